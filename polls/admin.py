@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.db.models import Sum
 
 from models import Poll, Choice, Vote
 
@@ -13,11 +14,38 @@ class PollAdmin(admin.ModelAdmin):
     inlines = (ChoiceInline,)
     list_display = ('question', 'count_choices', 'count_total_votes')
 
+    def get_queryset(self, request):
+        queryset = super(PollAdmin, self).get_queryset(request)
+        return queryset.annotate(total_votes=Sum('choicetally__votes'))
+
+    def count_total_votes(self, obj):
+        return obj.total_votes or 0
+    count_total_votes.short_description = 'Total votes'
+    count_total_votes.admin_order_field = 'total_votes'
+
+
+def delete_votes(modeladmin, request, queryset):
+    # one delete that updates the tally, see VoteQuerySet.delete
+    count = queryset.count()
+    queryset.delete()
+    modeladmin.message_user(request, 'Deleted %d votes.' % count)
+delete_votes.short_description = 'Delete selected votes'
+
 
 class VoteAdmin(admin.ModelAdmin):
     model = Vote
-    list_display = ('choice', 'user', 'poll', 'created')
+    list_display = ('choice', 'user', 'voter', 'poll', 'created')
     readonly_fields = ('created',)
+    actions = (delete_votes,)
+
+    def get_actions(self, request):
+        actions = super(VoteAdmin, self).get_actions(request)
+        # replaced by delete_votes
+        actions.pop('delete_selected', None)
+        return actions
+
+    def delete_model(self, request, obj):
+        Vote.objects.filter(pk=obj.pk).delete()
 
 admin.site.register(Poll, PollAdmin)
 admin.site.register(Vote, VoteAdmin)
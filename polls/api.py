@@ -7,31 +7,106 @@
     PUT /poll/ -- update poll data
     GET /poll/ -- retrieve the poll information, including choice details
     GET /result/ -- retrieve the statistics on the poll.
+    GET /result/<pk or reference>/timeseries/ -- retrieve the vote count by choice over time
+    GET /result/<pk or reference>/stream/ -- stream the statistics as server-sent events
     This shall return a JSON formatted like so. Note the actual statistics calculation shall be implemented
         in poll.service.stats (later on, this will be externalized into a batch job).
 '''
 
 from exceptions import PollClosed, PollNotOpen, PollNotAnonymous, PollNotMultiple
 import json
+import re
 
+from django.conf import settings
 from django.conf.urls import url
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import resolve
+from django.db import transaction
 from django.forms.models import model_to_dict
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from tastypie import fields
 from tastypie import http
 from tastypie.authentication import MultiAuthentication, BasicAuthentication, SessionAuthentication, \
     Authentication
 from tastypie.authorization import Authorization, \
     DjangoAuthorization
-from tastypie.exceptions import ImmediateHttpResponse
+from tastypie.exceptions import ImmediateHttpResponse, NotFound
 from tastypie.resources import ALL, NamespacedModelResource
 
+from polls import metrics
+from polls.cache import results_cache
 from polls.exceptions import PollInvalidChoice
-from polls.models import Poll, Choice, Vote
+from polls.instrument import instrument_resource
+from polls.models import Poll, Choice, Vote, ROLLUP_BUCKETS, get_poll_rules
+from polls.pagination import PollPaginator
+from polls.stream import event_stream
 from polls.util import ReasonableDjangoAuthorization, IPAuthentication
 
 
+def parse_timestamp(value):
+    """
+    return the datetime of an ISO timestamp, or None if it is invalid. the
+    datetime is aware if USE_TZ is set and naive otherwise, naive
+    timestamps are in the default timezone.
+    """
+    try:
+        value = parse_datetime(unicode(value))
+    except ValueError:
+        return None
+    if value is None:
+        return None
+    if settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    elif not settings.USE_TZ and timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.get_default_timezone())
+    return value
+
+
+#: the detail uri of a poll by pk or reference, see PollResource.prepend_urls
+POLL_URI = re.compile(r'/poll/(?:(?P<pk>[0-9]+)|(?P<reference>[\w-]+))/$',
+                      re.UNICODE)
+POLL_REFERENCE = re.compile(r'^[\w-]+$', re.UNICODE)
+
+
+def resolve_poll(value):
+    """
+    return the (pk, reference) of a poll uri, pk or reference, one of
+    them is None. raises NotFound
+
+    this matches a single precompiled pattern instead of resolving the
+    uri against the urlconf, see get_poll_rules_via_uri
+    """
+    if isinstance(value, (int, long)):
+        return value, None
+    if not isinstance(value, basestring):
+        raise NotFound
+    if '/' in value:
+        match = POLL_URI.search(value)
+        if match is None:
+            raise NotFound
+        pk, reference = match.group('pk', 'reference')
+    elif value.isdigit():
+        pk, reference = value, None
+    elif POLL_REFERENCE.match(value):
+        pk, reference = None, value
+    else:
+        raise NotFound
+    return pk and int(pk), reference
+
+
+def get_poll_rules_via_uri(value):
+    """
+    return the cached PollRules of the poll of a uri, pk or reference,
+    without loading the poll, see polls.models.get_poll_rules. raises
+    NotFound or Poll.DoesNotExist
+    """
+    pk, reference = resolve_poll(value)
+    return get_poll_rules(pk=pk, reference=reference)
+
+
+@instrument_resource
 class UserResource(NamespacedModelResource):
 
     class Meta:
@@ -57,8 +132,9 @@ class UserResource(NamespacedModelResource):
         queries get_object_list, and we should return a valid
         list
         """
-        view, args, kwargs = resolve(request.path)
-        if request.method == 'GET' and not 'pk' in kwargs and not request.user.is_superuser:
+        # the request was resolved already, except if called directly
+        match = getattr(request, 'resolver_match', None) or resolve(request.path)
+        if request.method == 'GET' and not 'pk' in match.kwargs and not request.user.is_superuser:
             return object_list.filter(pk=request.user.pk)
         return object_list
 
@@ -68,6 +144,7 @@ class UserResource(NamespacedModelResource):
         return object_list
 
 
+@instrument_resource
 class PollResource(NamespacedModelResource):
     # POST, GET, PUT
     # user = fields.ForeignKey(UserResource, 'user')
@@ -82,21 +159,49 @@ class PollResource(NamespacedModelResource):
             BasicAuthentication(), SessionAuthentication(), Authentication())
         authorization = ReasonableDjangoAuthorization(read_list='',
                                                       read_detail='')
+        excludes = ['tally_shards', 'reference_uuid']
         filtering = {
             'reference': 'exact',
         }
+        # pages by cursor instead of offset, see polls.pagination
+        paginator_class = PollPaginator
         
+    #: the maximum number of queries to GET a list page or a detail,
+    #: not counting authentication
+    query_budget = dict(list=3, detail=3)
+
+    def get_object_list(self, request):
+        # fetch the choices of all polls in a page with a single query
+        object_list = super(PollResource, self).get_object_list(request)
+        return object_list.prefetch_related('choice_set')
+
     def obj_create(self, bundle, **kwargs):
-        return super(PollResource, self).obj_create(bundle, user=bundle.request.user)
+        """ create the poll and the choices given in the same call """
+        choices = bundle.data.get('choices') or []
+        if not isinstance(choices, list):
+            raise ImmediateHttpResponse(
+                response=http.HttpBadRequest('invalid choices'))
+        if choices and not bundle.request.user.has_perm('polls.add_choice'):
+            raise ImmediateHttpResponse(response=http.HttpUnauthorized())
+        with transaction.atomic():
+            bundle = super(PollResource, self).obj_create(
+                bundle, user=bundle.request.user)
+            try:
+                if choices:
+                    Choice.objects.create_for_poll(bundle.obj, choices)
+            except PollInvalidChoice:
+                # leaving the atomic block by an exception rolls back the poll
+                raise ImmediateHttpResponse(
+                    response=http.HttpBadRequest('invalid choices'))
+        return bundle
 
     def dehydrate(self, bundle):
-        choices = Choice.objects.filter(poll=bundle.data['id'])
+        choices = bundle.obj.choice_set.all()
         bundle.data['choices'] = [model_to_dict(choice) for choice in choices]
         return bundle
 
     def alter_detail_data_to_serialize(self, request, data):
-        data.data['already_voted'] = Poll.objects.get(
-            pk=data.data.get('id')).already_voted(user=request.user)
+        data.data['already_voted'] = data.obj.already_voted(user=request.user)
         return data
 
     def prepend_urls(self):
@@ -109,6 +214,7 @@ class PollResource(NamespacedModelResource):
         ]
 
 
+@instrument_resource
 class ChoiceResource(NamespacedModelResource):
     poll = fields.ToOneField(PollResource, 'poll')
 
@@ -122,6 +228,7 @@ class ChoiceResource(NamespacedModelResource):
         always_return_data = True
 
 
+@instrument_resource
 class VoteResource(NamespacedModelResource):
     user = fields.ToOneField(
         UserResource, 'user', blank=True, null=True, readonly=True)
@@ -140,9 +247,102 @@ class VoteResource(NamespacedModelResource):
         resource_name = 'vote'
         always_return_data = True
 
+    #: the authentication of dispatch_batch
+    batch_authentication = MultiAuthentication(BasicAuthentication(),
+                                               SessionAuthentication())
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/batch/$" % self._meta.resource_name,
+                self.wrap_view('dispatch_batch'), name="api_vote_batch"),
+        ]
+
+    def dispatch_batch(self, request, **kwargs):
+        """
+        vote with many ballots of anonymous voters in one call, e.g. from
+        offline clients. requires a user with the add_vote permission,
+        authenticated by password or session.
+
+        POST /vote/batch/
+        {
+          poll : poll uri,
+          ballots : [{ voter : client key, choice : [choice, ...],
+                       data : data, comment : comment,
+                       created : ISO timestamp the ballot was cast }, ...]
+        }
+
+        returns a result for each ballot, in order
+        {
+          results : [{ status : accepted|duplicate|rejected,
+                       reason : reason }, ...]
+        }
+        """
+        self.method_check(request, allowed=['post'])
+        # not by IPAuthentication, anonymous callers get no user or voter
+        auth_result = self.batch_authentication.is_authenticated(request)
+        if isinstance(auth_result, HttpResponse):
+            raise ImmediateHttpResponse(response=auth_result)
+        if auth_result is not True or request.user.is_anonymous():
+            raise ImmediateHttpResponse(response=http.HttpUnauthorized())
+        self.throttle_check(request)
+        if not request.user.has_perm('polls.add_vote'):
+            raise ImmediateHttpResponse(response=http.HttpUnauthorized())
+        data = self.deserialize(request, request.body, format=request.META.get(
+            'CONTENT_TYPE', 'application/json'))
+        if not isinstance(data, dict):
+            raise ImmediateHttpResponse(
+                response=http.HttpBadRequest('invalid data'))
+        ballots = data.get('ballots')
+        max_size = getattr(settings, 'POLLS_VOTE_BATCH_SIZE', 500)
+        if not isinstance(ballots, list) or len(ballots) > max_size:
+            raise ImmediateHttpResponse(
+                response=http.HttpBadRequest('invalid data'))
+        try:
+            poll = get_poll_rules_via_uri(data.get('poll')).as_poll()
+        except (NotFound, Poll.DoesNotExist):
+            raise ImmediateHttpResponse(
+                response=http.HttpBadRequest('invalid poll'))
+        results = [None] * len(ballots)
+        valid = []
+        for index, ballot in enumerate(ballots):
+            if not isinstance(ballot, dict):
+                results[index] = ('rejected', 'invalid data')
+                continue
+            ballot = dict(ballot)
+            if ballot.get('created'):
+                created = parse_timestamp(ballot['created'])
+                if created is None:
+                    results[index] = ('rejected', 'invalid created')
+                    continue
+                ballot['created'] = created
+            valid.append((index, ballot))
+        voted = poll.vote_batch([ballot for index, ballot in valid])
+        for (index, ballot), result in zip(valid, voted):
+            results[index] = result
+        self.log_throttled_access(request)
+        return self.create_response(request, dict(results=[
+            dict(status=status, reason=reason) for status, reason in results]))
+
     def obj_create(self, bundle, **kwargs):
-        poll = PollResource().get_via_uri(bundle.data.get('poll'))
-        if not poll.already_voted(bundle.request.user):
+        # vote by the cached rules of the poll instead of loading it
+        rules = get_poll_rules_via_uri(bundle.data.get('poll'))
+        try:
+            rules.check_open()
+        except (PollClosed, PollNotOpen) as e:
+            metrics.rejections.inc(poll=rules.pk, reason=e.__class__.__name__)
+            raise ImmediateHttpResponse(
+                response=http.HttpForbidden('not allowed'))
+        poll = rules.as_poll()
+        user = bundle.request.user
+        # set by IPAuthentication for anonymous voters
+        voter = getattr(bundle.request, 'voter', None)
+        try:
+            already_voted = poll.already_voted(user, voter=voter)
+        except PollNotAnonymous:
+            metrics.rejections.inc(poll=poll.pk, reason='PollNotAnonymous')
+            raise ImmediateHttpResponse(
+                response=http.HttpForbidden('not allowed'))
+        if not already_voted:
             try:
                 choices = bundle.data.get('choice')
                 # convert single-choice into list
@@ -150,7 +350,8 @@ class VoteResource(NamespacedModelResource):
                     choices = [choices]
                 votes = poll.vote(choices=choices,
                                   data=bundle.data.get('data'),
-                                  user=bundle.request.user,
+                                  user=None if user.is_anonymous() else user,
+                                  voter=voter,
                                   comment=bundle.data.get('comment'))
             except (PollClosed, PollNotOpen, PollNotAnonymous, PollNotMultiple):
                 raise ImmediateHttpResponse(
@@ -158,23 +359,43 @@ class VoteResource(NamespacedModelResource):
             except PollInvalidChoice:
                 raise ImmediateHttpResponse(
                     response=http.HttpBadRequest('invalid data'))
-            else:
-                bundle.obj = votes[0]
+            if votes[0].pk is None:
+                # the ballot was spooled, see polls.buffer
+                raise ImmediateHttpResponse(response=http.HttpAccepted())
+            bundle.obj = votes[0]
         else:
+            metrics.rejections.inc(poll=poll.pk, reason='already_voted')
             raise ImmediateHttpResponse(
                 response=http.HttpForbidden('already voted'))
         return bundle
 
     def obj_update(self, bundle, **kwargs):
-        poll = PollResource().get_via_uri(bundle.data.get('poll'))
+        rules = get_poll_rules_via_uri(bundle.data.get('poll'))
+        try:
+            vote = self.obj_get(bundle=bundle, **kwargs)
+        except Vote.DoesNotExist:
+            raise NotFound('vote not found')
         # non anonymous votes by the same user can be modified
-        if not poll.is_anonymous and bundle.obj.user == bundle.request.user:
-            bundle.obj.change_vote(choices=bundle.data.get('choice'),
-                                   data=bundle.data.get('data'),
-                                   user=bundle.request.user)
-        else:
+        user = bundle.request.user
+        if (rules.is_anonymous or vote.poll_id != rules.pk or
+                user.is_anonymous() or vote.user_id != user.pk):
             raise ImmediateHttpResponse(
                 response=http.HttpForbidden('already voted'))
+        choices = bundle.data.get('choice')
+        # convert single-choice into list
+        if isinstance(choices, basestring):
+            choices = [choices]
+        try:
+            votes = rules.as_poll().change_vote(choices, user=user,
+                                                data=bundle.data.get('data'))
+        except (PollClosed, PollNotOpen, PollNotAnonymous, PollNotMultiple):
+            raise ImmediateHttpResponse(
+                response=http.HttpForbidden('not allowed'))
+        except PollInvalidChoice:
+            raise ImmediateHttpResponse(
+                response=http.HttpBadRequest('invalid data'))
+        bundle.obj = votes[0]
+        return bundle
 
     def dehydrate(self, bundle):
         # convert JSON Field
@@ -187,6 +408,7 @@ class VoteResource(NamespacedModelResource):
         return bundle
 
 
+@instrument_resource
 class ResultResource(NamespacedModelResource):
 
     class Meta:
@@ -199,11 +421,20 @@ class ResultResource(NamespacedModelResource):
         resource_name = 'result'
         always_return_data = True
         excludes = ['description', 'start_votes', 'end_votes',
-                    'is_anonymous', 'is_multiple', 'is_closed', 'reference']
+                    'is_anonymous', 'is_multiple', 'is_closed', 'reference',
+                    'reference_uuid', 'tally_shards']
 
     def prepend_urls(self):
         """ match by pk or reference """
         return [
+            url(r"^(?P<resource_name>%s)/(?P<pk>[0-9]+)/timeseries/$" % self._meta.resource_name,
+                self.wrap_view('dispatch_timeseries'), name="api_dispatch_timeseries"),
+            url(r"^(?P<resource_name>%s)/(?P<reference>[\w-]+)/timeseries/$" % self._meta.resource_name,
+                self.wrap_view('dispatch_timeseries'), name="api_dispatch_timeseries"),
+            url(r"^(?P<resource_name>%s)/(?P<pk>[0-9]+)/stream/$" % self._meta.resource_name,
+                self.wrap_view('dispatch_stream'), name="api_dispatch_stream"),
+            url(r"^(?P<resource_name>%s)/(?P<reference>[\w-]+)/stream/$" % self._meta.resource_name,
+                self.wrap_view('dispatch_stream'), name="api_dispatch_stream"),
             url(r"^(?P<resource_name>%s)/(?P<pk>[0-9]+)/$" % self._meta.resource_name,
                 self.wrap_view('dispatch_detail'), name="api_dispatch_detail"),
             url(r"^(?P<resource_name>%s)/(?P<reference>[\w-]+)/$" % self._meta.resource_name,
@@ -211,6 +442,106 @@ class ResultResource(NamespacedModelResource):
         ]
 
     def dehydrate(self, bundle):
+        """
+        add the statistics of the poll. with ?as_of=<ISO timestamp> the
+        statistics as of that time are computed from the rollups, see
+        Poll.get_tally_as_of. with ?segment_by=<key> the statistics are
+        broken down by that key of the votes' data, see Poll.get_segments
+        """
         poll = bundle.obj
-        bundle.data['stats'] = poll.get_stats()
+        as_of = bundle.request.GET.get('as_of')
+        segment_by = bundle.request.GET.get('segment_by')
+        if as_of and segment_by:
+            raise ImmediateHttpResponse(response=http.HttpBadRequest(
+                'as_of and segment_by cannot be combined'))
+        if segment_by:
+            with metrics.results_latency.time(source='segment'):
+                bundle.data['stats'] = results_cache.get_stats(
+                    poll, segment_by=segment_by)
+        elif as_of:
+            as_of = parse_timestamp(as_of)
+            if as_of is None:
+                raise ImmediateHttpResponse(
+                    response=http.HttpBadRequest('invalid as_of'))
+            with metrics.results_latency.time(source='rollups'):
+                bundle.data['stats'] = poll.get_stats(as_of=as_of)
+            bundle.data['as_of'] = as_of
+        else:
+            with metrics.results_latency.time(source='cache'):
+                bundle.data['stats'] = results_cache.get_stats(poll)
         return bundle
+
+    def dispatch_timeseries(self, request, **kwargs):
+        """
+        return the vote count by choice over time, read from the rollups
+
+        GET /result/<pk or reference>/timeseries/?bucket=1m
+
+        bucket is one of 1m or 1h, defaults to 1m. since and until are
+        optional ISO timestamps to limit the series. returns
+        {
+          bucket : bucket,
+          labels : [choice, ...],
+          codes  : [code, ...],
+          series : [{ start : timestamp, votes : [count, ...] }, ...],
+        }
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        bucket = request.GET.get('bucket', '1m')
+        if bucket not in ROLLUP_BUCKETS:
+            raise ImmediateHttpResponse(
+                response=http.HttpBadRequest('invalid bucket'))
+        limits = {}
+        for name in ('since', 'until'):
+            if request.GET.get(name):
+                limits[name] = parse_timestamp(request.GET[name])
+                if limits[name] is None:
+                    raise ImmediateHttpResponse(
+                        response=http.HttpBadRequest('invalid %s' % name))
+        poll = self.get_poll(request, **kwargs)
+        self.log_throttled_access(request)
+        return self.create_response(
+            request, poll.get_timeseries(bucket, **limits))
+
+    def dispatch_stream(self, request, **kwargs):
+        """
+        stream the statistics of a poll as server-sent events, see
+        polls.stream
+
+        GET /result/<pk or reference>/stream/
+
+        sends a stats event with the statistics on connect and whenever
+        they change, at most once per POLLS_STREAM_INTERVAL
+
+        the stream holds a worker for up to POLLS_STREAM_TIMEOUT seconds,
+        serve it by an asynchronous server such as gunicorn with gevent
+        workers. beyond POLLS_STREAM_MAX_SUBSCRIBERS streams per process
+        clients poll instead, see polls.stream
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        poll = self.get_poll(request, **kwargs)
+        last_event_id = request.META.get('HTTP_LAST_EVENT_ID', '')
+        last_event_id = int(last_event_id) if last_event_id.isdigit() else None
+        self.log_throttled_access(request)
+        response = StreamingHttpResponse(event_stream(poll, last_event_id),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # do not let nginx buffer the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def get_poll(self, request, **kwargs):
+        """
+        return the poll of a result url by pk or reference, or respond
+        with 404
+        """
+        try:
+            return self.cached_obj_get(
+                bundle=self.build_bundle(request=request),
+                **self.remove_api_resource_names(kwargs))
+        except Poll.DoesNotExist:
+            raise ImmediateHttpResponse(response=http.HttpNotFound())
@@ -0,0 +1,271 @@
+"""
+micro-benchmarks of the polls core
+
+a synthetic poll with a given number of choices and votes is generated
+for every scenario, then each operation is timed repeatedly. results are
+reported as operations per second and latency percentiles, and can be
+saved as JSON and compared to a previous run.
+
+Usage:
+    results = run_benchmarks(choices=[10, 1000], votes=[1000, 100000],
+                             ballot_sizes=[1, 5], repeat=100)
+    save_results(results, 'benchmark.json')
+    compare_results(load_results('baseline.json'), results)
+    => [(scenario, operation, baseline ops/s, ops/s), ...] of regressions
+
+    $ python manage.py polls_benchmark --choices 10,1000 --votes 1000,1000000
+      --output benchmark.json --compare baseline.json
+
+benchmarks write to the configured database, run them against a local
+SQLite database, not production. generated data is deleted after each
+scenario.
+"""
+from datetime import timedelta
+from timeit import default_timer
+import json
+import platform
+import random
+
+import django
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection, transaction
+from django.utils import timezone
+
+from polls.api import PollResource, get_poll_rules_via_uri
+from polls.models import (Choice, ChoiceTally, Poll, Vote, Voter, VoteRollup,
+                          ROLLUP_BUCKETS, bucket_start)
+
+
+OPERATIONS = ('vote', 'change_vote', 'already_voted', 'get_stats',
+              'count_percentage', 'resolve_poll', 'resolve_poll_rules')
+PERCENTILES = (50, 90, 99)
+
+
+def generate_poll(choices=10, votes=1000, ballot_size=1, chunk_size=5000):
+    """
+    create an anonymous poll with the given number of choices and votes
+    cast by ballot_size choices each, with its tally and rollups. votes
+    are spread over the last hour. returns the poll.
+    """
+    now = timezone.now()
+    poll = Poll.objects.create(
+        question='benchmark %d choices %d votes' % (choices, votes),
+        is_anonymous=True, is_multiple=ballot_size > 1,
+        start_votes=now - timedelta(days=1))
+    Choice.objects.create_for_poll(
+        poll, ['choice %d' % i for i in xrange(choices)])
+    # bulk_create does not set primary keys
+    choice_ids = list(poll.choice_set.values_list('pk', flat=True))
+    prefix = 'bench:%d:' % poll.pk
+    ballots = max(1, votes // ballot_size)
+    for start in xrange(0, ballots, chunk_size):
+        Voter.objects.bulk_create(
+            Voter(key='%s%d' % (prefix, i))
+            for i in xrange(start, min(start + chunk_size, ballots)))
+    voter_ids = (Voter.objects.filter(key__startswith=prefix)
+                 .order_by('pk').values_list('pk', flat=True))
+    tally = dict((choice_id, 0) for choice_id in choice_ids)
+    rollups = {}
+    chunk = []
+    for voter_id in voter_ids.iterator():
+        created = now - timedelta(seconds=random.random() * 3600)
+        for choice_id in random.sample(choice_ids, min(ballot_size, choices)):
+            chunk.append(Vote(poll=poll, choice_id=choice_id,
+                              voter_id=voter_id, created=created))
+            tally[choice_id] += 1
+            for seconds in ROLLUP_BUCKETS.values():
+                key = (choice_id, seconds, bucket_start(created, seconds))
+                rollups[key] = rollups.get(key, 0) + 1
+        if len(chunk) >= chunk_size:
+            Vote.objects.bulk_create(chunk)
+            chunk = []
+    Vote.objects.bulk_create(chunk)
+    ChoiceTally.objects.bulk_create(
+        (ChoiceTally(poll=poll, choice_id=choice_id, votes=count)
+         for choice_id, count in tally.iteritems()))
+    VoteRollup.objects.bulk_create(
+        (VoteRollup(poll=poll, choice_id=choice_id, bucket=seconds,
+                    start=start, votes=count)
+         for (choice_id, seconds, start), count in rollups.iteritems()))
+    return poll
+
+
+def delete_poll(poll):
+    """
+    delete a generated poll and its voters
+    """
+    with transaction.atomic():
+        pk = poll.pk
+        poll.delete()
+        # without sending a signal for every voter
+        (Voter.objects.filter(key__startswith='bench:%d:' % pk)
+         ._raw_delete(connection.alias))
+
+
+def measure(func, repeat=100, warmup=5):
+    """
+    call func(i) repeat times after warmup calls, returns a dict of
+    {
+      count : repeat,
+      ops_per_sec : calls per second,
+      mean, min, max, p50, p90, p99 : latency in milliseconds
+    }
+    """
+    for i in xrange(warmup):
+        func(i)
+    timings = []
+    for i in xrange(repeat):
+        started = default_timer()
+        func(warmup + i)
+        timings.append(default_timer() - started)
+    total = sum(timings)
+    timings.sort()
+    result = dict(count=repeat,
+                  ops_per_sec=repeat / total if total else None,
+                  mean=1000 * total / repeat,
+                  min=1000 * timings[0], max=1000 * timings[-1])
+    for percentile in PERCENTILES:
+        # nearest rank
+        rank = max(0, int(round(percentile / 100.0 * repeat)) - 1)
+        result['p%d' % percentile] = 1000 * timings[rank]
+    return result
+
+
+def benchmark_poll(poll, ballot_size=1, repeat=100, warmup=5,
+                   operations=OPERATIONS):
+    """
+    time the operations on a poll, returns a dict of { operation : result }
+    """
+    choice_ids = list(poll.choice_set.values_list('pk', flat=True))
+    count = repeat + warmup
+    new_voters = [Voter.objects.create(key='bench:%d:new:%d' % (poll.pk, i))
+                  for i in xrange(count)]
+    old_voters = list(Voter.objects.filter(
+        key__startswith='bench:%d:' % poll.pk, vote__poll=poll)
+        .distinct()[:count])
+    user = AnonymousUser()
+
+    def ballot():
+        return random.sample(choice_ids, min(ballot_size, len(choice_ids)))
+
+    def vote(i):
+        poll.vote(ballot(), voter=new_voters[i], buffered=False)
+
+    def change_vote(i):
+        poll.change_vote(ballot(), voter=old_voters[i % len(old_voters)])
+
+    def already_voted(i):
+        # alternate between voters who did and did not vote
+        voters = old_voters if i % 2 else new_voters
+        poll.already_voted(user, voter=voters[i % len(voters)])
+
+    def get_stats(i):
+        poll.get_stats()
+
+    def count_percentage(i):
+        poll.count_percentage(as_code=True)
+
+    # the poll lookup of a vote request, by the resource and by the
+    # cached rules
+    uri = '/api/v1/poll/%d/' % poll.pk
+
+    def resolve_poll(i):
+        PollResource().get_via_uri(uri)
+
+    def resolve_poll_rules(i):
+        get_poll_rules_via_uri(uri)
+
+    funcs = dict(vote=vote, change_vote=change_vote,
+                 already_voted=already_voted, get_stats=get_stats,
+                 count_percentage=count_percentage, resolve_poll=resolve_poll,
+                 resolve_poll_rules=resolve_poll_rules)
+    results = {}
+    for operation in operations:
+        if operation in ('change_vote', 'already_voted') and not old_voters:
+            continue
+        results[operation] = measure(funcs[operation], repeat, warmup)
+    return results
+
+
+def run_benchmarks(choices=(10,), votes=(1000,), ballot_sizes=(1,),
+                   repeat=100, warmup=5, operations=OPERATIONS, keep=False,
+                   log=None):
+    """
+    run the benchmarks of every scenario of choices x votes x ballot size,
+    returns the results to save with save_results
+    """
+    scenarios = []
+    for num_choices in choices:
+        for num_votes in votes:
+            for ballot_size in ballot_sizes:
+                if ballot_size > num_choices:
+                    continue
+                scenario = dict(choices=num_choices, votes=num_votes,
+                                ballot_size=ballot_size)
+                if log:
+                    log('generating %(choices)d choices, %(votes)d votes, '
+                        '%(ballot_size)d per ballot' % scenario)
+                started = default_timer()
+                poll = generate_poll(num_choices, num_votes, ballot_size)
+                scenario['generate_seconds'] = default_timer() - started
+                try:
+                    scenario['operations'] = benchmark_poll(
+                        poll, ballot_size, repeat, warmup, operations)
+                finally:
+                    if not keep:
+                        delete_poll(poll)
+                if log:
+                    for operation, result in sorted(
+                            scenario['operations'].iteritems()):
+                        log('  %-16s %10.1f ops/s  p50 %8.2f ms  p99 %8.2f ms'
+                            % (operation, result['ops_per_sec'] or 0,
+                               result['p50'], result['p99']))
+                scenarios.append(scenario)
+    return dict(environment=environment(), scenarios=scenarios)
+
+
+def environment():
+    """
+    return a description of where the benchmarks ran
+    """
+    env = dict(python=platform.python_version(),
+               django=django.get_version(),
+               platform=platform.platform(),
+               database=connection.vendor,
+               created=timezone.now().isoformat())
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        env['sqlite'] = sqlite3.sqlite_version
+    return env
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(baseline, results, threshold=0.1):
+    """
+    return the operations that are slower than in baseline by more than
+    threshold, as a list of (scenario, operation, baseline ops/s, ops/s)
+    """
+    def key(scenario):
+        return scenario['choices'], scenario['votes'], scenario['ballot_size']
+    baselines = dict((key(scenario), scenario)
+                     for scenario in baseline['scenarios'])
+    regressions = []
+    for scenario in results['scenarios']:
+        base = baselines.get(key(scenario))
+        if base is None:
+            continue
+        for operation, result in sorted(scenario['operations'].iteritems()):
+            before = base['operations'].get(operation, {}).get('ops_per_sec')
+            after = result['ops_per_sec']
+            if before and after and after < before * (1 - threshold):
+                regressions.append((key(scenario), operation, before, after))
+    return regressions
@@ -0,0 +1,208 @@
+"""
+probabilistic already-voted checks
+
+a Bloom filter of the voters of a poll is kept in the cache, shared by all
+workers. if a voter is not in the filter they have not voted and the
+database need not be queried. false positives are checked against the
+database.
+
+the filter is built from the poll's votes on first use, by a single
+worker behind a lock. votes do not rewrite the filter: each vote stores
+its voters under the next number of a per-poll counter, and readers add
+these deltas to the filter. every POLLS_VOTED_FILTER_DELTAS deltas a
+reader merges them into the filter, again behind the lock. while the
+filter or one of its deltas is missing, e.g. because it was evicted,
+voters are checked against the database until the filter is rebuilt,
+so it never misses a voter.
+
+Settings:
+    POLLS_VOTED_FILTER -- set to True to enable, defaults to False
+    POLLS_VOTED_FILTER_CAPACITY -- the minimum number of voters a filter
+      is sized for, defaults to 10000
+    POLLS_VOTED_FILTER_ERROR_RATE -- the false positive rate at capacity,
+      defaults to 0.01
+    POLLS_VOTED_FILTER_DELTAS -- the number of deltas after which they are
+      merged into the filter, defaults to 100
+"""
+import hashlib
+import math
+import struct
+
+from django.conf import settings
+
+from polls.cache import get_cache, get_counter
+
+
+FILTER_KEY = 'polls:voted:%s'
+LOCK_KEY = 'polls:voted:%s:lock'
+SEQUENCE_KEY = 'polls:voted:%s:seq'
+DELTA_KEY = 'polls:voted:%s:%d'
+#: seconds to keep a delta, a filter whose deltas expired is rebuilt
+DELTA_TIMEOUT = 86400
+HEADER = struct.Struct('!IIII')
+
+
+class BloomFilter(object):
+
+    """
+    a Bloom filter of strings
+
+    Usage:
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        bloom.add('foo')
+        'foo' in bloom
+        => True
+        bloom = BloomFilter.loads(bloom.dumps())
+    """
+    def __init__(self, capacity, error_rate=0.01, num_bits=None,
+                 num_hashes=None, count=0, bits=None):
+        self.capacity = capacity
+        if num_bits is None:
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                     math.log(2) ** 2))
+            num_bits = max(8, num_bits)
+        if num_hashes is None:
+            num_hashes = max(1, int(round(num_bits * math.log(2) / capacity)))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self.bits = bits or bytearray((num_bits + 7) // 8)
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(key))
+
+    @property
+    def is_full(self):
+        return self.count > self.capacity
+
+    def dumps(self):
+        return HEADER.pack(self.capacity, self.num_bits, self.num_hashes,
+                           self.count) + str(self.bits)
+
+    @classmethod
+    def loads(cls, value):
+        capacity, num_bits, num_hashes, count = HEADER.unpack_from(value)
+        return cls(capacity, num_bits=num_bits, num_hashes=num_hashes,
+                   count=count, bits=bytearray(value[HEADER.size:]))
+
+    def _positions(self, key):
+        # double hashing, see Kirsch and Mitzenmacher, "Less Hashing,
+        # Same Performance: Building a Better Bloom Filter"
+        digest = hashlib.md5(key).digest()
+        h1, h2 = struct.unpack('!QQ', digest)
+        return [(h1 + i * h2) % self.num_bits
+                for i in xrange(self.num_hashes)]
+
+
+def voter_key(user_id=None, voter_id=None):
+    """
+    return the filter key of a user, or of a voter if given
+    """
+    if voter_id is not None:
+        return 'v%s' % voter_id
+    return 'u%s' % user_id
+
+
+def is_enabled():
+    return getattr(settings, 'POLLS_VOTED_FILTER', False)
+
+
+def might_have_voted(poll, key):
+    """
+    return False if the voter with the given key has certainly not voted
+    in the poll, True if they might have
+    """
+    if not is_enabled():
+        return True
+    bloom = _get_filter(poll)
+    if bloom is None:
+        return True
+    return key in bloom
+
+
+def add_voters(poll_pk, keys):
+    """
+    add voter keys to the filter of a poll, if the filter exists
+    """
+    if not is_enabled():
+        return
+    cache = get_cache()
+    try:
+        sequence = cache.incr(SEQUENCE_KEY % poll_pk)
+    except ValueError:
+        # there is no filter, it is built from the votes
+        return
+    cache.set(DELTA_KEY % (poll_pk, sequence), list(keys), DELTA_TIMEOUT)
+
+
+def drop_filter(poll_pk):
+    get_cache().delete_many([FILTER_KEY % poll_pk, SEQUENCE_KEY % poll_pk])
+
+
+def _get_filter(poll):
+    cache = get_cache()
+    values = cache.get_many([FILTER_KEY % poll.pk, SEQUENCE_KEY % poll.pk])
+    value = values.get(FILTER_KEY % poll.pk)
+    sequence = values.get(SEQUENCE_KEY % poll.pk)
+    if value is None or sequence is None:
+        _build_filter(poll)
+        return None
+    merged, value = value
+    bloom = BloomFilter.loads(value)
+    if sequence == merged:
+        return bloom
+    max_deltas = getattr(settings, 'POLLS_VOTED_FILTER_DELTAS', 100)
+    keys = [DELTA_KEY % (poll.pk, number)
+            for number in xrange(merged + 1, sequence + 1)]
+    deltas = cache.get_many(keys)
+    missing = [index for index, key in enumerate(keys) if key not in deltas]
+    if missing:
+        # the latest deltas may still be stored by their votes, older
+        # ones were evicted
+        if len(keys) - missing[0] > max_deltas:
+            _build_filter(poll)
+        return None
+    for key in keys:
+        for voter in deltas[key]:
+            bloom.add(voter)
+    if bloom.is_full:
+        # rebuild with a larger capacity, the full filter is still valid
+        _build_filter(poll)
+    elif len(keys) >= max_deltas and cache.add(LOCK_KEY % poll.pk, True, 60):
+        # merged deltas expire, readers of the previous filter need them
+        try:
+            cache.set(FILTER_KEY % poll.pk, (sequence, bloom.dumps()), None)
+        finally:
+            cache.delete(LOCK_KEY % poll.pk)
+    return bloom
+
+
+def _build_filter(poll):
+    cache = get_cache()
+    if not cache.add(LOCK_KEY % poll.pk, True, 60):
+        # another worker is building the filter
+        return
+    try:
+        # an evicted sequence never restarts below deltas that are
+        # still cached, see get_counter
+        sequence = get_counter(SEQUENCE_KEY % poll.pk)
+        if sequence is None:
+            return
+        # votes after the sequence are added from their deltas
+        voters = (poll.vote_set.order_by()
+                  .values_list('user', 'voter').distinct())
+        capacity = max(getattr(settings, 'POLLS_VOTED_FILTER_CAPACITY', 10000),
+                       2 * voters.count())
+        bloom = BloomFilter(capacity, getattr(
+            settings, 'POLLS_VOTED_FILTER_ERROR_RATE', 0.01))
+        for user_id, voter_id in voters.iterator():
+            bloom.add(voter_key(user_id, voter_id))
+        cache.set(FILTER_KEY % poll.pk, (sequence, bloom.dumps()), None)
+    finally:
+        cache.delete(LOCK_KEY % poll.pk)
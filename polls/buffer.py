@@ -0,0 +1,230 @@
+"""
+write-behind buffering of votes
+
+when POLLS_VOTE_BUFFER is set to a file path, Poll.vote() validates a
+ballot and appends it to a SQLite spool file at that path instead of
+inserting the votes. the polls_flush_votes management command drains the
+spool into the database in batched transactions.
+
+    # settings.py
+    POLLS_VOTE_BUFFER = '/var/spool/polls/votes.sqlite3'
+    POLLS_VOTE_BUFFER_BATCH_SIZE = 1000
+    POLLS_VOTE_BUFFER_FLUSH_INTERVAL = 1.0
+
+    $ python manage.py polls_flush_votes
+
+concurrent flushes claim disjoint batches of the spool. a batch whose
+flush died is claimed again after POLLS_VOTE_BUFFER_CLAIM_TIMEOUT
+seconds, and its ballots that were committed to the database already
+are skipped, so that no ballot is counted twice.
+
+Settings:
+    POLLS_VOTE_BUFFER_CLAIM_TIMEOUT -- seconds after which the ballots
+      claimed by a flush are flushed again, must exceed the duration of
+      a flush, defaults to 300
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from polls import bloom
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ballot (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    poll_id INTEGER NOT NULL,
+    user_id INTEGER,
+    voter_id INTEGER,
+    choices TEXT NOT NULL,
+    data TEXT,
+    comment TEXT,
+    created TEXT NOT NULL,
+    flush_id TEXT,
+    claimed REAL
+);
+CREATE INDEX IF NOT EXISTS ballot_poll_user ON ballot (poll_id, user_id);
+CREATE INDEX IF NOT EXISTS ballot_poll_voter ON ballot (poll_id, voter_id);
+"""
+
+
+class VoteBuffer(object):
+
+    """
+    a durable spool of ballots in a SQLite database, safe to be shared
+    by multiple threads and processes on the same host
+
+    Usage:
+        buffer = VoteBuffer('/path/to/spool.sqlite3')
+        buffer.append(poll_id, user_id, [choice_id, ...])
+        buffer.depth()
+        => 1
+        buffer.flush(batch_size=1000)
+        => 1
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            columns = [row[1] for row in
+                       connection.execute('PRAGMA table_info(ballot)')]
+            if 'flush_id' not in columns:
+                # spools created before flushes claimed ballots
+                connection.execute('ALTER TABLE ballot ADD COLUMN flush_id TEXT')
+                connection.execute('ALTER TABLE ballot ADD COLUMN claimed REAL')
+            self._local.connection = connection
+        return connection
+
+    def append(self, poll_id, user_id, choice_ids, data=None, comment=None,
+               created=None, voter_id=None):
+        """
+        append a ballot to the buffer. the ballot must have been validated.
+        """
+        created = created or timezone.now()
+        self.connection.execute(
+            'INSERT INTO ballot (poll_id, user_id, voter_id, choices, data, '
+            'comment, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (poll_id, user_id, voter_id, json.dumps(list(choice_ids)),
+             json.dumps(data) if data is not None else None, comment,
+             created.isoformat()))
+
+    def depth(self):
+        """
+        return the number of ballots waiting to be flushed
+        """
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM ballot').fetchone()[0]
+
+    def pending(self, poll_id, user_id, voter_id=None):
+        """
+        return True if the user, or the voter if given, has a ballot
+        waiting to be flushed
+        """
+        if voter_id is not None:
+            query = 'SELECT 1 FROM ballot WHERE poll_id = ? AND voter_id = ?'
+            params = (poll_id, voter_id)
+        else:
+            query = 'SELECT 1 FROM ballot WHERE poll_id = ? AND user_id IS ?'
+            params = (poll_id, user_id)
+        return self.connection.execute(
+            query + ' LIMIT 1', params).fetchone() is not None
+
+    def claim(self, batch_size):
+        """
+        claim up to batch_size ballots that are not claimed by another
+        flush, or whose claim timed out. returns the flush id and the
+        rows claimed, see polls.buffer
+        """
+        timeout = getattr(settings, 'POLLS_VOTE_BUFFER_CLAIM_TIMEOUT', 300)
+        flush_id = uuid.uuid4().hex
+        now = time.time()
+        connection = self.connection
+        # an immediate transaction locks the spool against other claims
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT id, poll_id, user_id, voter_id, choices, data, '
+                'comment, created, flush_id FROM ballot '
+                'WHERE flush_id IS NULL OR claimed < ? ORDER BY id LIMIT ?',
+                (now - timeout, batch_size)).fetchall()
+            connection.executemany(
+                'UPDATE ballot SET flush_id = ?, claimed = ? WHERE id = ?',
+                [(flush_id, now, row[0]) for row in rows])
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return flush_id, rows
+
+    def flush(self, batch_size=None):
+        """
+        move up to batch_size ballots into the database in a single
+        transaction. returns the number of ballots flushed.
+        """
+        from polls.models import Choice, ChoiceTally, Poll, Vote, VoteRollup
+        from polls.cache import bump_version
+        batch_size = batch_size or getattr(
+            settings, 'POLLS_VOTE_BUFFER_BATCH_SIZE', 1000)
+        flush_id, rows = self.claim(batch_size)
+        if not rows:
+            return 0
+        ballots = [(poll_id, user_id, voter_id, json.loads(choices),
+                    json.loads(data) if data is not None else None,
+                    comment, parse_datetime(created))
+                   for (_, poll_id, user_id, voter_id, choices, data, comment,
+                        created, _) in rows]
+        # ballots claimed before by a flush that died may have been
+        # committed, the votes of a ballot share their voter and time
+        reclaimed = [ballot for ballot, row in zip(ballots, rows) if row[-1]]
+        if reclaimed:
+            query = Q()
+            for ballot in reclaimed:
+                query |= Q(poll=ballot[0], user=ballot[1], voter=ballot[2],
+                           created=ballot[6])
+            flushed = set(Vote.objects.filter(query).values_list(
+                'poll', 'user', 'voter', 'created'))
+            ballots = [ballot for ballot in ballots
+                       if (ballot[0], ballot[1], ballot[2], ballot[6])
+                       not in flushed]
+        choice_ids = set(choice_id for ballot in ballots
+                         for choice_id in ballot[3])
+        # choices deleted since the ballot was cast are dropped
+        choices = dict((choice.pk, choice) for choice in
+                       Choice.objects.filter(pk__in=choice_ids).only('poll'))
+        votes = [Vote(poll_id=poll_id, user_id=user_id, voter_id=voter_id,
+                      choice=choices[choice_id], data=data,
+                      comment=comment, created=created)
+                 for (poll_id, user_id, voter_id, choice_ids, data, comment,
+                      created) in ballots
+                 for choice_id in choice_ids if choice_id in choices]
+        poll_ids = set(vote.poll_id for vote in votes)
+        shards = dict(Poll.objects.filter(pk__in=poll_ids)
+                      .values_list('pk', 'tally_shards'))
+        with transaction.atomic():
+            Vote.objects.bulk_create(votes, batch_size=batch_size)
+            for poll_id in poll_ids:
+                ChoiceTally.objects.increment(
+                    (vote.choice for vote in votes if vote.poll_id == poll_id),
+                    shards=shards[poll_id])
+            VoteRollup.objects.add(votes)
+        for poll_id in poll_ids:
+            bump_version(poll_id)
+            # a filter built while the ballots were spooled misses them
+            bloom.add_voters(poll_id, set(
+                bloom.voter_key(vote.user_id, vote.voter_id)
+                for vote in votes if vote.poll_id == poll_id))
+        self.connection.execute('DELETE FROM ballot WHERE flush_id = ?',
+                                (flush_id,))
+        return len(rows)
+
+
+_buffers = {}
+
+
+def get_vote_buffer():
+    """
+    return the VoteBuffer configured by POLLS_VOTE_BUFFER, or None if
+    votes are not buffered
+    """
+    path = getattr(settings, 'POLLS_VOTE_BUFFER', None)
+    if not path:
+        return None
+    if path not in _buffers:
+        _buffers[path] = VoteBuffer(path)
+    return _buffers[path]
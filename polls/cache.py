@@ -0,0 +1,273 @@
+"""
+caching of poll results
+
+results are cached by poll together with the poll's version. the version
+is bumped on every vote and on every change of the poll, which makes the
+cached results stale. stale results are handled like so:
+
+    * up to POLLS_RESULTS_MAX_AGE seconds after they were computed, stale
+      results are served as is
+    * up to POLLS_RESULTS_STALE_WHILE_REVALIDATE seconds after that, stale
+      results are served while a single background thread recomputes them
+    * older results are recomputed on the request path
+
+Settings:
+    POLLS_CACHE  -- the cache alias to use, defaults to 'default'
+    POLLS_RESULTS_CACHE_TIMEOUT -- seconds to keep results, defaults to 3600
+    POLLS_RESULTS_MAX_AGE -- defaults to 1
+    POLLS_RESULTS_STALE_WHILE_REVALIDATE -- defaults to 30
+    POLLS_RESULTS_BACKGROUND_REFRESH -- set to False to recompute stale
+      results on the request path, e.g. for testing. defaults to True
+    POLLS_POLL_CACHE_SIZE -- the number of polls whose choices and rules
+      are kept in process, see PollDataCache. defaults to 1000
+    POLLS_POLL_CACHE_TTL -- seconds to keep them in process, defaults to 10
+    POLLS_POLL_CACHE_TIMEOUT -- seconds to keep them in the shared cache,
+      defaults to 3600
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from polls import metrics
+
+
+VERSION_KEY = 'polls:version:%s'
+RESULTS_KEY = 'polls:results:%s'
+REFRESH_KEY = 'polls:refresh:%s'
+GENERATION_KEY = '%s:generation'
+#: the result label of polls.metrics.results_cache_requests by counter
+RESULT_LABELS = {'hits': 'hit', 'stale': 'stale', 'misses': 'miss'}
+
+
+def get_cache():
+    """
+    return the cache used by polls
+    """
+    alias = getattr(settings, 'POLLS_CACHE', 'default')
+    try:
+        from django.core.cache import caches
+    except ImportError:
+        # Django < 1.7
+        from django.core.cache import get_cache as get_cache_by_alias
+        return get_cache_by_alias(alias)
+    return caches[alias]
+
+
+def _initial_version():
+    # counters start at the current time so that an evicted counter never
+    # restarts below a value that is still in use
+    return int(time.time() * 1000)
+
+
+def get_counter(key):
+    """
+    return the value of a counter shared by all processes, e.g. a version
+    or generation. a missing counter is started, see _initial_version
+    """
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, _initial_version(), None)
+        value = cache.get(key)
+    return value
+
+
+def bump_counter(key):
+    """
+    increment a counter shared by all processes and return its value. a
+    missing counter is started, see _initial_version
+    """
+    cache = get_cache()
+    try:
+        return cache.incr(key)
+    except ValueError:
+        value = _initial_version()
+        cache.set(key, value, None)
+        return value
+
+
+def get_version(poll_pk):
+    """
+    return the current version of a poll
+    """
+    return get_counter(VERSION_KEY % poll_pk)
+
+
+def bump_version(poll_pk):
+    """
+    bump the version of a poll, invalidating its cached results
+    """
+    return bump_counter(VERSION_KEY % poll_pk)
+
+
+class PollDataCache(object):
+
+    """
+    a value derived from a poll that rarely changes, cached in process and
+    in the shared cache by the poll's generation. invalidate() bumps the
+    generation, so that all processes load the value again and a value
+    loaded before the invalidation is never served after it. the
+    generation is read from the shared cache on every get.
+
+    the generation is not the poll's version, which every vote bumps.
+
+    Usage:
+        choice_maps = PollDataCache('polls:choices:%s', load_choice_map)
+        choice_maps.get(poll.pk)
+        => load_choice_map(poll.pk), cached
+        choice_maps.invalidate(poll.pk)
+    """
+    def __init__(self, key, load):
+        from polls.util import LRUCache
+        self.key = key
+        self.load = load
+        self.local = LRUCache(
+            maxsize=getattr(settings, 'POLLS_POLL_CACHE_SIZE', 1000),
+            ttl=getattr(settings, 'POLLS_POLL_CACHE_TTL', 10))
+
+    def get(self, arg):
+        cache = get_cache()
+        generation = self.generation(arg)
+        entry = self.local.get(arg)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+        key = '%s:%s' % (self.key % arg, generation)
+        value = cache.get(key)
+        if value is None:
+            value = self.load(arg)
+            cache.set(key, value, getattr(
+                settings, 'POLLS_POLL_CACHE_TIMEOUT', 3600))
+        self.local.set(arg, (generation, value))
+        return value
+
+    def generation(self, arg):
+        """
+        return the current generation of the value for arg
+        """
+        return get_counter(GENERATION_KEY % (self.key % arg))
+
+    def invalidate(self, arg):
+        self.local.delete(arg)
+        bump_counter(GENERATION_KEY % (self.key % arg))
+
+
+class ResultsCache(object):
+
+    """
+    versioned cache of Poll.get_stats()
+
+    Usage:
+        stats = results_cache.get_stats(poll)
+        results_cache.counters()
+        => { 'hits' : 10, 'stale' : 2, 'misses' : 1 }
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict(hits=0, stale=0, misses=0)
+
+    def get_stats(self, poll, segment_by=None):
+        """
+        return the cached statistics of a poll, see Poll.get_stats. the
+        statistics by each segment_by key are cached separately.
+        """
+        cache = get_cache()
+        version = get_version(poll.pk)
+        entry = cache.get(self._key(RESULTS_KEY, poll, segment_by))
+        if entry is not None:
+            cached_version, computed, stats = entry
+            age = time.time() - computed
+            if cached_version == version or age <= self.max_age:
+                self._count('hits')
+                return stats
+            if age <= self.max_age + self.stale_while_revalidate:
+                self._count('stale')
+                self._revalidate(poll, segment_by)
+                return stats
+        self._count('misses')
+        return self._compute(poll, version, segment_by)
+
+    def get_stats_at(self, poll, version):
+        """
+        return the statistics of the given version of a poll, never stale
+        ones. the statistics are computed if no process has cached them
+        yet.
+        """
+        entry = get_cache().get(self._key(RESULTS_KEY, poll))
+        if entry is not None and entry[0] == version:
+            self._count('hits')
+            return entry[2]
+        self._count('misses')
+        return self._compute(poll, version)
+
+    def counters(self):
+        """
+        return a copy of the hit and miss counters
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def reset_counters(self):
+        with self._lock:
+            for key in self._counters:
+                self._counters[key] = 0
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'POLLS_RESULTS_MAX_AGE', 1)
+
+    @property
+    def stale_while_revalidate(self):
+        return getattr(settings, 'POLLS_RESULTS_STALE_WHILE_REVALIDATE', 30)
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'POLLS_RESULTS_CACHE_TIMEOUT', 3600)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+        metrics.results_cache_requests.inc(result=RESULT_LABELS[counter])
+
+    def _key(self, key, poll, segment_by=None):
+        key = key % poll.pk
+        if segment_by is not None:
+            # segment keys are user input, keep the cache key safe
+            digest = hashlib.md5(segment_by.encode('utf-8')).hexdigest()
+            key = '%s:%s' % (key, digest)
+        return key
+
+    def _compute(self, poll, version, segment_by=None):
+        # get the version before computing so that votes cast while we
+        # compute leave the results stale
+        with metrics.results_compute.time():
+            stats = poll.get_stats(segment_by=segment_by)
+        get_cache().set(self._key(RESULTS_KEY, poll, segment_by),
+                        (version, time.time(), stats), self.timeout)
+        return stats
+
+    def _revalidate(self, poll, segment_by=None):
+        # only one process recomputes the results of a poll at a time
+        if not get_cache().add(self._key(REFRESH_KEY, poll, segment_by), True,
+                               self.stale_while_revalidate or 1):
+            return
+        if getattr(settings, 'POLLS_RESULTS_BACKGROUND_REFRESH', True):
+            thread = threading.Thread(target=self._refresh,
+                                      args=(poll, segment_by))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._refresh(poll, segment_by, close_connection=False)
+
+    def _refresh(self, poll, segment_by=None, close_connection=True):
+        try:
+            self._compute(poll, get_version(poll.pk), segment_by)
+        finally:
+            get_cache().delete(self._key(REFRESH_KEY, poll, segment_by))
+            if close_connection:
+                connection.close()
+
+
+results_cache = ResultsCache()
@@ -0,0 +1,88 @@
+"""
+export of votes as CSV or NDJSON
+
+votes are read in chunks by primary key, as tuples rather than model
+instances, so memory stays flat however many votes a poll has.
+
+Usage:
+    for line in export_lines(poll, 'csv'):
+        out.write(line)
+"""
+import csv
+import json
+
+from django.conf import settings
+
+from polls.models import Vote
+
+
+FIELDS = ('id', 'created', 'choice', 'user', 'voter', 'comment', 'data')
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def iter_votes(poll, chunk_size=None):
+    """
+    yield a tuple of FIELDS for each vote of a poll, ordered by id
+    """
+    chunk_size = chunk_size or getattr(settings, 'POLLS_EXPORT_CHUNK_SIZE', 5000)
+    votes = (Vote.objects.filter(poll=poll).order_by('pk')
+             .values_list('pk', 'created', 'choice__code', 'user', 'voter',
+                          'comment', 'data'))
+    last_pk = 0
+    while True:
+        rows = list(votes.filter(pk__gt=last_pk)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        last_pk = rows[-1][0]
+
+
+def _json_text(data):
+    # the JSONField is not decoded by values_list, keep the text as is
+    if data is None or data == '':
+        return 'null'
+    if isinstance(data, basestring):
+        return data
+    return json.dumps(data)
+
+
+class _Line(object):
+    # a file-like object that returns what is written to it
+    def write(self, value):
+        return value
+
+
+def csv_lines(poll, chunk_size=None):
+    writer = csv.writer(_Line())
+    yield writer.writerow(FIELDS)
+    for pk, created, code, user, voter, comment, data in iter_votes(poll, chunk_size):
+        yield writer.writerow([
+            pk, created.isoformat(), code.encode('utf-8'),
+            user if user is not None else '',
+            voter if voter is not None else '',
+            comment.encode('utf-8') if comment else '',
+            _json_text(data).encode('utf-8')])
+
+
+def ndjson_lines(poll, chunk_size=None):
+    for pk, created, code, user, voter, comment, data in iter_votes(poll, chunk_size):
+        line = json.dumps(dict(id=pk, created=created.isoformat(), choice=code,
+                               user=user, voter=voter, comment=comment),
+                          sort_keys=True)
+        yield '%s, "data": %s}\n' % (line[:-1], _json_text(data).encode('utf-8'))
+
+
+def export_lines(poll, format='csv', chunk_size=None):
+    """
+    yield the lines of the export of a poll's votes in the given format,
+    'csv' or 'ndjson'
+    """
+    if format == 'csv':
+        return csv_lines(poll, chunk_size)
+    if format == 'ndjson':
+        return ndjson_lines(poll, chunk_size)
+    raise ValueError('unknown export format %s' % format)
@@ -0,0 +1,119 @@
+"""
+model fields of polls
+
+poll references are strings, by default UUIDs in their hyphenated form,
+and are returned as they were stored. references that are UUIDs are also
+stored compactly in Poll.reference_uuid, a native uuid column on
+PostgreSQL and a 16 byte binary column on other databases, which keeps
+its unique index small. lookups of UUID references use that column, so
+they accept the hyphenated and the compact (32 hex digits) form, upper or
+lower case:
+
+    Poll.objects.get(reference='5e0cdc46d6fe43fd9849b66ec15ecdb6')
+    => <Poll>, poll.reference == '5e0cdc46-d6fe-43fd-9849-b66ec15ecdb6'
+
+references that are not UUIDs, e.g. names, are looked up by the string
+column. see polls.models.PollQuerySet.
+
+note that the compact column is set from the reference on save, not by
+QuerySet.update(reference=...).
+"""
+import uuid
+
+from django.core import exceptions
+from django.db import models
+from django.utils import six
+
+
+#: column types of UUIDs by database vendor
+UUID_TYPES = {
+    'postgresql': 'uuid',
+    'mysql': 'binary(16)',
+    'oracle': 'RAW(16)',
+    'sqlite': 'BLOB',
+}
+
+
+def parse_reference(value):
+    """
+    return the UUID of a hyphenated or compact reference, or None if it
+    is not a UUID
+    """
+    if isinstance(value, uuid.UUID) or value is None:
+        return value
+    try:
+        return uuid.UUID(value)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def normalize_reference(value):
+    """
+    return a reference in its hyphenated form if it is a UUID, as is
+    otherwise
+    """
+    parsed = parse_reference(value)
+    if parsed is None:
+        return value
+    return six.text_type(parsed)
+
+
+class ReferenceUUIDField(models.Field):
+
+    """
+    the UUID of the reference field of the same model, or None if the
+    reference is not a UUID. the value is set from the reference on save.
+
+    values read from the database are the column values, e.g. 16 bytes of
+    binary, convert them by to_python.
+    """
+    description = 'The UUID of a reference'
+    empty_strings_allowed = False
+
+    def __init__(self, reference, *args, **kwargs):
+        self.reference = reference
+        kwargs.setdefault('null', True)
+        kwargs['editable'] = False
+        super(ReferenceUUIDField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(ReferenceUUIDField, self).deconstruct()
+        kwargs['reference'] = self.reference
+        del kwargs['editable']
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        return UUID_TYPES.get(connection.vendor, 'BLOB')
+
+    def pre_save(self, model_instance, add):
+        value = parse_reference(getattr(model_instance, self.reference))
+        setattr(model_instance, self.attname, value)
+        return value
+
+    def to_python(self, value):
+        if isinstance(value, (buffer, bytearray)):
+            # the 16 bytes of a binary column
+            return uuid.UUID(bytes=bytes(value))
+        parsed = parse_reference(value)
+        if parsed is None and value is not None:
+            raise exceptions.ValidationError('%r is not a UUID' % (value,))
+        return parsed
+
+    def get_prep_value(self, value):
+        return self.to_python(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None:
+            return None
+        if connection.vendor == 'postgresql':
+            return six.text_type(value)
+        return connection.Database.Binary(value.bytes)
+
+    def get_prep_lookup(self, lookup_type, value):
+        if lookup_type not in ('exact', 'in', 'isnull'):
+            raise TypeError('Lookup type %r not supported by UUIDs'
+                            % lookup_type)
+        return super(ReferenceUUIDField, self).get_prep_lookup(
+            lookup_type, value)
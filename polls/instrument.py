@@ -0,0 +1,287 @@
+"""
+opt-in SQL query and timing instrumentation of requests
+
+QueryInstrumentationMiddleware records, for every request, the number
+of SQL queries, the total database time, the slowest statements and the
+time spent in the phases of the resources decorated with
+instrument_resource: authentication, obj_create, dehydrate and
+serialization. each record is logged as JSON to the 'polls.instrument'
+logger and aggregated per resource name.
+
+    # settings.py
+    POLLS_INSTRUMENTATION = True
+    MIDDLEWARE_CLASSES = (
+        'polls.instrument.QueryInstrumentationMiddleware',
+        ...
+    )
+
+    aggregates()
+    => { 'poll' : { 'requests' : 10, 'queries' : 30, ... }, ... }
+
+statements are normalized into fingerprints, e.g.
+
+    SELECT ... WHERE "polls_vote"."poll_id" = ? AND "user_id" IN (...)
+
+so that the same statement with different parameters is aggregated.
+note that the body of a streaming response is not timed.
+
+Settings:
+    POLLS_INSTRUMENTATION -- set to True to enable, defaults to False
+    POLLS_INSTRUMENTATION_SLOWEST -- the number of slowest statements
+      recorded per request, defaults to 5
+"""
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+import copy
+import hashlib
+import json
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+
+logger = logging.getLogger('polls.instrument')
+
+_local = threading.local()
+_aggregates = {}
+_aggregates_lock = threading.Lock()
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w"])-?\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN \((?:\?|%s)(?:, (?:\?|%s))*\)', re.I)
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    return sql with literals replaced by ? and IN lists collapsed, so that
+    the same statement with different parameters has the same fingerprint
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class RequestRecord(object):
+
+    """
+    the queries and phase timings of a request
+
+    Usage:
+        record = RequestRecord()
+        record.start()
+        ...
+        record.stop()
+        record.as_dict()
+    """
+    def __init__(self, resource=None):
+        self.resource = resource
+        self.phases = {}
+        self.active = set()
+        self.queries = []
+        self._debug_cursor = None
+        self._first_query = 0
+
+    def start(self):
+        self._started = default_timer()
+        # record queries without settings.DEBUG
+        self._debug_cursor = _get_debug_cursor()
+        _set_debug_cursor(True)
+        self._first_query = len(connection.queries)
+        _local.record = self
+
+    def stop(self):
+        self.duration = default_timer() - self._started
+        self.queries = connection.queries[self._first_query:]
+        _set_debug_cursor(self._debug_cursor)
+        _local.record = None
+
+    def add_phase(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    def as_dict(self, slowest=None):
+        """
+        return the record as a dict of
+        {
+          resource : resource name,
+          duration : ms,
+          queries : number of queries,
+          db_time : ms,
+          phases : { phase : ms },
+          slowest : [{ fingerprint, id, time : ms }, ...],
+        }
+        """
+        if slowest is None:
+            slowest = getattr(settings, 'POLLS_INSTRUMENTATION_SLOWEST', 5)
+        timed = [(float(query['time'] or 0), query['sql'])
+                 for query in self.queries]
+        timed.sort(reverse=True)
+        statements = []
+        for seconds, sql in timed[:slowest]:
+            sql = fingerprint(sql)
+            statements.append(dict(
+                fingerprint=sql, time=1000 * seconds,
+                id=hashlib.md5(sql.encode('utf-8')).hexdigest()[:12]))
+        return dict(resource=self.resource, duration=1000 * self.duration,
+                    queries=len(timed),
+                    db_time=1000 * sum(seconds for seconds, sql in timed),
+                    phases=dict((name, 1000 * seconds) for name, seconds
+                                in self.phases.iteritems()),
+                    slowest=statements)
+
+
+def _get_debug_cursor():
+    # Django < 1.8 uses use_debug_cursor
+    if hasattr(connection, 'force_debug_cursor'):
+        return connection.force_debug_cursor
+    return connection.use_debug_cursor
+
+
+def _set_debug_cursor(value):
+    if hasattr(connection, 'force_debug_cursor'):
+        connection.force_debug_cursor = value
+    else:
+        connection.use_debug_cursor = value
+
+
+@contextmanager
+def phase(name):
+    """
+    time a phase of the current request, if it is instrumented
+    """
+    record = getattr(_local, 'record', None)
+    if record is None or name in record.active:
+        # not instrumented, or timed by an outer call already
+        yield
+        return
+    record.active.add(name)
+    started = default_timer()
+    try:
+        yield
+    finally:
+        record.active.discard(name)
+        record.add_phase(name, default_timer() - started)
+
+
+def aggregate(record):
+    """
+    add a record, as returned by RequestRecord.as_dict, to the aggregates
+    of its resource
+    """
+    with _aggregates_lock:
+        stats = _aggregates.setdefault(record['resource'], dict(
+            requests=0, duration=0.0, queries=0, max_queries=0,
+            db_time=0.0, phases={}, statements={}))
+        stats['requests'] += 1
+        stats['duration'] += record['duration']
+        stats['queries'] += record['queries']
+        stats['max_queries'] = max(stats['max_queries'], record['queries'])
+        stats['db_time'] += record['db_time']
+        for name, duration in record['phases'].iteritems():
+            stats['phases'][name] = stats['phases'].get(name, 0) + duration
+        for statement in record['slowest']:
+            count, total, sql = stats['statements'].get(
+                statement['id'], (0, 0.0, statement['fingerprint']))
+            stats['statements'][statement['id']] = (
+                count + 1, total + statement['time'], sql)
+
+
+def aggregates():
+    """
+    return the totals per resource name as a dict of
+    {
+      <resource> : {
+        requests : number of requests,
+        duration, db_time : total ms,
+        queries : total queries, max_queries : most queries of a request,
+        phases : { phase : total ms },
+        statements : { id : (times among the slowest, total ms, fingerprint) },
+      }
+    }
+    """
+    with _aggregates_lock:
+        return copy.deepcopy(_aggregates)
+
+
+def reset_aggregates():
+    with _aggregates_lock:
+        _aggregates.clear()
+
+
+def resource_name(request):
+    """
+    return the name of the api resource of a request, or of its url
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    return match.kwargs.get('resource_name') or match.url_name
+
+
+class QueryInstrumentationMiddleware(object):
+
+    """
+    record and log the queries and timings of every request, see
+    polls.instrument
+    """
+    def __init__(self):
+        if not getattr(settings, 'POLLS_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        request._polls_record = RequestRecord()
+        request._polls_record.start()
+
+    def process_response(self, request, response):
+        record = getattr(request, '_polls_record', None)
+        if record is None:
+            return response
+        record.stop()
+        record.resource = resource_name(request)
+        data = record.as_dict()
+        data.update(method=request.method, path=request.path,
+                    status=response.status_code)
+        aggregate(data)
+        logger.info(json.dumps(data, sort_keys=True),
+                    extra=dict(polls_request=data))
+        return response
+
+
+#: the methods of a tastypie resource timed by instrument_resource
+RESOURCE_PHASES = (
+    ('is_authenticated', 'authentication'),
+    ('obj_create', 'obj_create'),
+    ('full_dehydrate', 'dehydrate'),
+    ('serialize', 'serialization'),
+    ('deserialize', 'serialization'),
+)
+
+
+def _timed(method, name):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with phase(name):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def instrument_resource(cls):
+    """
+    class decorator to time the phases of a tastypie resource, see
+    RESOURCE_PHASES. the most derived methods are timed, including the
+    resource's own overrides.
+
+    Usage:
+        @instrument_resource
+        class PollResource(ModelResource):
+            ...
+    """
+    for method, name in RESOURCE_PHASES:
+        setattr(cls, method, _timed(getattr(cls, method).__func__, name))
+    return cls
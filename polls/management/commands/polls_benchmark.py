@@ -0,0 +1,69 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from polls.benchmark import (OPERATIONS, compare_results, load_results,
+                             run_benchmarks, save_results)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+class Command(NoArgsCommand):
+    help = ("Benchmark the polls core on synthetic polls, see polls.benchmark. "
+            "Writes to the database, use a local SQLite database.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--choices', dest='choices', default='10,100',
+                    help='Comma separated numbers of choices per poll'),
+        make_option('--votes', dest='votes', default='1000,10000',
+                    help='Comma separated numbers of votes per poll'),
+        make_option('--ballot-size', dest='ballot_sizes', default='1',
+                    help='Comma separated numbers of choices per ballot'),
+        make_option('--repeat', type='int', dest='repeat', default=100,
+                    help='Number of timed calls per operation'),
+        make_option('--warmup', type='int', dest='warmup', default=5,
+                    help='Number of untimed calls per operation'),
+        make_option('--operations', dest='operations',
+                    default=','.join(OPERATIONS),
+                    help='Comma separated operations to time'),
+        make_option('--output', dest='output', default=None,
+                    help='Save the results as JSON to this file'),
+        make_option('--compare', dest='compare', default=None,
+                    help='Report regressions against a saved JSON file'),
+        make_option('--threshold', type='float', dest='threshold', default=0.1,
+                    help='Slowdown reported as a regression, defaults to 0.1'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help='Keep the generated polls'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            choices = int_list(options['choices'])
+            votes = int_list(options['votes'])
+            ballot_sizes = int_list(options['ballot_sizes'])
+        except ValueError:
+            raise CommandError('Numbers must be comma separated integers')
+        operations = [operation for operation
+                      in options['operations'].split(',') if operation]
+        unknown = set(operations).difference(OPERATIONS)
+        if unknown:
+            raise CommandError('Unknown operations %s, choose from %s' % (
+                ', '.join(sorted(unknown)), ', '.join(OPERATIONS)))
+        baseline = options['compare'] and load_results(options['compare'])
+        results = run_benchmarks(
+            choices, votes, ballot_sizes, repeat=options['repeat'],
+            warmup=options['warmup'], operations=operations,
+            keep=options['keep'], log=self.stdout.write)
+        if options['output']:
+            save_results(results, options['output'])
+        if baseline:
+            regressions = compare_results(baseline, results,
+                                          options['threshold'])
+            for scenario, operation, before, after in regressions:
+                self.stdout.write(
+                    'regression %s choices %s votes %s per ballot %s: '
+                    '%.1f ops/s, was %.1f' % (scenario + (operation, after,
+                                                          before)))
+            if not regressions:
+                self.stdout.write('no regressions')
@@ -0,0 +1,42 @@
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.export import export_lines
+from polls.models import Poll
+
+
+class Command(BaseCommand):
+    args = '<poll id or reference>'
+    help = "Export the votes of a poll as CSV or NDJSON"
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+                    choices=['csv', 'ndjson'], help='csv or ndjson'),
+        make_option('--output', dest='output', default=None,
+                    help='Output file, defaults to stdout'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=None, help='Number of votes read per query'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Specify the poll id or reference')
+        try:
+            if args[0].isdigit():
+                poll = Poll.objects.get(pk=args[0])
+            else:
+                poll = Poll.objects.get(reference=args[0])
+        except Poll.DoesNotExist:
+            raise CommandError('Poll %s does not exist' % args[0])
+        if options['output']:
+            out = open(options['output'], 'wb')
+        else:
+            out = options.get('stdout') or sys.stdout
+        try:
+            for line in export_lines(poll, options['format'],
+                                     options['chunk_size']):
+                out.write(line)
+        finally:
+            if options['output']:
+                out.close()
@@ -0,0 +1,47 @@
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+
+from polls.buffer import get_vote_buffer
+
+
+class Command(NoArgsCommand):
+    help = "Flush buffered votes into the database, see polls.buffer"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=None, help='Number of ballots per transaction'),
+        make_option('--interval', type='float', dest='interval',
+                    default=None, help='Seconds to wait when the buffer is empty'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Flush the buffer once and exit'),
+        make_option('--depth', action='store_true', dest='depth', default=False,
+                    help='Report the number of buffered ballots and exit'),
+    )
+
+    def handle_noargs(self, **options):
+        buffer = get_vote_buffer()
+        if buffer is None:
+            raise CommandError('POLLS_VOTE_BUFFER is not set')
+        if options['depth']:
+            self.stdout.write('%d' % buffer.depth())
+            return
+        batch_size = options['batch_size'] or getattr(
+            settings, 'POLLS_VOTE_BUFFER_BATCH_SIZE', 1000)
+        interval = options['interval']
+        if interval is None:
+            interval = getattr(settings, 'POLLS_VOTE_BUFFER_FLUSH_INTERVAL', 1.0)
+        while True:
+            flushed = 0
+            while True:
+                count = buffer.flush(batch_size=batch_size)
+                flushed += count
+                if count < batch_size:
+                    break
+            if flushed or int(options['verbosity']) > 1:
+                self.stdout.write('flushed %d ballots, %d pending' %
+                                  (flushed, buffer.depth()))
+            if options['once']:
+                break
+            time.sleep(interval)
@@ -0,0 +1,57 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from polls import bloom
+from polls.models import Poll, Vote, Voter
+
+
+class Command(NoArgsCommand):
+    help = ("Move the votes of users created by IPAuthentication to Voters, "
+            "see POLLS_ANONYMOUS_VOTERS")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--delete', action='store_true', dest='delete',
+                    default=False, help='Delete the users once migrated'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000, help='Number of users per transaction'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Only report the number of users'),
+    )
+
+    def get_ip_users(self):
+        """
+        users created by polls.util.get_user have an unusable password and
+        the default from email, and are no staff
+        """
+        return get_user_model().objects.filter(
+            password__startswith='!', email=settings.DEFAULT_FROM_EMAIL,
+            is_staff=False, is_superuser=False).order_by('pk')
+
+    def handle_noargs(self, **options):
+        users = self.get_ip_users()
+        if options['dry_run']:
+            self.stdout.write('%d users to migrate' % users.count())
+            return
+        migrated = 0
+        last_pk = 0
+        while True:
+            batch = list(users.filter(pk__gt=last_pk)
+                         .values_list('pk', 'username')[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            with transaction.atomic():
+                for pk, username in batch:
+                    voter, created = Voter.objects.get_or_create(
+                        key=Voter.hash_key(username))
+                    Vote.objects.filter(user=pk).update(user=None, voter=voter)
+                if options['delete']:
+                    users.filter(pk__in=[pk for pk, username in batch]).delete()
+            migrated += len(batch)
+        # the already-voted filters know the users, not the voters
+        for poll_pk in Poll.objects.values_list('pk', flat=True).iterator():
+            bloom.drop_filter(poll_pk)
+        self.stdout.write('migrated %d users' % migrated)
@@ -0,0 +1,282 @@
+"""
+in-process metrics in the Prometheus text format
+
+counters and histograms are kept in memory by every process. if
+POLLS_METRICS_DIR is set, every process also writes its values to a file
+of its own in that directory, at most every POLLS_METRICS_FLUSH_INTERVAL
+seconds. the metrics view sums the files of all processes, so that
+multiple worker processes on the same host are reported as one.
+
+    # settings.py
+    POLLS_METRICS_DIR = '/var/run/polls-metrics'
+
+    # served by polls.views.MetricsView at /metrics in polls.urls
+
+    ballots.inc(poll=poll.pk)
+    with results_latency.time(source='cache'):
+        ...
+    registry.expose()
+    => '# HELP polls_ballots_total ...'
+
+the directory should be emptied when the application is restarted,
+values of processes that exited are kept so counters do not drop.
+
+Settings:
+    POLLS_METRICS_DIR -- a directory shared by the processes of a host,
+      defaults to None, i.e. every process reports its own values
+    POLLS_METRICS_FLUSH_INTERVAL -- seconds, defaults to 1.0
+"""
+from contextlib import contextmanager
+from timeit import default_timer
+import atexit
+import glob
+import json
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+
+FILE_PATTERN = 'polls-metrics-%s.json'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+class Metric(object):
+
+    """
+    a metric with labels, values are kept by the registry
+    """
+    type = None
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def _labels(self, labels):
+        return tuple((name, unicode(labels[name])) for name in self.labelnames)
+
+
+class Counter(Metric):
+
+    """
+    a monotonic count
+
+    Usage:
+        votes = Counter(registry, 'polls_votes_total', 'Votes', ['poll'])
+        votes.inc(poll=1)
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry.update(self, self._labels(labels),
+                             lambda value: (value or 0) + amount)
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+
+    """
+    a distribution of observed values in buckets
+
+    Usage:
+        latency = Histogram(registry, 'polls_latency_seconds', 'Latency')
+        latency.observe(0.1)
+        with latency.time():
+            ...
+    """
+    type = 'histogram'
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS) + (float('inf'),)
+        super(Histogram, self).__init__(registry, name, help, labelnames)
+
+    def observe(self, amount, **labels):
+        def update(value):
+            # [count per bucket, ..., sum]
+            value = value or [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    value[index] += 1
+                    break
+            value[-1] += amount
+            return value
+        self.registry.update(self, self._labels(labels), update)
+
+    @contextmanager
+    def time(self, **labels):
+        started = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(default_timer() - started, **labels)
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, value):
+                cumulative += count
+                yield ('%s_bucket' % self.name,
+                       labels + (('le', _format_value(float(bound))),),
+                       cumulative)
+            yield '%s_sum' % self.name, labels, value[-1]
+            yield '%s_count' % self.name, labels, cumulative
+
+
+class Registry(object):
+
+    """
+    the metrics of a process, see polls.metrics
+    """
+    def __init__(self):
+        self.metrics = {}
+        self._values = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._flushed = 0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        self._values[metric.name] = {}
+
+    def update(self, metric, labels, update):
+        with self._lock:
+            if self._pid != os.getpid():
+                # values copied from the parent process belong to it
+                self._pid = os.getpid()
+                for values in self._values.itervalues():
+                    values.clear()
+            values = self._values[metric.name]
+            values[labels] = update(values.get(labels))
+        self._maybe_flush()
+
+    def values(self):
+        """
+        return the values of this process as a dict of
+        { name : { labels : value } }
+        """
+        with self._lock:
+            return dict((name, dict((labels, list(value)
+                                     if isinstance(value, list) else value)
+                                    for labels, value in values.iteritems()))
+                        for name, values in self._values.iteritems())
+
+    def collect(self):
+        """
+        return the values of all processes, see values()
+        """
+        directory = self.directory
+        if not directory:
+            return self.values()
+        self.flush()
+        collected = dict((name, {}) for name in self.metrics)
+        for path in glob.glob(os.path.join(directory, FILE_PATTERN % '*')):
+            try:
+                with open(path) as f:
+                    dumped = json.load(f)
+            except (IOError, ValueError):
+                # removed or being replaced
+                continue
+            for name, values in dumped.iteritems():
+                if name not in collected:
+                    continue
+                for labels, value in values:
+                    labels = tuple(tuple(label) for label in labels)
+                    collected[name][labels] = _add(
+                        collected[name].get(labels), value)
+        return collected
+
+    def expose(self):
+        """
+        return the metrics of all processes in the Prometheus text format
+        """
+        collected = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.iteritems()):
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for sample, labels, value in metric.samples(collected[name]):
+                lines.append('%s%s %s' % (sample, _format_labels(labels),
+                                          _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    @property
+    def directory(self):
+        return getattr(settings, 'POLLS_METRICS_DIR', None)
+
+    def flush(self):
+        """
+        write the values of this process to its file
+        """
+        directory = self.directory
+        if not directory:
+            return
+        self._flushed = default_timer()
+        dumped = dict((name, values.items())
+                      for name, values in self.values().iteritems())
+        # write and rename so readers never see a partial file
+        fd, path = tempfile.mkstemp(dir=directory, prefix='.polls-metrics')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dumped, f)
+        os.rename(path, os.path.join(directory, FILE_PATTERN % os.getpid()))
+
+    def reset(self):
+        with self._lock:
+            for values in self._values.itervalues():
+                values.clear()
+
+    def _maybe_flush(self):
+        interval = getattr(settings, 'POLLS_METRICS_FLUSH_INTERVAL', 1.0)
+        if self.directory and default_timer() - self._flushed >= interval:
+            self.flush()
+
+
+def _add(value, other):
+    if value is None:
+        return other
+    if isinstance(value, list):
+        return [a + b for a, b in zip(value, other)]
+    return value + other
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+ballots = Counter(
+    registry, 'polls_ballots_total', 'Ballots accepted, by poll', ['poll'])
+rejections = Counter(
+    registry, 'polls_rejections_total',
+    'Ballots rejected, by poll and reason', ['poll', 'reason'])
+results_cache_requests = Counter(
+    registry, 'polls_results_cache_total',
+    'Results cache lookups, by result: hit, stale or miss', ['result'])
+results_compute = Histogram(
+    registry, 'polls_results_compute_seconds',
+    'Time to compute the statistics of a poll')
+results_latency = Histogram(
+    registry, 'polls_results_latency_seconds',
+    'Time to get the statistics of a result request, by source', ['source'])
+
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def count_votes(apps, schema_editor):
+    ChoiceTally = apps.get_model('polls', 'ChoiceTally')
+    Vote = apps.get_model('polls', 'Vote')
+    counts = (Vote.objects.order_by().values('poll', 'choice')
+              .annotate(votes=Count('id')))
+    ChoiceTally.objects.bulk_create(
+        ChoiceTally(poll_id=row['poll'], choice_id=row['choice'],
+                    votes=row['votes'])
+        for row in counts.iterator())
+
+
+def delete_tallies(apps, schema_editor):
+    apps.get_model('polls', 'ChoiceTally').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0003_auto_20160424_1140'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChoiceTally',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('votes', models.IntegerField(default=0)),
+                ('choice', models.OneToOneField(related_name='tally', to='polls.Choice')),
+                ('poll', models.ForeignKey(to='polls.Poll')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunPython(count_votes, delete_tallies),
+    ]
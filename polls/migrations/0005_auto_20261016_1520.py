@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0004_choicetally'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vote',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+            preserve_default=True,
+        ),
+    ]
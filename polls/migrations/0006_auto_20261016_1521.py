@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0005_auto_20261016_1520'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='choicetally',
+            name='slot',
+            field=models.PositiveSmallIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='poll',
+            name='tally_shards',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Number of vote counters per choice, increase for polls with many concurrent votes'),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='choicetally',
+            name='choice',
+            field=models.ForeignKey(related_name='tallies', to='polls.Choice'),
+            preserve_default=True,
+        ),
+        migrations.AlterUniqueTogether(
+            name='choicetally',
+            unique_together=set([('choice', 'slot')]),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+import calendar
+
+from django.db import models, migrations
+from django.utils import timezone
+
+
+# copies of polls.models.ROLLUP_BUCKETS and bucket_start as of this
+# migration, later changes must not change the rollups it creates
+ROLLUP_BUCKETS = {'1m': 60, '1h': 3600}
+
+
+def bucket_start(when, seconds):
+    if timezone.is_aware(when):
+        when = timezone.make_naive(when, timezone.utc)
+        aware = True
+    else:
+        aware = False
+    epoch = calendar.timegm(when.timetuple())
+    start = datetime.utcfromtimestamp(epoch - epoch % seconds)
+    return timezone.make_aware(start, timezone.utc) if aware else start
+
+
+def rollup_votes(apps, schema_editor):
+    VoteRollup = apps.get_model('polls', 'VoteRollup')
+    Vote = apps.get_model('polls', 'Vote')
+    counts = {}
+    votes = Vote.objects.order_by().values_list('poll', 'choice', 'created')
+    for poll_id, choice_id, created in votes.iterator():
+        for seconds in ROLLUP_BUCKETS.values():
+            key = (poll_id, choice_id, seconds, bucket_start(created, seconds))
+            counts[key] = counts.get(key, 0) + 1
+    VoteRollup.objects.bulk_create(
+        (VoteRollup(poll_id=poll_id, choice_id=choice_id, bucket=seconds,
+                    start=start, votes=count)
+         for (poll_id, choice_id, seconds, start), count in counts.iteritems()),
+        batch_size=1000)
+
+
+def delete_rollups(apps, schema_editor):
+    apps.get_model('polls', 'VoteRollup').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0007_auto_20261016_1525'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('bucket', models.PositiveIntegerField()),
+                ('start', models.DateTimeField()),
+                ('votes', models.IntegerField(default=0)),
+                ('choice', models.ForeignKey(related_name='rollups', to='polls.Choice')),
+                ('poll', models.ForeignKey(to='polls.Poll')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='voterollup',
+            unique_together=set([('choice', 'bucket', 'start')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='voterollup',
+            index_together=set([('poll', 'bucket', 'start')]),
+        ),
+        migrations.RunPython(rollup_votes, delete_rollups),
+    ]
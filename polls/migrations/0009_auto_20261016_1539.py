@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0008_auto_20261016_1532'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='poll',
+            name='start_votes',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='The earliest time votes get accepted', db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='vote',
+            index_together=set([('poll', 'created'), ('poll', 'voter'), ('choice', 'created'), ('poll', 'user')]),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import polls.fields
+
+
+def fill_reference_uuids(apps, schema_editor):
+    # store the references that are UUIDs compactly, see polls.fields.
+    # the references themselves are kept as they are
+    Poll = apps.get_model('polls', 'Poll')
+    field = Poll._meta.get_field('reference_uuid')
+    connection = schema_editor.connection
+    rows = []
+    references = {}
+    for pk, reference in Poll.objects.values_list('pk', 'reference').iterator():
+        parsed = polls.fields.parse_reference(reference)
+        if parsed is not None:
+            rows.append((field.get_db_prep_value(parsed, connection), pk))
+            references.setdefault(parsed, []).append(reference)
+    duplicates = sorted(value for values in references.values()
+                        if len(values) > 1 for value in values)
+    if duplicates:
+        raise ValueError(
+            'the poll references %s are the same UUID, change them first'
+            % ', '.join(duplicates[:10]))
+    if not rows:
+        return
+    quote = schema_editor.quote_name
+    connection.cursor().executemany(
+        'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+            quote(Poll._meta.db_table), quote(field.column),
+            quote(Poll._meta.pk.column)), rows)
+
+
+def keep_reference_uuids(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0009_auto_20261016_1539'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='poll',
+            name='reference_uuid',
+            field=polls.fields.ReferenceUUIDField(reference='reference', null=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_reference_uuids, keep_reference_uuids),
+        migrations.AlterField(
+            model_name='poll',
+            name='reference_uuid',
+            field=polls.fields.ReferenceUUIDField(reference='reference', unique=True, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,25 +1,61 @@
-from datetime import timedelta
+from collections import namedtuple
+from datetime import datetime, timedelta
 from exceptions import PollClosed, PollNotOpen, PollNotAnonymous, PollNotMultiple
 from uuid import uuid4
+import calendar
+import json
+import random
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, F, Min, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.crypto import salted_hmac
 from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 from django_extensions.db.fields.json import JSONField
 
+from polls import bloom, metrics
+from polls.buffer import get_vote_buffer
+from polls.cache import PollDataCache, bump_version
 from polls.exceptions import PollChoiceRequired, PollInvalidChoice
+from polls.fields import (ReferenceUUIDField, normalize_reference,
+                          parse_reference)
+from polls.util import reset_client_cache
+
+
+CHOICES_KEY = 'polls:choices:%s'
+RULES_KEY = 'polls:rules:%s'
+REFERENCE_KEY = 'polls:reference:%s'
 
 
 def vote_endtime():
     return timezone.now() + timedelta(days=5)
 
 
+class PollQuerySet(models.QuerySet):
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        # references that are UUIDs are looked up by their compact column,
+        # in any of their forms, see polls.fields
+        for lookup in ('reference', 'reference__exact'):
+            if lookup in kwargs:
+                parsed = parse_reference(kwargs[lookup])
+                if parsed is not None:
+                    del kwargs[lookup]
+                    kwargs['reference_uuid'] = parsed
+        return super(PollQuerySet, self)._filter_or_exclude(
+            negate, *args, **kwargs)
+
+
 class Poll(models.Model):
     question = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     reference = models.CharField(max_length=36, default=uuid4, unique=True)
+    #: the reference if it is a UUID, see polls.fields
+    reference_uuid = ReferenceUUIDField('reference', unique=True)
     is_anonymous = models.BooleanField(
         default=False, help_text=_('Allow to vote for anonymous user'))
     is_multiple = models.BooleanField(
@@ -29,53 +65,239 @@ class Poll(models.Model):
     allow_multi_votes = models.BooleanField(
         default=False, help_text=_('Allow multiple votes by same user'))
     start_votes = models.DateTimeField(
-        default=timezone.now, help_text=_('The earliest time votes get accepted'))
+        default=timezone.now, db_index=True,
+        help_text=_('The earliest time votes get accepted'))
     end_votes = models.DateTimeField(default=vote_endtime,
                                      help_text=_('The latest time votes get accepted'))
+    tally_shards = models.PositiveSmallIntegerField(
+        default=1, help_text=_('Number of vote counters per choice, increase '
+                               'for polls with many concurrent votes'))
+
+    objects = PollQuerySet.as_manager()
+
+    def vote(self, choices, user=None, data=None, comment=None,
+             voter=None, buffered=None):
+        """
+        vote for the given choice ids or codes and return the votes. the
+        votes after the first are inserted at once and have no pk
+
+        anonymous votes can be tracked by a Voter instead of a user, see
+        polls.util.IPAuthentication
 
-    def vote(self, choices, user=None, data=None, comment=None):
+        if POLLS_VOTE_BUFFER is set and buffered is not False, the ballot
+        is validated and appended to the vote buffer. the votes returned
+        are not saved in this case, see polls.buffer
+        """
         current_time = timezone.now()
-        if self.is_closed:
-            raise PollClosed
-        if current_time < self.start_votes or current_time > self.end_votes:
-            raise PollNotOpen
-        if user is None and not self.is_anonymous:
-            raise PollNotAnonymous
-        if not choices:
-            raise PollInvalidChoice
-        if len(choices) > 1 and not self.is_multiple:
-            raise PollNotMultiple
-        if len(choices) == 0:
-            raise PollChoiceRequired
+        try:
+            self.check_ballot(choices, user=user, current_time=current_time)
+            resolved = self.resolve_choices(choices)
+        except (PollClosed, PollNotOpen, PollNotAnonymous, PollNotMultiple,
+                PollChoiceRequired, PollInvalidChoice) as e:
+            metrics.rejections.inc(poll=self.pk, reason=e.__class__.__name__)
+            raise
         # if self.is_anonymous: user = None # pass None, even though user is
         # authenticated
+        # we always track the technical user at least by ip or clientid 
+        # to make sure we don't get multiple votes
+        #if self.is_anonymous:
+        #    user = None
+        votes = [Vote(poll=self, user=user, voter=voter, choice=choice,
+                      data=data, comment=comment, created=current_time)
+                 for choice in resolved]
+        voter_key = bloom.voter_key(user and user.pk, voter and voter.pk)
+        buffer = get_vote_buffer() if buffered is not False else None
+        if buffer is not None:
+            buffer.append(self.pk, user and user.pk,
+                          [vote.choice_id for vote in votes], data=data,
+                          comment=comment, created=current_time,
+                          voter_id=voter and voter.pk)
+            bloom.add_voters(self.pk, [voter_key])
+            metrics.ballots.inc(poll=self.pk)
+            return votes
+        with transaction.atomic():
+            # the first vote gets its pk, e.g. for the API response, the
+            # others are inserted at once
+            votes[0].save()
+            if len(votes) > 1:
+                Vote.objects.bulk_create(votes[1:])
+            ChoiceTally.objects.increment((vote.choice for vote in votes),
+                                          shards=self.tally_shards)
+            VoteRollup.objects.add(votes)
+        bump_version(self.pk)
+        bloom.add_voters(self.pk, [voter_key])
+        metrics.ballots.inc(poll=self.pk)
+        return votes
+
+    def vote_batch(self, ballots):
+        """
+        vote with many ballots of anonymous voters at once, e.g. as
+        collected by offline clients
+
+        ballots is a list of dicts of
+        {
+          voter : client key,
+          choice : [choice id or code, ...],
+          data : data,
+          comment : comment,
+          created : datetime the ballot was cast, defaults to now
+        }
+
+        returns a (status, reason) tuple for each ballot. status is one of
+        'accepted', 'duplicate' or 'rejected', reason is the name of the
+        exception a rejected ballot raised.
+        """
+        now = timezone.now()
+        results = [None] * len(ballots)
+        choice_map = self.get_choice_map(
+            choice_id for ballot in ballots
+            for choice_id in self._ballot_choices(ballot))
+        valid = []
+        for index, ballot in enumerate(ballots):
+            created = min(ballot.get('created') or now, now)
+            choices = self._ballot_choices(ballot)
+            try:
+                if not ballot.get('voter'):
+                    raise PollNotAnonymous
+                self.check_ballot(choices, current_time=created)
+                choices = self.resolve_choices(choices, choice_map)
+            except (PollClosed, PollNotOpen, PollNotAnonymous, PollNotMultiple,
+                    PollChoiceRequired, PollInvalidChoice) as e:
+                results[index] = ('rejected', e.__class__.__name__)
+                continue
+            valid.append((index, Voter.hash_key(ballot['voter']), choices,
+                          created))
+        voters = Voter.objects.get_or_create_keys(key for index, key, choices,
+                                                  created in valid)
+        if self.allow_multi_votes:
+            voted = set()
+        else:
+            voted = set(self.vote_set.filter(voter__in=voters.values())
+                        .values_list('voter', flat=True))
         votes = []
-        for choice_id in choices:
-            if isinstance(choice_id, int) or choice_id.isdigit():
-                query = dict(pk=choice_id)
+        for index, key, choices, created in valid:
+            voter_id = voters[key]
+            if voter_id in voted:
+                results[index] = ('duplicate', None)
+                continue
+            if not self.allow_multi_votes:
+                voted.add(voter_id)
+            ballot = ballots[index]
+            votes.extend(Vote(poll=self, voter_id=voter_id, choice=choice,
+                              data=ballot.get('data'),
+                              comment=ballot.get('comment'), created=created)
+                         for choice in choices)
+            results[index] = ('accepted', None)
+        with transaction.atomic():
+            Vote.objects.bulk_create(votes)
+            ChoiceTally.objects.increment((vote.choice for vote in votes),
+                                          shards=self.tally_shards)
+            VoteRollup.objects.add(votes)
+        bump_version(self.pk)
+        bloom.add_voters(self.pk, set(bloom.voter_key(voter_id=vote.voter_id)
+                                      for vote in votes))
+        for status, reason in results:
+            if status == 'accepted':
+                metrics.ballots.inc(poll=self.pk)
             else:
-                query = dict(poll=self, code=choice_id)
-            try:
-                choice = Choice.objects.get(**query)
-            except:
+                metrics.rejections.inc(poll=self.pk,
+                                       reason=reason or 'already_voted')
+        return results
+
+    def _ballot_choices(self, ballot):
+        choices = ballot.get('choice') or []
+        # convert single-choice into list
+        if isinstance(choices, (basestring, int, long)):
+            choices = [choices]
+        return choices
+
+    def check_ballot(self, choices, user=None, current_time=None):
+        """
+        raise if a ballot of the given choices cast by user at
+        current_time is not allowed, see PollRules.check_ballot
+        """
+        self.rules.check_ballot(choices, user=user, current_time=current_time)
+
+    @property
+    def rules(self):
+        """
+        the voting rules of this instance as a PollRules
+        """
+        return PollRules(*(getattr(self, name) for name in PollRules._fields))
+
+    def get_choice_map(self, choices):
+        """
+        return the choices of this poll with the given ids or codes as
+        a tuple of dicts ({ pk : choice }, { code : choice })
+
+        the choices are looked up in the poll's cached code map, see
+        load_choice_map, so that no query is needed. ids or codes that
+        are not in the map are queried in case the map is stale.
+        """
+        pks, codes = choice_maps.get(self.pk)
+        by_pk = {}
+        by_code = {}
+        missing = []
+        for choice_id in choices:
+            pk = _lookup_choice(choice_id, pks, codes)
+            if pk is None:
+                missing.append(choice_id)
+            elif pk not in by_pk:
+                code, label = pks[pk]
+                by_pk[pk] = by_code[code] = Choice(id=pk, poll=self,
+                                                   code=code, choice=label)
+        if missing:
+            found = self._query_choice_map(missing)
+            if found:
+                # choices were added since the map was cached
+                choice_maps.invalidate(self.pk)
+                by_pk.update(found)
+                by_code.update((choice.code, choice)
+                               for choice in found.itervalues())
+        return by_pk, by_code
+
+    def _query_choice_map(self, choices):
+        # return { pk : choice } of the given ids or codes, using a query
+        pks = set()
+        codes = set()
+        for choice_id in choices:
+            if isinstance(choice_id, (int, long)):
+                pks.add(choice_id)
+            elif isinstance(choice_id, basestring):
+                if choice_id.isdigit():
+                    pks.add(int(choice_id))
+                codes.add(choice_id)
+        if not pks and not codes:
+            return {}
+        return dict((choice.pk, choice) for choice in self.choice_set.filter(
+            models.Q(pk__in=pks) | models.Q(code__in=codes)))
+
+    def resolve_choices(self, choices, choice_map=None):
+        """
+        return the Choice for every given choice id or code, from the
+        cached choice map or the given one, see get_choice_map. raises
+        PollInvalidChoice if any choice is not a choice of this poll.
+        """
+        by_pk, by_code = choice_map or self.get_choice_map(choices)
+        resolved = []
+        for choice_id in choices:
+            choice = by_pk.get(_lookup_choice(choice_id, by_pk, by_code))
+            if choice is None:
                 raise PollInvalidChoice
-            # we always track the technical user at least by ip or clientid 
-            # to make sure we don't get multiple votes
-            #if self.is_anonymous:
-            #    user = None
-            vote = Vote.objects.create(poll=self, user=user,
-                                       choice=choice, data=data,
-                                       comment=comment)
-            votes.append(vote)
-        return votes
+            resolved.append(choice)
+        return resolved
 
-    def change_vote(self, choices, user=None, data=None):
+    def change_vote(self, choices, user=None, data=None, voter=None):
         """
         this deletes all previous votes of the user and revotes with
-        new choices.
+        new choices. returns the new votes.
         """
-        votes = self.vote_set.filter(user=user).delete()
-        self.vote(choices, user=user, data=data)
+        with transaction.atomic():
+            # the tally and rollups are decremented, see VoteQuerySet
+            self.votes_by(user, voter).delete()
+            votes = self.vote(choices, user=user, data=data, voter=voter,
+                              buffered=False)
+        bump_version(self.pk)
         return votes
 
     def count_choices(self):
@@ -88,19 +310,150 @@ class Poll(models.Model):
           <choice> : percentage
           (...)
         }
+
+        with as_code=True the choice codes are used as keys and no Choice
+        instances are built
         """
-        total_votes = self.count_total_votes()
+        if as_code:
+            counts = [(code, votes) for code, label, votes
+                      in self.count_votes_by_choice(as_code=True)]
+        else:
+            counts = [(choice, choice.votes)
+                      for choice in self.count_votes_by_choice()]
+        total_votes = sum(votes for key, votes in counts)
         stats = {}
-        for choice in self.choice_set.all():
-            key = choice.code if as_code else choice
-            stats[key] = float(choice.count_votes()) / total_votes
+        for key, votes in counts:
+            stats[key] = float(votes) / total_votes if total_votes else 0.0
         return stats
 
     def count_total_votes(self):
-        votes = sum((choice.count_votes() for choice in self.choice_set.all()))
-        return votes
+        votes = self.choicetally_set.aggregate(votes=Sum('votes'))['votes']
+        return votes or 0
+
+    def count_votes_by_choice(self, as_code=False):
+        """
+        return the vote count of every choice, ordered by choice, using a
+        single aggregation query over the tally
+
+        returns a list of Choice instances with a votes attribute, or with
+        as_code=True a list of (code, label, votes) tuples
+        """
+        choices = self.choice_set.order_by('choice', 'pk')
+        if as_code:
+            choices = choices.values_list('code', 'choice')
+            choices = choices.annotate(votes=Sum('tallies__votes'))
+            return [(code, label, votes or 0) for code, label, votes in choices]
+        choices = list(choices.annotate(votes=Sum('tallies__votes')))
+        for choice in choices:
+            choice.votes = choice.votes or 0
+        return choices
+
+    def get_tally(self):
+        """
+        return the current vote count by choice as a dict of
+        {
+          <choice pk> : votes
+          (...)
+        }
+        """
+        tally = (self.choicetally_set.order_by().values_list('choice')
+                 .annotate(votes=Sum('votes')))
+        return dict(tally)
+
+    def get_tally_as_of(self, as_of):
+        """
+        return the vote count by choice as of the given time, from the
+        rollups, as a dict of
+        {
+          <choice pk> : votes
+          (...)
+        }
+
+        the count is exact to the minute: votes cast in the minute of
+        as_of are not counted.
+        """
+        hour = bucket_start(as_of, ROLLUP_BUCKETS['1h'])
+        minute = bucket_start(as_of, ROLLUP_BUCKETS['1m'])
+        rollups = self.voterollup_set.filter(
+            models.Q(bucket=ROLLUP_BUCKETS['1h'], start__lt=hour) |
+            models.Q(bucket=ROLLUP_BUCKETS['1m'], start__gte=hour,
+                     start__lt=minute))
+        tally = rollups.order_by().values_list('choice').annotate(
+            votes=Sum('votes'))
+        return dict(tally)
+
+    def get_timeseries(self, bucket='1m', since=None, until=None):
+        """
+        return the vote count by choice in buckets of the given size,
+        from the rollups
+
+        returns a dict of
+        {
+          bucket : bucket,
+          labels : [choice, ...],
+          codes  : [code, ...],
+          series : [{ start : datetime, votes : [count, ...] }, ...],
+        }
+
+        votes are in the same (choice) order as labels and codes. buckets
+        without votes are left out. since and until limit the series to
+        buckets starting at or after since and before until.
+        """
+        seconds = ROLLUP_BUCKETS[bucket]
+        choices = list(self.choice_set.order_by('choice', 'pk')
+                       .values_list('pk', 'code', 'choice'))
+        index = dict((pk, i) for i, (pk, code, label) in enumerate(choices))
+        rollups = self.voterollup_set.filter(bucket=seconds)
+        if since is not None:
+            rollups = rollups.filter(start__gte=bucket_start(since, seconds))
+        if until is not None:
+            rollups = rollups.filter(start__lt=until)
+        series = []
+        for start, choice_id, votes in (rollups.order_by('start')
+                                        .values_list('start', 'choice', 'votes')):
+            if not series or series[-1]['start'] != start:
+                series.append(dict(start=start, votes=[0] * len(choices)))
+            series[-1]['votes'][index[choice_id]] += votes
+        return dict(bucket=bucket, series=series,
+                    codes=[code for pk, code, label in choices],
+                    labels=[label for pk, code, label in choices])
 
-    def get_stats(self):
+    def get_segments(self, segment_by, choices=None):
+        """
+        return the vote count by choice for every value of the segment_by
+        key of the votes' data, as a list of
+        [
+          (<value>, [count, ...]),
+          (...)
+        ]
+
+        counts are in the order of the given choice pks, by default in
+        choice order. values are sorted, votes without the key are counted
+        with a value of None, last. votes are counted by distinct data in
+        a single query so that every distinct data is decoded once.
+        """
+        if choices is None:
+            choices = self.choice_set.order_by('choice', 'pk').values_list(
+                'pk', flat=True)
+        index = dict((pk, i) for i, pk in enumerate(choices))
+        rows = (self.vote_set.order_by().values_list('data', 'choice')
+                .annotate(votes=Count('pk')))
+        values = {}
+        segments = {}
+        for data, choice_id, votes in rows:
+            if isinstance(data, basestring):
+                # the JSONField is not decoded by values_list
+                if data not in values:
+                    values[data] = _segment_value(data, segment_by)
+                value = values[data]
+            else:
+                value = _segment_value(data, segment_by)
+            counts = segments.setdefault(value, [0] * len(index))
+            counts[index[choice_id]] += votes
+        return sorted(segments.items(),
+                      key=lambda item: (item[0] is None, item[0]))
+
+    def get_stats(self, as_of=None, segment_by=None):
         """
         return a statistics object
 
@@ -108,25 +461,67 @@ class Poll(models.Model):
         {
           labels : [choice, ...],
           codes  : [code, ...],
-          percentage : [%, ...],
+          values : [%, ...],
+          votes  : total votes,
+        }
+
+        labels, codes and values are in the same (choice) order. all values
+        are computed from a single query. with as_of the statistics as of
+        the given time are computed from the rollups, see get_tally_as_of.
+
+        with segment_by the statistics are broken down by that key of the
+        votes' data, see get_segments, and include
+        {
+          segment_by : segment_by,
+          segments : [{ segment : value, counts : [count, ...],
+                        values : [%, ...], votes : votes }, ...],
         }
         """
-        # get statistics as dict of { choice : pct }
-        stats = self.count_percentage()
-        # convert to same indexed labels, codes, percentages
+        if segment_by is not None:
+            if as_of is not None:
+                raise ValueError('as_of and segment_by cannot be combined')
+            return self._get_segment_stats(segment_by)
         labels = []
         codes = []
-        percentage = []
-        for c, p in stats.iteritems():
-            labels.append(c.choice)
-            codes.append(c.code)
-            percentage.append(p)
-        count = self.count_total_votes()
+        counts = []
+        if as_of is not None:
+            tally = self.get_tally_as_of(as_of)
+            choices = [(code, label, tally.get(pk, 0)) for pk, code, label in
+                       self.choice_set.order_by('choice', 'pk')
+                       .values_list('pk', 'code', 'choice')]
+        else:
+            choices = self.count_votes_by_choice(as_code=True)
+        for code, label, votes in choices:
+            labels.append(label)
+            codes.append(code)
+            counts.append(votes)
+        count = sum(counts)
+        percentage = [float(votes) / count if count else 0.0
+                      for votes in counts]
         stats = dict(values=percentage, codes=codes,
                      labels=labels, votes=count)
         return stats
 
-    def already_voted(self, user): 
+    def _get_segment_stats(self, segment_by):
+        choices = list(self.choice_set.order_by('choice', 'pk')
+                       .values_list('pk', 'code', 'choice'))
+        segments = []
+        totals = [0] * len(choices)
+        for value, counts in self.get_segments(
+                segment_by, [pk for pk, code, label in choices]):
+            votes = sum(counts)
+            segments.append(dict(segment=value, counts=counts, votes=votes,
+                                 values=[float(count) / votes if votes else 0.0
+                                         for count in counts]))
+            totals = [total + count for total, count in zip(totals, counts)]
+        count = sum(totals)
+        return dict(codes=[code for pk, code, label in choices],
+                    labels=[label for pk, code, label in choices],
+                    values=[float(votes) / count if count else 0.0
+                            for votes in totals],
+                    votes=count, segment_by=segment_by, segments=segments)
+
+    def already_voted(self, user, voter=None): 
         if not self.is_anonymous:
             if user.is_anonymous():
                 raise PollNotAnonymous
@@ -134,7 +529,24 @@ class Poll(models.Model):
             # if we allow multiple votes, we don't care how many
             # votes this user has already vote
             return False
-        return self.vote_set.filter(user=user).exists()
+        # spooled ballots are missing from a filter that is built before
+        # they are flushed, see polls.buffer
+        buffer = get_vote_buffer()
+        if buffer is not None and buffer.pending(self.pk, user.pk,
+                                                 voter and voter.pk):
+            return True
+        voter_key = bloom.voter_key(user.pk, voter and voter.pk)
+        if not bloom.might_have_voted(self, voter_key):
+            return False
+        return self.votes_by(user, voter).exists()
+
+    def votes_by(self, user, voter=None):
+        """
+        return the votes of a user, or of a voter if given
+        """
+        if voter is not None:
+            return self.vote_set.filter(voter=voter)
+        return self.vote_set.filter(user=user)
 
     def __unicode__(self):
         return self.question
@@ -143,6 +555,179 @@ class Poll(models.Model):
         ordering = ['-start_votes']
 
 
+class PollRules(namedtuple('PollRules', [
+        'pk', 'reference', 'is_closed', 'start_votes', 'end_votes',
+        'is_anonymous', 'is_multiple', 'allow_multi_votes', 'tally_shards'])):
+
+    """
+    an immutable snapshot of the fields of a poll needed to vote, cached
+    by get_poll_rules so that votes do not load the poll
+
+    Usage:
+        rules = get_poll_rules(pk=1)
+        rules.check_open()
+        rules.as_poll().vote(['yes'], user)
+    """
+    __slots__ = ()
+
+    def check_open(self, current_time=None):
+        """
+        raise PollClosed or PollNotOpen if no votes are accepted at
+        current_time
+        """
+        current_time = current_time or timezone.now()
+        if self.is_closed:
+            raise PollClosed
+        if current_time < self.start_votes or current_time > self.end_votes:
+            raise PollNotOpen
+
+    def check_ballot(self, choices, user=None, current_time=None):
+        """
+        raise if a ballot of the given choices cast by user at
+        current_time is not allowed
+        """
+        self.check_open(current_time)
+        if user is None and not self.is_anonymous:
+            raise PollNotAnonymous
+        if not choices:
+            raise PollInvalidChoice
+        if len(choices) > 1 and not self.is_multiple:
+            raise PollNotMultiple
+        if len(choices) == 0:
+            raise PollChoiceRequired
+
+    def as_poll(self):
+        """
+        return a Poll with the fields of the snapshot only, to vote
+        without loading the poll
+        """
+        return Poll(**self._asdict())
+
+
+def load_poll_rules(poll_pk):
+    """
+    return the PollRules of a poll, raises Poll.DoesNotExist
+    """
+    return PollRules(*Poll.objects.values_list(*PollRules._fields)
+                     .get(pk=poll_pk))
+
+
+def load_poll_reference(reference):
+    """
+    return the pk of the poll with the given reference, raises
+    Poll.DoesNotExist
+    """
+    return Poll.objects.values_list('pk', flat=True).get(reference=reference)
+
+
+#: the rules of each poll, see PollRules
+poll_rules = PollDataCache(RULES_KEY, load_poll_rules)
+#: the pk of each poll reference
+poll_references = PollDataCache(REFERENCE_KEY, load_poll_reference)
+
+
+def get_poll_rules(pk=None, reference=None):
+    """
+    return the cached PollRules of the poll with the given pk or
+    reference, raises Poll.DoesNotExist
+    """
+    if reference is None:
+        return poll_rules.get(int(pk))
+    # compact or hyphenated UUIDs are the same reference
+    reference = normalize_reference(reference)
+    try:
+        rules = poll_rules.get(poll_references.get(reference))
+    except Poll.DoesNotExist:
+        rules = None
+    if rules is None or normalize_reference(rules.reference) != reference:
+        # the poll was deleted or its reference changed since it was cached
+        poll_references.invalidate(reference)
+        rules = poll_rules.get(poll_references.get(reference))
+    return rules
+
+
+class ChoiceManager(models.Manager):
+
+    def create_for_poll(self, poll, choices):
+        """
+        create the choices of a poll with a single insert
+
+        choices is a list of labels or dicts of { choice : label,
+        code : code }. codes that are not given are generated from the
+        label and made unique within the poll. raises PollInvalidChoice
+        if a label is missing or a given code is not unique.
+        """
+        items = []
+        for item in choices:
+            if isinstance(item, basestring):
+                item = dict(choice=item)
+            if not isinstance(item, dict) or not item.get('choice'):
+                raise PollInvalidChoice
+            items.append((item['choice'], item.get('code')))
+        codes = [code for label, code in items if code]
+        taken = set(self.filter(poll=poll).values_list('code', flat=True))
+        if len(set(codes)) < len(codes) or taken.intersection(codes):
+            raise PollInvalidChoice
+        taken.update(codes)
+        objs = []
+        for label, code in items:
+            if not code:
+                code = unique_code(label, taken)
+                taken.add(code)
+            objs.append(Choice(poll=poll, choice=label, code=code))
+        self.bulk_create(objs)
+        bump_version(poll.pk)
+        choice_maps.invalidate(poll.pk)
+        return objs
+
+
+def _lookup_choice(choice_id, pks, codes):
+    # return the pk of a choice id or code given the pks and codes of a
+    # poll's choices, or None. codes may be numeric, pks are tried first
+    if isinstance(choice_id, (int, long)):
+        return choice_id if choice_id in pks else None
+    if not isinstance(choice_id, basestring):
+        return None
+    if choice_id.isdigit() and int(choice_id) in pks:
+        return int(choice_id)
+    value = codes.get(choice_id)
+    # codes map to pks or to choices
+    return getattr(value, 'pk', value)
+
+
+def load_choice_map(poll_pk):
+    """
+    return the choices of a poll as a tuple of dicts
+    ({ pk : (code, label) }, { code : pk })
+    """
+    pks = {}
+    codes = {}
+    for pk, code, label in Choice.objects.filter(poll=poll_pk).values_list(
+            'pk', 'code', 'choice'):
+        pks[pk] = (code, label)
+        codes[code] = pk
+    return pks, codes
+
+
+#: the choice map of each poll, see load_choice_map
+choice_maps = PollDataCache(CHOICES_KEY, load_choice_map)
+
+
+def unique_code(label, taken):
+    """
+    return the slug of label, made unique among the taken codes by a
+    numeric suffix
+    """
+    max_length = Choice._meta.get_field('code').max_length
+    base = slugify(unicode(label))[:max_length] or 'choice'
+    code = base
+    suffix = 1
+    while code in taken:
+        suffix += 1
+        code = '%s-%d' % (base[:max_length - len(str(suffix)) - 1], suffix)
+    return code
+
+
 class Choice(models.Model):
     #: poll reference
     poll = models.ForeignKey(Poll)
@@ -151,6 +736,8 @@ class Choice(models.Model):
     #: code as an alternative to id
     code = models.CharField(max_length=36, default='', blank=True)
 
+    objects = ChoiceManager()
+
     def count_votes(self):
         return self.vote_set.count()
 
@@ -167,16 +754,318 @@ class Choice(models.Model):
         ordering = ['poll', 'choice']
 
 
+class VoterManager(models.Manager):
+
+    def get_or_create_keys(self, keys):
+        """
+        get or create the voters with the given hashed keys, returns a dict
+        of { key : voter pk }
+        """
+        keys = set(keys)
+        if not keys:
+            return {}
+        voters = dict(self.filter(key__in=keys).values_list('key', 'pk'))
+        missing = keys.difference(voters)
+        if missing:
+            try:
+                with transaction.atomic():
+                    self.bulk_create(Voter(key=key) for key in missing)
+            except IntegrityError:
+                # a concurrent request created some of the voters
+                for key in missing:
+                    self.get_or_create(key=key)
+            voters.update(self.filter(key__in=missing).values_list('key', 'pk'))
+        return voters
+
+
+class Voter(models.Model):
+    """
+    a lightweight identity of an anonymous voter, e.g. by ip address or
+    client id. only a hash of the client key is stored.
+    """
+    key = models.CharField(max_length=40, unique=True)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = VoterManager()
+
+    @staticmethod
+    def hash_key(client_key):
+        return salted_hmac('polls.Voter', client_key).hexdigest()
+
+    def __unicode__(self):
+        return self.key
+
+
+class VoteQuerySet(models.QuerySet):
+
+    def delete(self):
+        """
+        delete the votes and subtract them from the tally and rollups of
+        their polls in the same transaction. the votes are counted by
+        choice and time in a single query.
+
+        votes deleted with their poll or choice are not counted, their
+        tally and rollups are deleted with them.
+        """
+        with transaction.atomic(using=self.db):
+            counts = list(self.order_by()
+                          .values_list('poll', 'choice', 'created')
+                          .annotate(votes=Count('pk')))
+            super(VoteQuerySet, self).delete()
+            tally = {}
+            for poll_id, choice_id, created, votes in counts:
+                tally[choice_id] = tally.get(choice_id, 0) + votes
+            ChoiceTally.objects.decrement(tally)
+            VoteRollup.objects.subtract(counts)
+        for poll_id in set(row[0] for row in counts):
+            bump_version(poll_id)
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
 class Vote(models.Model):
     user = models.ForeignKey(User, blank=True, null=True)
+    voter = models.ForeignKey(Voter, blank=True, null=True)
     poll = models.ForeignKey(Poll)
     choice = models.ForeignKey(Choice)
     comment = models.TextField(max_length=144, blank=True, null=True)
-    created = models.DateTimeField(auto_now_add=True)
+    created = models.DateTimeField(default=timezone.now, editable=False)
     data = JSONField(blank=True, null=True)
 
+    objects = VoteQuerySet.as_manager()
+
     def __unicode__(self):
         return u'Vote for %s' % self.choice
 
+    def delete(self, using=None):
+        # subtract the vote from the tally, see VoteQuerySet.delete
+        Vote.objects.db_manager(using).filter(pk=self.pk).delete()
+
     class Meta:
         ordering = ['poll', 'choice']
+        # already_voted, per choice counts and time ranges, see
+        # polls.test.test_queries
+        index_together = (('poll', 'user'), ('poll', 'voter'),
+                          ('poll', 'created'), ('choice', 'created'))
+
+
+class ChoiceTallyManager(models.Manager):
+
+    def increment(self, choices, delta=1, shards=1):
+        """
+        add delta to the tally of each choice. a choice that is given
+        multiple times is counted multiple times.
+
+        the tally of each choice is spread over shards rows (slots). one
+        slot is picked at random so that concurrent voters for the same
+        choice are unlikely to wait for each other's row lock.
+        """
+        slot = random.randrange(shards) if shards > 1 else 0
+        counts = {}
+        polls = {}
+        for choice in choices:
+            counts[choice.pk] = counts.get(choice.pk, 0) + delta
+            polls[choice.pk] = choice.poll_id
+        # one update for all choices that get the same count
+        by_count = {}
+        for choice_id, count in counts.iteritems():
+            by_count.setdefault(count, []).append(choice_id)
+        for count, choice_ids in by_count.iteritems():
+            updated = self.filter(choice__in=choice_ids, slot=slot).update(
+                votes=F('votes') + count)
+            if updated < len(choice_ids):
+                self._create(choice_ids, polls, count, slot)
+
+    def decrement(self, counts):
+        """
+        subtract votes from the tally of choices, counts is a dict of
+        { choice pk : votes }. the count is subtracted from the first slot
+        of each choice, tallies that do not exist are not created.
+        """
+        slots = (self.filter(choice__in=list(counts)).order_by()
+                 .values_list('choice').annotate(slot=Min('slot')))
+        # one update for all choices of a slot that lose the same count
+        by_slot = {}
+        for choice_id, slot in slots:
+            by_slot.setdefault((slot, counts[choice_id]), []).append(choice_id)
+        for (slot, count), choice_ids in by_slot.iteritems():
+            self.filter(choice__in=choice_ids, slot=slot).update(
+                votes=F('votes') - count)
+
+    def _create(self, choice_ids, polls, count, slot):
+        # first vote for some of the choices, create their tally rows. if a
+        # concurrent voter was faster we get an IntegrityError and update
+        existing = set(self.filter(choice__in=choice_ids, slot=slot)
+                       .values_list('choice', flat=True))
+        missing = [choice_id for choice_id in choice_ids
+                   if choice_id not in existing]
+        try:
+            with transaction.atomic():
+                self.bulk_create([ChoiceTally(poll_id=polls[choice_id],
+                                              choice_id=choice_id,
+                                              slot=slot, votes=count)
+                                  for choice_id in missing])
+        except IntegrityError:
+            self.filter(choice__in=missing, slot=slot).update(
+                votes=F('votes') + count)
+
+
+class ChoiceTally(models.Model):
+    """
+    denormalized vote count by choice, maintained on every vote and
+    deleted vote. the count of a choice is the sum of its slots, see
+    Poll.tally_shards
+    """
+    poll = models.ForeignKey(Poll)
+    choice = models.ForeignKey(Choice, related_name='tallies')
+    slot = models.PositiveSmallIntegerField(default=0)
+    votes = models.IntegerField(default=0)
+
+    objects = ChoiceTallyManager()
+
+    def __unicode__(self):
+        return u'%s: %d' % (self.choice, self.votes)
+
+    class Meta:
+        unique_together = (('choice', 'slot'),)
+
+
+#: rollup bucket sizes in seconds, by name
+ROLLUP_BUCKETS = {'1m': 60, '1h': 3600}
+
+
+def _segment_value(data, key):
+    # the value of key in the data of a vote, or None. values that are
+    # not hashable are segmented by their JSON text
+    if isinstance(data, basestring):
+        try:
+            data = json.loads(data) if data else None
+        except ValueError:
+            return None
+    if not isinstance(data, dict):
+        return None
+    value = data.get(key)
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, sort_keys=True)
+    return value
+
+
+def bucket_start(when, seconds):
+    """
+    return the start of the bucket of the given size in seconds that
+    contains when
+    """
+    if timezone.is_aware(when):
+        when = timezone.make_naive(when, timezone.utc)
+        aware = True
+    else:
+        aware = False
+    epoch = calendar.timegm(when.timetuple())
+    start = datetime.utcfromtimestamp(epoch - epoch % seconds)
+    return timezone.make_aware(start, timezone.utc) if aware else start
+
+
+class VoteRollupManager(models.Manager):
+
+    def add(self, votes, delta=1):
+        """
+        add delta to the rollups of the given votes, in every bucket size
+        """
+        self._add((vote.poll_id, vote.choice_id, vote.created, delta)
+                  for vote in votes)
+
+    def subtract(self, counts):
+        """
+        subtract votes from the rollups, counts is a list of (poll pk,
+        choice pk, created, votes), e.g. the deleted votes counted by
+        choice and time
+        """
+        self._add((poll_id, choice_id, created, -votes)
+                  for poll_id, choice_id, created, votes in counts)
+
+    def _add(self, rows):
+        # add the count of each (poll pk, choice pk, created, count) row
+        counts = {}
+        polls = {}
+        for poll_id, choice_id, created, delta in rows:
+            polls[choice_id] = poll_id
+            for seconds in ROLLUP_BUCKETS.values():
+                key = (choice_id, seconds, bucket_start(created, seconds))
+                counts[key] = counts.get(key, 0) + delta
+        # one update for all choices of a bucket that get the same count
+        by_bucket = {}
+        for (choice_id, seconds, start), count in counts.iteritems():
+            by_bucket.setdefault((seconds, start, count), []).append(choice_id)
+        for (seconds, start, count), choice_ids in by_bucket.iteritems():
+            rollups = self.filter(choice__in=choice_ids, bucket=seconds,
+                                  start=start)
+            updated = rollups.update(votes=F('votes') + count)
+            if updated < len(choice_ids) and count > 0:
+                self._create(rollups, choice_ids, polls, seconds, start, count)
+
+    def _create(self, rollups, choice_ids, polls, seconds, start, count):
+        # first vote in this bucket for some of the choices, see
+        # ChoiceTallyManager._create
+        existing = set(rollups.values_list('choice', flat=True))
+        missing = [choice_id for choice_id in choice_ids
+                   if choice_id not in existing]
+        try:
+            with transaction.atomic():
+                self.bulk_create([VoteRollup(poll_id=polls[choice_id],
+                                             choice_id=choice_id,
+                                             bucket=seconds, start=start,
+                                             votes=count)
+                                  for choice_id in missing])
+        except IntegrityError:
+            self.filter(choice__in=missing, bucket=seconds,
+                        start=start).update(votes=F('votes') + count)
+
+
+class VoteRollup(models.Model):
+    """
+    vote count by choice in fixed time buckets, maintained on every vote.
+    see ROLLUP_BUCKETS for the bucket sizes.
+    """
+    poll = models.ForeignKey(Poll)
+    choice = models.ForeignKey(Choice, related_name='rollups')
+    #: bucket size in seconds
+    bucket = models.PositiveIntegerField()
+    #: start of the bucket
+    start = models.DateTimeField()
+    votes = models.IntegerField(default=0)
+
+    objects = VoteRollupManager()
+
+    def __unicode__(self):
+        return u'%s at %s: %d' % (self.choice, self.start, self.votes)
+
+    class Meta:
+        unique_together = (('choice', 'bucket', 'start'),)
+        index_together = (('poll', 'bucket', 'start'),)
+
+
+@receiver(post_save, sender=Poll)
+def poll_saved(sender, instance, created=False, **kwargs):
+    bump_version(instance.pk)
+    poll_rules.invalidate(instance.pk)
+    if created:
+        bloom.drop_filter(instance.pk)
+
+
+@receiver(post_delete, sender=Poll)
+def poll_deleted(sender, instance, **kwargs):
+    poll_rules.invalidate(instance.pk)
+    poll_references.invalidate(instance.reference)
+
+
+@receiver([post_save, post_delete], sender=Choice)
+def choice_changed(sender, instance, **kwargs):
+    bump_version(instance.poll_id)
+    choice_maps.invalidate(instance.poll_id)
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Voter)
+def client_deleted(sender, instance, **kwargs):
+    # client_cache of polls.util may know the user or voter
+    reset_client_cache()
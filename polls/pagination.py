@@ -0,0 +1,200 @@
+"""
+keyset pagination of polls
+
+pages are selected by the sort keys of the last row of the previous page
+instead of by an offset, so that a deep page costs the same index range
+scan as the first one. the position is passed as an opaque cursor.
+
+    page = keyset_page(Poll.objects.all(), POLL_KEYS, cursor, limit=20)
+    page.object_list, page.next_cursor
+
+    GET /api/v1/poll/?limit=20
+    => { meta : { limit : 20, next : '/api/v1/poll/?limit=20&cursor=...',
+                  previous : null, total_count : 123 },
+         objects : [...] }
+
+the total count costs a query of its own, pass count=false to skip it,
+total_count is null then.
+
+Settings:
+    POLLS_PAGINATION_COUNT -- set to False to count only if count=true is
+      passed, defaults to True
+"""
+import base64
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import six
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+
+#: the keys of polls, see Poll.Meta.ordering
+POLL_KEYS = ('-start_votes', '-id')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPage(object):
+
+    """
+    a page of objects and the cursor of the next page, if any
+    """
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(values):
+    """
+    return the opaque cursor of the key values of a row
+    """
+    values = [value.isoformat() if hasattr(value, 'isoformat') else value
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values)).rstrip('=')
+
+
+def decode_cursor(cursor, model, keys):
+    """
+    return the key values of a cursor, converted by the fields of model.
+    raises InvalidCursor
+    """
+    try:
+        cursor = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise InvalidCursor(cursor)
+    try:
+        return [model._meta.get_field(key.lstrip('-')).to_python(value)
+                for key, value in zip(keys, values)]
+    except (TypeError, ValidationError):
+        raise InvalidCursor(cursor)
+
+
+def _after(keys, values):
+    # rows after the given key values, e.g. for keys ('-a', '-b')
+    # a < x or (a = x and b < y)
+    query = Q()
+    for index, key in enumerate(keys):
+        name = key.lstrip('-')
+        lookup = '%s__%s' % (name, 'lt' if key.startswith('-') else 'gt')
+        condition = Q(**{lookup: values[index]})
+        for previous, value in zip(keys[:index], values[:index]):
+            condition &= Q(**{previous.lstrip('-'): value})
+        query |= condition
+    return query
+
+
+def after_cursor(queryset, keys, cursor=None):
+    """
+    return queryset ordered by keys, starting after cursor if given.
+    raises InvalidCursor
+    """
+    queryset = queryset.order_by(*keys)
+    if cursor:
+        values = decode_cursor(cursor, queryset.model, keys)
+        queryset = queryset.filter(_after(keys, values))
+    return queryset
+
+
+def keyset_page(queryset, keys, cursor=None, limit=20):
+    """
+    return the KeysetPage of queryset ordered by keys that starts after
+    cursor, or the first page. the last key must be unique, e.g. the id.
+    raises InvalidCursor
+
+    limit rows are returned, all rows if limit is 0 or None. one more row
+    is queried to know whether there is a next page.
+    """
+    queryset = after_cursor(queryset, keys, cursor)
+    if not limit:
+        return KeysetPage(list(queryset))
+    rows = list(queryset[:limit + 1])
+    if len(rows) <= limit:
+        return KeysetPage(rows)
+    rows = rows[:limit]
+    return KeysetPage(rows, encode_cursor(
+        [getattr(rows[-1], key.lstrip('-')) for key in keys]))
+
+
+class KeysetPaginator(Paginator):
+
+    """
+    tastypie paginator by keys, see polls.pagination. ?cursor= replaces
+    ?offset=, and ?count=false skips the total count.
+
+    Usage:
+        class PollResource(ModelResource):
+            class Meta:
+                paginator_class = PollPaginator
+    """
+    keys = ('-id',)
+
+    def page(self):
+        limit = self.get_limit()
+        try:
+            page = keyset_page(self.objects, self.keys,
+                               self.request_data.get('cursor'), limit)
+        except InvalidCursor:
+            raise BadRequest('Invalid cursor provided.')
+        meta = dict(limit=limit, previous=None,
+                    next=self.get_next_uri(limit, page.next_cursor),
+                    total_count=self.get_count() if self.counts() else None)
+        return {
+            self.collection_name: page.object_list,
+            'meta': meta,
+        }
+
+    def counts(self):
+        """
+        return True if the total count is requested, see polls.pagination
+        """
+        count = self.request_data.get('count')
+        if count is None:
+            return getattr(settings, 'POLLS_PAGINATION_COUNT', True)
+        return count.lower() not in ('0', 'false', 'no')
+
+    def get_next_uri(self, limit, cursor):
+        if cursor is None or self.resource_uri is None:
+            return None
+        params = [(key, value) for key, value in self._request_params()
+                  if key not in ('limit', 'offset', 'cursor')]
+        params.extend([('limit', limit), ('cursor', cursor)])
+        return '%s?%s' % (self.resource_uri, urlencode(params))
+
+    def _request_params(self):
+        # QueryDict or dict
+        if hasattr(self.request_data, 'lists'):
+            items = [(key, value) for key, values in self.request_data.lists()
+                     for value in values]
+        else:
+            items = self.request_data.items()
+        return [(key, value.encode('utf-8')
+                 if isinstance(value, six.text_type) else value)
+                for key, value in items]
+
+
+class PollPaginator(KeysetPaginator):
+    keys = POLL_KEYS
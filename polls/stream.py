@@ -0,0 +1,172 @@
+"""
+live poll results as server-sent events
+
+every subscriber of a poll waits on the same ResultsChannel. once per
+POLLS_STREAM_INTERVAL one of them checks the poll's version and, if the
+results changed, gets the new statistics. all other subscribers are
+woken up with the same payload, so a poll costs at most one statistics
+computation per interval and process however many dashboards watch it.
+statistics are shared across processes by the results cache.
+
+every open stream holds a worker thread of the web server until it is
+closed. serve streams by an asynchronous server, e.g. gunicorn with
+gevent workers, and keep POLLS_STREAM_MAX_SUBSCRIBERS below the number
+of connections a process can hold. a process that has as many
+subscribers sends the current statistics and closes the stream, the
+client then polls by reconnecting every POLLS_STREAM_HEARTBEAT seconds.
+
+Usage:
+    for event in event_stream(poll):
+        out.write(event)
+
+Settings:
+    POLLS_STREAM_INTERVAL -- the minimum seconds between two updates of a
+      poll, defaults to 1.0
+    POLLS_STREAM_HEARTBEAT -- seconds between keep-alive comments if
+      the results do not change, defaults to 15
+    POLLS_STREAM_TIMEOUT -- seconds after which a stream is closed, the
+      client reconnects. defaults to 30
+    POLLS_STREAM_MAX_SUBSCRIBERS -- the maximum number of open streams per
+      process, defaults to 100
+"""
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from polls.cache import get_version, results_cache
+
+
+class ResultsChannel(object):
+
+    """
+    coalesced updates of the statistics of a poll
+
+    Usage:
+        channel = ResultsChannel(poll)
+        version, stats = channel.next(None, timeout=15)
+        channel.next(version, timeout=15)
+        => None if the results did not change within the timeout
+    """
+    def __init__(self, poll, interval=None):
+        self.poll = poll
+        self.interval = interval
+        self.version = None
+        self.stats = None
+        self.subscribers = 0
+        self._condition = threading.Condition()
+        self._refreshing = False
+        self._next_tick = 0
+
+    def next(self, seen, timeout):
+        """
+        return the (version, stats) of the poll once its version is not
+        seen, or None after timeout seconds
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self._condition:
+                while True:
+                    if self.version is not None and self.version != seen:
+                        return self.version, self.stats
+                    now = time.time()
+                    if now >= deadline:
+                        return None
+                    if not self._refreshing and now >= self._next_tick:
+                        # this subscriber refreshes for all others
+                        self._refreshing = True
+                        break
+                    wait_until = deadline
+                    if not self._refreshing:
+                        wait_until = min(deadline, self._next_tick)
+                    self._condition.wait(wait_until - now)
+            self._refresh()
+
+    def _refresh(self):
+        version = stats = None
+        try:
+            version = get_version(self.poll.pk)
+            if version != self.version:
+                stats = results_cache.get_stats_at(self.poll, version)
+        finally:
+            interval = self.interval
+            if interval is None:
+                interval = getattr(settings, 'POLLS_STREAM_INTERVAL', 1.0)
+            with self._condition:
+                if stats is not None:
+                    self.version, self.stats = version, stats
+                self._refreshing = False
+                self._next_tick = time.time() + interval
+                self._condition.notify_all()
+
+
+_channels = {}
+_channels_lock = threading.Lock()
+_subscribers = 0
+
+
+def subscribe(poll):
+    """
+    return the channel of a poll, call unsubscribe() when done. returns
+    None if POLLS_STREAM_MAX_SUBSCRIBERS are subscribed in this process
+    """
+    global _subscribers
+    with _channels_lock:
+        if _subscribers >= getattr(
+                settings, 'POLLS_STREAM_MAX_SUBSCRIBERS', 100):
+            return None
+        _subscribers += 1
+        channel = _channels.get(poll.pk)
+        if channel is None:
+            channel = _channels[poll.pk] = ResultsChannel(poll)
+        channel.subscribers += 1
+        return channel
+
+
+def unsubscribe(channel):
+    global _subscribers
+    with _channels_lock:
+        _subscribers -= 1
+        channel.subscribers -= 1
+        if not channel.subscribers and _channels.get(channel.poll.pk) is channel:
+            del _channels[channel.poll.pk]
+
+
+def event_stream(poll, last_event_id=None):
+    """
+    yield server-sent events of the statistics of a poll, one on
+    subscribing and one whenever they change. the event id is the poll's
+    version, a client that reconnects with a Last-Event-ID of the current
+    version gets no event until the results change.
+    """
+    interval = getattr(settings, 'POLLS_STREAM_INTERVAL', 1.0)
+    heartbeat = getattr(settings, 'POLLS_STREAM_HEARTBEAT', 15)
+    closes = time.time() + getattr(settings, 'POLLS_STREAM_TIMEOUT', 30)
+    seen = last_event_id
+    channel = subscribe(poll)
+    if channel is None:
+        # too many streams, let the client poll
+        yield 'retry: %d\n\n' % (heartbeat * 1000)
+        version = get_version(poll.pk)
+        if version != seen:
+            yield _stats_event(version,
+                               results_cache.get_stats_at(poll, version))
+        return
+    try:
+        yield 'retry: %d\n\n' % (interval * 1000)
+        while time.time() < closes:
+            update = channel.next(seen, min(heartbeat, closes - time.time()))
+            if update is None:
+                yield ': keep-alive\n\n'
+                continue
+            seen, stats = update
+            yield _stats_event(seen, stats)
+    finally:
+        unsubscribe(channel)
+
+
+def _stats_event(version, stats):
+    return 'id: %s\nevent: stats\ndata: %s\n\n' % (
+        version, json.dumps(stats, cls=DjangoJSONEncoder))
@@ -1,14 +1,25 @@
 from datetime import timedelta
 import json
 import logging
+import os
+import shutil
+import tempfile
 import uuid
 
 from django.contrib.auth.models import Permission, User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
+from tastypie.exceptions import NotFound
 from tastypie.test import ResourceTestCase
 from tastypie.utils import make_naive
 
-from polls.models import Poll, Choice
+from polls.cache import get_cache
+from polls.api import PollResource, get_poll_rules_via_uri, resolve_poll
+from polls.buffer import get_vote_buffer
+from polls.models import (Poll, Choice, Vote, Voter, poll_references,
+                          poll_rules)
+from polls.util import client_cache
 
 
 logger = logging.getLogger(__name__)
@@ -21,6 +32,10 @@ class PollsApiTest(ResourceTestCase):
 
     def setUp(self):
         super(PollsApiTest, self).setUp()
+        get_cache().clear()
+        client_cache.clear()
+        poll_rules.local.clear()
+        poll_references.local.clear()
         self.username = 'test'
         self.password = 'password'
         self.user = User.objects.create_user(
@@ -79,6 +94,76 @@ class PollsApiTest(ResourceTestCase):
         except ValueError:
             self.fail('badly formed UUID string')
 
+    def test_poll_list_query_budget(self):
+        for i in range(5):
+            resp = self.create_poll(self.poll_data(anonymous=True))
+            self.assertHttpCreated(resp)
+            pk = Poll.objects.order_by('-id')[0].pk
+            self.create_choices(self.choice_data(poll_id=pk), quantity=3)
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.api_client.get(self.getURL('poll'))
+        self.assertValidJSONResponse(resp)
+        objects = self.deserialize(resp)['objects']
+        self.assertEqual(len(objects), 5)
+        self.assertEqual([len(poll['choices']) for poll in objects], [3] * 5)
+        self.assertTrue(len(queries) <= PollResource.query_budget['list'])
+        # plus one query for basic authentication
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.api_client.get(self.getURL('poll', pk),
+                                       authentication=self.get_credentials())
+        self.assertValidJSONResponse(resp)
+        self.assertEqual(len(self.deserialize(resp)['choices']), 3)
+        self.assertTrue(len(queries) <= PollResource.query_budget['detail'] + 1)
+
+    def test_poll_list_cursor(self):
+        for i in range(5):
+            Poll.objects.create(question='question %d' % i)
+        resp = self.api_client.get(self.getURL('poll'), data={'limit': 2})
+        self.assertValidJSONResponse(resp)
+        deserialized = self.deserialize(resp)
+        self.assertEqual(deserialized['meta']['total_count'], 5)
+        references = [poll['reference'] for poll in deserialized['objects']]
+        # the resource uri is not reversed without the polls namespace
+        url = deserialized['meta']['next'] + '&count=false'
+        while url:
+            resp = self.api_client.get(self.getURL('poll') + url)
+            self.assertValidJSONResponse(resp)
+            deserialized = self.deserialize(resp)
+            self.assertEqual(deserialized['meta']['total_count'], None)
+            self.assertTrue(len(deserialized['objects']) <= 2)
+            references.extend(poll['reference'] for poll in deserialized['objects'])
+            url = deserialized['meta']['next']
+            if url:
+                # the next url keeps the limit and the count option
+                self.assertTrue(url.startswith('?count=false&limit=2&cursor='))
+        self.assertEqual(references, list(Poll.objects.order_by(
+            '-start_votes', '-id').values_list('reference', flat=True)))
+        resp = self.api_client.get(self.getURL('poll'), data={'cursor': 'xyz'})
+        self.assertHttpBadRequest(resp)
+
+    def test_create_poll_with_choices(self):
+        poll_data = self.poll_data()
+        poll_data['choices'] = ['Yes', 'No', 'Yes', {'choice': 'Maybe', 'code': 'm'}]
+        resp = self.create_poll(poll_data)
+        self.assertHttpCreated(resp)
+        choices = self.deserialize(resp)['choices']
+        self.assertEqual(sorted((c['choice'], c['code']) for c in choices),
+                         [('Maybe', 'm'), ('No', 'no'), ('Yes', 'yes'),
+                          ('Yes', 'yes-2')])
+        # duplicate codes are invalid
+        poll_data['choices'] = [{'choice': 'A', 'code': 'a'},
+                                {'choice': 'B', 'code': 'a'}]
+        polls = Poll.objects.count()
+        resp = self.create_poll(poll_data)
+        self.assertHttpBadRequest(resp)
+        self.assertEqual(Poll.objects.count(), polls)
+        # adding choices requires the permission
+        self.user.user_permissions.add(Permission.objects.get(codename='add_poll'))
+        poll_data['choices'] = ['Yes']
+        resp = self.api_client.post(self.getURL('poll'), format='json',
+                                    data=poll_data, authentication=self.get_credentials())
+        self.assertHttpUnauthorized(resp)
+
     def test_create_poll_unauthenticated(self):
         resp = self.api_client.post(self.getURL('poll'), format='json')
         self.assertHttpUnauthorized(resp)
@@ -137,6 +222,85 @@ class PollsApiTest(ResourceTestCase):
             self.getURL('vote'), data=vote_data, format='json')
         self.assertHttpCreated(resp)
 
+    def test_voting_multiple_choices(self):
+        resp = self.create_poll(self.poll_data(multiple=True))
+        self.assertHttpCreated(resp)
+        pk = Poll.objects.order_by('-id')[0].pk
+        self.create_choices(self.choice_data(poll_id=pk), quantity=3)
+        vote_data = self.vote_data(poll_id=pk, choices=['choice0', 'choice2'])
+        resp = self.api_client.post(self.getURL('vote'), data=vote_data,
+                                    format='json',
+                                    authentication=self.get_credentials())
+        self.assertHttpCreated(resp)
+        vote = Vote.objects.filter(poll=pk).order_by('pk')[0]
+        deserialized = self.deserialize(resp)
+        self.assertEqual(deserialized['choice'], 'choice0')
+        # the resource uri is not reversed without the polls namespace
+        self.assertEqual(deserialized['id'], vote.pk)
+        self.assertIn('resource_uri', deserialized)
+        self.assertEqual(Vote.objects.filter(poll=pk).count(), 2)
+
+    def test_voting_buffered(self):
+        resp = self.create_poll(self.poll_data())
+        self.assertHttpCreated(resp)
+        pk = Poll.objects.order_by('-id')[0].pk
+        self.create_choices(self.choice_data(poll_id=pk), quantity=3)
+        path = tempfile.mkdtemp()
+        try:
+            with override_settings(
+                    POLLS_VOTE_BUFFER=os.path.join(path, 'votes.sqlite3')):
+                resp = self.api_client.post(self.getURL('vote'),
+                                            data=self.vote_data(pk, ['choice0']),
+                                            format='json',
+                                            authentication=self.get_credentials())
+                self.assertHttpAccepted(resp)
+                self.assertEqual(Vote.objects.count(), 0)
+                # the spooled ballot counts as a vote
+                resp = self.api_client.post(self.getURL('vote'),
+                                            data=self.vote_data(pk, ['choice1']),
+                                            format='json',
+                                            authentication=self.get_credentials())
+                self.assertHttpForbidden(resp)
+                self.assertEqual(get_vote_buffer().flush(), 1)
+            self.assertEqual(Vote.objects.get().choice.code, 'choice0')
+        finally:
+            shutil.rmtree(path)
+
+    def test_change_vote(self):
+        resp = self.create_poll(self.poll_data())
+        self.assertHttpCreated(resp)
+        pk = Poll.objects.order_by('-id')[0].pk
+        self.create_choices(self.choice_data(poll_id=pk), quantity=3)
+        resp = self.api_client.post(self.getURL('vote'),
+                                    data=self.vote_data(pk, ['choice0']),
+                                    format='json',
+                                    authentication=self.get_credentials())
+        self.assertHttpCreated(resp)
+        vote_pk = self.deserialize(resp)['id']
+        # votes of other users cannot be changed
+        resp = self.api_client.put(self.getURL('vote', vote_pk),
+                                   data=self.vote_data(pk, ['choice1']),
+                                   format='json',
+                                   authentication=self.get_credentials(admin=True))
+        self.assertHttpForbidden(resp)
+        resp = self.api_client.put(self.getURL('vote', vote_pk),
+                                   data=self.vote_data(pk, 'choice1'),
+                                   format='json',
+                                   authentication=self.get_credentials())
+        self.assertHttpOK(resp)
+        self.assertEqual(self.deserialize(resp)['choice'], 'choice1')
+        vote = Vote.objects.get(poll=pk)
+        self.assertEqual((vote.user_id, vote.choice.code),
+                         (self.user.pk, 'choice1'))
+        self.assertEqual(Poll.objects.get(pk=pk).get_stats()['values'],
+                         [0.0, 1.0, 0.0])
+        resp = self.api_client.put(self.getURL('vote', vote.pk),
+                                   data=self.vote_data(pk, ['xchoice']),
+                                   format='json',
+                                   authentication=self.get_credentials())
+        self.assertHttpBadRequest(resp)
+        self.assertEqual(Vote.objects.get(poll=pk).pk, vote.pk)
+
     def test_anonymous_voting_multiple(self):
         poll_data = self.poll_data(anonymous=True)
         resp = self.create_poll(poll_data)
@@ -165,6 +329,185 @@ class PollsApiTest(ResourceTestCase):
             self.getURL('vote'), data=vote_data, format='json')
         self.assertHttpForbidden(resp)
 
+    @override_settings(POLLS_ANONYMOUS_VOTERS=True)
+    def test_anonymous_voting_voters(self):
+        poll_data = self.poll_data(anonymous=True)
+        resp = self.create_poll(poll_data)
+        self.assertHttpCreated(resp)
+        pk = Poll.objects.order_by('-id')[0].pk
+        choice_data = self.choice_data(poll_id=pk)
+        self.create_choices(choice_data, quantity=3)
+        users = User.objects.count()
+        vote_data = self.vote_data(poll_id=pk, choices=[1])
+        resp = self.api_client.post(
+            self.getURL('vote'), data=vote_data, format='json')
+        self.assertHttpCreated(resp)
+        resp = self.api_client.post(
+            self.getURL('vote'), data=vote_data, format='json')
+        self.assertHttpForbidden(resp)
+        self.api_client.client.cookies['quickpollscid'] = uuid.uuid4().hex
+        resp = self.api_client.post(
+            self.getURL('vote'), data=vote_data, format='json')
+        self.assertHttpCreated(resp)
+        # no users are created for anonymous voters
+        self.assertEqual(User.objects.count(), users)
+        self.assertEqual(Vote.objects.filter(user=None).count(), 2)
+        self.assertEqual(Vote.objects.values('voter').distinct().count(), 2)
+
+    @override_settings(POLLS_ANONYMOUS_VOTERS=True)
+    def test_anonymous_voters_not_anonymous_poll(self):
+        resp = self.create_poll(self.poll_data())
+        self.assertHttpCreated(resp)
+        pk = Poll.objects.order_by('-id')[0].pk
+        self.create_choices(self.choice_data(poll_id=pk), quantity=3)
+        vote_data = self.vote_data(poll_id=pk, choices=[1])
+        resp = self.api_client.post(
+            self.getURL('vote'), data=vote_data, format='json')
+        self.assertHttpForbidden(resp)
+
+    def test_voting_batch(self):
+        poll_data = self.poll_data(anonymous=True)
+        start_votes = make_naive(timezone.now()) - timedelta(hours=1)
+        poll_data['start_votes'] = unicode(start_votes.isoformat())
+        resp = self.create_poll(poll_data)
+        self.assertHttpCreated(resp)
+        pk = Poll.objects.order_by('-id')[0].pk
+        self.create_choices(self.choice_data(poll_id=pk), quantity=3)
+        cast = make_naive(timezone.now()) - timedelta(minutes=5)
+        batch = {
+            'poll': self.getURL('poll', id=pk),
+            'ballots': [
+                {'voter': 'kiosk-1', 'choice': ['choice0'],
+                 'data': {'region': 'north'}, 'created': cast.isoformat()},
+                {'voter': 'kiosk-2', 'choice': 'choice1'},
+                {'voter': 'kiosk-1', 'choice': ['choice1']},
+                {'voter': 'kiosk-3', 'choice': ['xchoice']},
+                {'voter': 'kiosk-4', 'choice': ['choice0', 'choice1']},
+                {'voter': 'kiosk-5', 'choice': ['choice2'], 'created': 'yesterday'},
+            ]
+        }
+        url = self.getURL('vote') + 'batch/'
+        # anonymous callers get no user or voter
+        users = User.objects.count()
+        for ip in ['1.1.1.1', '2.2.2.2']:
+            resp = self.api_client.post(url, data=batch, format='json',
+                                        REMOTE_ADDR=ip)
+            self.assertHttpUnauthorized(resp)
+        with override_settings(POLLS_ANONYMOUS_VOTERS=True):
+            resp = self.api_client.post(url, data=batch, format='json',
+                                        REMOTE_ADDR='3.3.3.3')
+            self.assertHttpUnauthorized(resp)
+        self.assertEqual(User.objects.count(), users)
+        self.assertFalse(Voter.objects.exists())
+        resp = self.api_client.post(url, data=batch, format='json',
+                                    authentication=self.get_credentials())
+        self.assertHttpUnauthorized(resp)
+        self.user.user_permissions.add(Permission.objects.get(codename='add_vote'))
+        resp = self.api_client.post(url, data=batch, format='json',
+                                    authentication=self.get_credentials())
+        self.assertHttpOK(resp)
+        self.assertEqual(self.deserialize(resp)['results'], [
+            {'status': 'accepted', 'reason': None},
+            {'status': 'accepted', 'reason': None},
+            {'status': 'duplicate', 'reason': None},
+            {'status': 'rejected', 'reason': 'PollInvalidChoice'},
+            {'status': 'rejected', 'reason': 'PollNotMultiple'},
+            {'status': 'rejected', 'reason': 'invalid created'},
+        ])
+        self.assertEqual(Poll.objects.get(pk=pk).count_total_votes(), 2)
+        vote = Vote.objects.get(choice__code='choice0')
+        self.assertEqual(vote.data, {'region': 'north'})
+        self.assertEqual(make_naive(vote.created), cast)
+        # syncing again reports duplicates
+        resp = self.api_client.post(url, data=batch, format='json',
+                                    authentication=self.get_credentials())
+        self.assertEqual([r['status'] for r in self.deserialize(resp)['results']][:3],
+                         ['duplicate'] * 3)
+
+    @override_settings(USE_TZ=False)
+    def test_voting_batch_naive(self):
+        cast = timezone.now() - timedelta(minutes=5)
+        poll = Poll.objects.create(question='naive', is_anonymous=True,
+                                   start_votes=cast - timedelta(days=1))
+        Choice.objects.create_for_poll(poll, ['yes', 'no'])
+        self.user.user_permissions.add(Permission.objects.get(codename='add_vote'))
+        url = self.getURL('vote') + 'batch/'
+        batch = {
+            'poll': self.getURL('poll', id=poll.pk),
+            'ballots': [
+                {'voter': 'kiosk-1', 'choice': ['yes'],
+                 'created': cast.isoformat()},
+                {'voter': 'kiosk-2', 'choice': ['no'],
+                 'created': cast.isoformat() + '+00:00'},
+            ]
+        }
+        resp = self.api_client.post(url, data=batch, format='json',
+                                    authentication=self.get_credentials())
+        self.assertHttpOK(resp)
+        self.assertEqual([r['status'] for r in self.deserialize(resp)['results']],
+                         ['accepted'] * 2)
+        self.assertEqual(Vote.objects.get(choice__code='yes').created, cast)
+        # the body must be an object
+        for data in ([batch], 'ballots'):
+            resp = self.api_client.post(url, data=data, format='json',
+                                        authentication=self.get_credentials())
+            self.assertHttpBadRequest(resp)
+
+    def test_result_timeseries(self):
+        poll_data = self.poll_data(anonymous=True)
+        poll_data['reference'] = 'broadcast'
+        resp = self.create_poll(poll_data)
+        self.assertHttpCreated(resp)
+        pk = Poll.objects.order_by('-id')[0].pk
+        self.create_choices(self.choice_data(poll_id=pk), quantity=3)
+        resp = self.api_client.post(
+            self.getURL('vote'), data=self.vote_data(poll_id=pk, choices=['choice1']),
+            format='json')
+        self.assertHttpCreated(resp)
+        url = self.getURL('result', id='broadcast') + 'timeseries/'
+        resp = self.api_client.get(url, data={'bucket': '1h'})
+        self.assertHttpOK(resp)
+        data = self.deserialize(resp)
+        self.assertEqual(data['bucket'], '1h')
+        self.assertEqual(data['codes'], ['choice0', 'choice1', 'choice2'])
+        self.assertEqual([item['votes'] for item in data['series']], [[0, 1, 0]])
+        resp = self.api_client.get(
+            self.getURL('result', id=pk) + 'timeseries/', data={'bucket': '1d'})
+        self.assertHttpBadRequest(resp)
+        resp = self.api_client.get(self.getURL('result', id='xpoll') + 'timeseries/')
+        self.assertHttpNotFound(resp)
+        # results as of a time before the vote
+        as_of = make_naive(timezone.now()) - timedelta(hours=1)
+        resp = self.api_client.get(self.getURL('result', id=pk),
+                                   data={'as_of': as_of.isoformat()})
+        self.assertHttpOK(resp)
+        self.assertEqual(self.deserialize(resp)['stats']['votes'], 0)
+        resp = self.api_client.get(self.getURL('result', id=pk),
+                                   data={'as_of': 'yesterday'})
+        self.assertHttpBadRequest(resp)
+        resp = self.api_client.get(self.getURL('result', id=pk),
+                                   data={'segment_by': 'region'})
+        self.assertHttpOK(resp)
+        self.assertEqual(self.deserialize(resp)['stats']['segments'], [
+            {'segment': None, 'counts': [0, 1, 0], 'values': [0.0, 1.0, 0.0],
+             'votes': 1}])
+        resp = self.api_client.get(self.getURL('result', id=pk), data={
+            'segment_by': 'region', 'as_of': as_of.isoformat()})
+        self.assertHttpBadRequest(resp)
+
+    @override_settings(POLLS_STREAM_TIMEOUT=0.1)
+    def test_result_stream(self):
+        resp = self.create_poll(self.poll_data(anonymous=True))
+        self.assertHttpCreated(resp)
+        pk = Poll.objects.order_by('-id')[0].pk
+        resp = self.api_client.get(self.getURL('result', id=pk) + 'stream/')
+        self.assertHttpOK(resp)
+        self.assertEqual(resp['Content-Type'], 'text/event-stream')
+        events = list(resp.streaming_content)
+        self.assertTrue(events[1].startswith('id: '))
+        resp = self.api_client.get(self.getURL('result', id='xpoll') + 'stream/')
+        self.assertHttpNotFound(resp)
+
     def test_voting_with_data(self):
         poll_data = self.poll_data(anonymous=True)
         resp = self.create_poll(poll_data)
@@ -247,10 +590,78 @@ class PollsApiTest(ResourceTestCase):
             pk = Poll.objects.order_by('-id')[0].pk
             choice_data = self.choice_data(poll_id=pk)
             self.create_choices(choice_data, quantity=3)
-        vote_data = self.vote_data(poll_id='two', choices=[1])
+        # choices of another poll are invalid
+        choice_pk = Choice.objects.filter(poll__reference='one')[0].pk
+        vote_data = self.vote_data(poll_id='two', choices=[choice_pk])
+        resp = self.api_client.post(
+            self.getURL('vote'), data=vote_data, format='json')
+        self.assertHttpBadRequest(resp)
+        choice_pk = Choice.objects.filter(poll__reference='two')[0].pk
+        vote_data = self.vote_data(poll_id='two', choices=[choice_pk])
+        resp = self.api_client.post(
+            self.getURL('vote'), data=vote_data, format='json')
+        self.assertHttpCreated(resp)
+
+    def test_resolve_poll(self):
+        self.assertEqual(resolve_poll('/api/v1/poll/12/'), (12, None))
+        self.assertEqual(resolve_poll('/polls/api/v1/poll/one-2/'),
+                         (None, 'one-2'))
+        self.assertEqual(resolve_poll('12'), (12, None))
+        self.assertEqual(resolve_poll(12), (12, None))
+        self.assertEqual(resolve_poll(u'one'), (None, u'one'))
+        for value in [None, '', '/api/v1/choice/12/', '/api/v1/poll/',
+                      '/api/v1/poll/12', 'one two', ['12']]:
+            self.assertRaises(NotFound, resolve_poll, value)
+        poll = Poll.objects.create(question='question', reference='one')
+        get_poll_rules_via_uri('one')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_poll_rules_via_uri(self.getURL('poll', id='one')),
+                             get_poll_rules_via_uri(self.getURL('poll', id=poll.pk)))
+        # compact references are the same poll
+        poll = Poll.objects.create(question='question')
+        reference = str(poll.reference)
+        resp = self.api_client.get(
+            self.getURL('poll', id=reference.replace('-', '')),
+            authentication=self.get_credentials())
+        self.assertHttpOK(resp)
+        self.assertEqual(self.deserialize(resp)['reference'], reference)
+        self.assertEqual(
+            get_poll_rules_via_uri(reference.replace('-', '')).pk, poll.pk)
+        # and keep the form they were stored in
+        poll = Poll.objects.create(question='question',
+                                   reference=uuid.uuid4().hex.upper())
+        resp = self.api_client.get(
+            self.getURL('poll', id=str(uuid.UUID(poll.reference))),
+            authentication=self.get_credentials())
+        self.assertHttpOK(resp)
+        self.assertEqual(self.deserialize(resp)['reference'], poll.reference)
+        self.assertNotIn('reference_uuid', self.deserialize(resp))
+        self.assertEqual(get_poll_rules_via_uri(poll.reference.lower()).pk,
+                         poll.pk)
+
+    def test_voting_closed_poll(self):
+        poll_data = self.poll_data(anonymous=True)
+        poll_data['reference'] = 'closing'
+        resp = self.create_poll(poll_data)
+        self.assertHttpCreated(resp)
+        poll = Poll.objects.get(reference='closing')
+        self.create_choices(self.choice_data(poll_id=poll.pk), quantity=3)
+        vote_data = self.vote_data(poll_id='closing', choices=['choice1'])
         resp = self.api_client.post(
             self.getURL('vote'), data=vote_data, format='json')
         self.assertHttpCreated(resp)
+        # closed polls are rejected by the cached rules, without a query
+        poll.is_closed = True
+        poll.save()
+        self.api_client.client.cookies['quickpollscid'] = uuid.uuid4().hex
+        resp = self.api_client.post(
+            self.getURL('vote'), data=vote_data, format='json')
+        self.assertHttpForbidden(resp)
+        with self.assertNumQueries(0):
+            resp = self.api_client.post(
+                self.getURL('vote'), data=vote_data, format='json')
+        self.assertHttpForbidden(resp)
+        self.assertEqual(Vote.objects.filter(poll=poll).count(), 1)
 
     def test_voting_multiple_votes_not_allowed(self):
         # create poll with vote, allow only one vote by user
@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from polls.benchmark import (OPERATIONS, compare_results, delete_poll,
+                             generate_poll, measure, run_benchmarks)
+from polls.models import ChoiceTally, Poll, Vote, Voter, VoteRollup
+
+
+class BenchmarkTest(TestCase):
+    def test_generate_poll(self):
+        poll = generate_poll(choices=5, votes=40, ballot_size=2, chunk_size=7)
+        self.assertEqual(poll.count_choices(), 5)
+        self.assertEqual(poll.vote_set.count(), 40)
+        self.assertEqual(poll.count_total_votes(), 40)
+        self.assertEqual(sum(poll.get_tally_as_of(poll.end_votes).values()), 40)
+        self.assertEqual(Voter.objects.count(), 20)
+        delete_poll(poll)
+        for model in (Poll, Vote, Voter, ChoiceTally, VoteRollup):
+            self.assertEqual(model.objects.count(), 0)
+
+    def test_measure(self):
+        calls = []
+        result = measure(calls.append, repeat=10, warmup=2)
+        self.assertEqual(calls, range(12))
+        self.assertEqual(result['count'], 10)
+        self.assertTrue(result['min'] <= result['p50'] <= result['p99'] <= result['max'])
+
+    def test_run_and_compare(self):
+        results = run_benchmarks(choices=[3], votes=[20], ballot_sizes=[1, 2, 5],
+                                 repeat=3, warmup=1)
+        self.assertEqual([scenario['ballot_size'] for scenario in results['scenarios']],
+                         [1, 2])
+        self.assertEqual(sorted(results['scenarios'][0]['operations']),
+                         sorted(OPERATIONS))
+        self.assertEqual(Poll.objects.count(), 0)
+        self.assertEqual(compare_results(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower['scenarios'][0]['operations']['vote']['ops_per_sec'] /= 2
+        self.assertEqual([(scenario, operation) for scenario, operation, before, after
+                          in compare_results(results, slower)],
+                         [((3, 20, 1), 'vote')])
+
+    def test_command(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            out = StringIO()
+            call_command('polls_benchmark', choices='3', votes='10', repeat=2,
+                         warmup=0, operations='get_stats,vote', output=path,
+                         stdout=out)
+            with open(path) as f:
+                results = json.load(f)
+            self.assertEqual(sorted(results['scenarios'][0]['operations']),
+                             ['get_stats', 'vote'])
+            self.assertEqual(results['environment']['database'], 'sqlite')
+            call_command('polls_benchmark', choices='3', votes='10', repeat=2,
+                         warmup=0, operations='get_stats', compare=path,
+                         threshold=100, stdout=out)
+            self.assertIn('no regressions', out.getvalue())
+        finally:
+            os.remove(path)
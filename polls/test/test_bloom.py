@@ -0,0 +1,88 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from polls.bloom import (DELTA_KEY, FILTER_KEY, LOCK_KEY, SEQUENCE_KEY,
+                         BloomFilter, might_have_voted, voter_key)
+from polls.cache import get_cache
+from polls.test.test_models import create_poll_single
+
+
+class BloomFilterTest(TestCase):
+    def test_membership(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('u%d' % i)
+        self.assertTrue(all('u%d' % i in bloom for i in range(1000)))
+        false_positives = sum('x%d' % i in bloom for i in range(10000))
+        self.assertTrue(false_positives < 300)
+        bloom = BloomFilter.loads(bloom.dumps())
+        self.assertTrue(all('u%d' % i in bloom for i in range(1000)))
+        self.assertEqual(bloom.count, 1000)
+        self.assertFalse(bloom.is_full)
+
+
+@override_settings(POLLS_VOTED_FILTER=True)
+class VotedFilterTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.user1 = User.objects.create_user('user1', 'test1@test.com', 'testtest1')
+        self.user2 = User.objects.create_user('user2', 'test2@test.com', 'testtest2')
+        self.user3 = User.objects.create_user('user3', 'test3@test.com', 'testtest3')
+
+    def test_already_voted(self):
+        poll, cids = create_poll_single()
+        # the filter is built from the existing votes
+        poll.vote([cids[0]], self.user1)
+        self.assertTrue(might_have_voted(poll, voter_key(self.user1.pk)))
+        self.assertTrue(poll.already_voted(self.user1))
+        # and updated by new votes
+        poll.vote([cids[0]], self.user2)
+        with self.assertNumQueries(1):
+            self.assertTrue(poll.already_voted(self.user2))
+        # negatives skip the database
+        with self.assertNumQueries(0):
+            self.assertFalse(poll.already_voted(self.user3))
+
+    def test_locked_filter_is_kept(self):
+        poll, cids = create_poll_single()
+        self.assertFalse(poll.already_voted(self.user1))
+        value = get_cache().get(FILTER_KEY % poll.pk)
+        get_cache().add(LOCK_KEY % poll.pk, True)
+        poll.vote([cids[0]], self.user1)
+        # votes do not rewrite the filter
+        self.assertEqual(get_cache().get(FILTER_KEY % poll.pk), value)
+        self.assertTrue(poll.already_voted(self.user1))
+        with self.assertNumQueries(0):
+            self.assertFalse(poll.already_voted(self.user2))
+        get_cache().delete(LOCK_KEY % poll.pk)
+
+    @override_settings(POLLS_VOTED_FILTER_DELTAS=2)
+    def test_deltas_are_merged(self):
+        poll, cids = create_poll_single()
+        self.assertFalse(poll.already_voted(self.user1))
+        poll.vote([cids[0]], self.user1)
+        poll.vote([cids[0]], self.user2)
+        self.assertFalse(might_have_voted(poll, voter_key(self.user3.pk)))
+        sequence = get_cache().get(SEQUENCE_KEY % poll.pk)
+        self.assertEqual(get_cache().get(FILTER_KEY % poll.pk)[0], sequence)
+        with self.assertNumQueries(0):
+            self.assertFalse(poll.already_voted(self.user3))
+
+    @override_settings(POLLS_VOTED_FILTER_DELTAS=1)
+    def test_missing_delta(self):
+        poll, cids = create_poll_single()
+        self.assertFalse(poll.already_voted(self.user1))
+        poll.vote([cids[0]], self.user1)
+        sequence = get_cache().get(SEQUENCE_KEY % poll.pk)
+        get_cache().delete(DELTA_KEY % (poll.pk, sequence))
+        # the voters are checked against the database
+        self.assertTrue(might_have_voted(poll, voter_key(self.user3.pk)))
+        self.assertTrue(poll.already_voted(self.user1))
+        # and the filter is rebuilt once the delta is overdue
+        poll.vote([cids[0]], self.user2)
+        self.assertTrue(might_have_voted(poll, voter_key(self.user3.pk)))
+        with self.assertNumQueries(0):
+            self.assertFalse(poll.already_voted(self.user3))
+        self.assertTrue(poll.already_voted(self.user1))
+        self.assertTrue(poll.already_voted(self.user2))
@@ -0,0 +1,112 @@
+from StringIO import StringIO
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from polls import cache
+from polls.buffer import VoteBuffer, get_vote_buffer
+from polls.models import Vote
+from polls.test.test_models import create_poll_single, create_poll_multiple
+
+
+class VoteBufferTest(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user('user1', 'test1@test.com', 'testtest1')
+        self.user2 = User.objects.create_user('user2', 'test2@test.com', 'testtest2')
+        self.path = tempfile.mkdtemp()
+        self.settings = override_settings(
+            POLLS_VOTE_BUFFER=os.path.join(self.path, 'votes.sqlite3'))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.path)
+
+    def test_buffered_vote(self):
+        poll, cids = create_poll_multiple()
+        votes = poll.vote([cids[0], cids[1]], self.user1, data={'foo': 'bar'})
+        self.assertEqual(len(votes), 2)
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(get_vote_buffer().depth(), 1)
+        self.assertTrue(poll.already_voted(self.user1))
+        self.assertFalse(poll.already_voted(self.user2))
+        self.assertEqual(get_vote_buffer().flush(), 1)
+        self.assertEqual(get_vote_buffer().depth(), 0)
+        self.assertEqual(Vote.objects.count(), 2)
+        self.assertEqual(Vote.objects.all()[0].data, {'foo': 'bar'})
+        self.assertEqual(poll.count_total_votes(), 2)
+        self.assertTrue(poll.already_voted(self.user1))
+
+    @override_settings(POLLS_VOTED_FILTER=True)
+    def test_buffered_vote_voted_filter(self):
+        cache.get_cache().clear()
+        poll, cids = create_poll_single()
+        poll.vote([cids[0]], self.user1)
+        # the filter is built without the spooled ballot
+        self.assertTrue(poll.already_voted(self.user1))
+        self.assertFalse(poll.already_voted(self.user2))
+        self.assertTrue(poll.already_voted(self.user1))
+        get_vote_buffer().flush()
+        self.assertTrue(poll.already_voted(self.user1))
+
+    def test_flush_command(self):
+        poll, cids = create_poll_single()
+        poll.vote([cids[0]], self.user1)
+        poll.vote([cids[1]], self.user2)
+        out = StringIO()
+        call_command('polls_flush_votes', once=True, batch_size=1, stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'flushed 2 ballots, 0 pending')
+        self.assertEqual(poll.count_percentage(True),
+                         {u'i-am-fine': 0.5, u'so-so': 0.5, u'bad': 0.0})
+
+    def test_change_vote_not_buffered(self):
+        poll, cids = create_poll_single()
+        poll.vote([cids[0]], self.user1, buffered=False)
+        poll.change_vote([cids[1]], self.user1)
+        self.assertEqual(get_vote_buffer().depth(), 0)
+        self.assertEqual(poll.vote_set.get().choice_id, cids[1])
+
+    def test_concurrent_flushes(self):
+        poll, cids = create_poll_single()
+        poll.vote([cids[0]], self.user1)
+        poll.vote([cids[1]], self.user2)
+        first = get_vote_buffer()
+        second = VoteBuffer(first.path)
+        # a flush in progress claimed the first ballot
+        flush_id, rows = first.claim(1)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(second.flush(), 1)
+        self.assertEqual(second.flush(), 0)
+        self.assertEqual(Vote.objects.get().user, self.user2)
+        self.assertEqual(second.depth(), 1)
+
+    def test_flush_after_crash(self):
+        poll, cids = create_poll_single()
+        poll.vote([cids[0]], self.user1)
+        poll.vote([cids[1]], self.user2)
+        buffer = get_vote_buffer()
+
+        def crash(poll_id):
+            raise RuntimeError()
+        # the flush dies after committing the votes
+        bump_version = cache.bump_version
+        cache.bump_version = crash
+        try:
+            self.assertRaises(RuntimeError, buffer.flush)
+        finally:
+            cache.bump_version = bump_version
+        self.assertEqual(Vote.objects.count(), 2)
+        self.assertEqual(buffer.depth(), 2)
+        # the ballots stay claimed until the claim times out
+        self.assertEqual(VoteBuffer(buffer.path).flush(), 0)
+        with override_settings(POLLS_VOTE_BUFFER_CLAIM_TIMEOUT=-1):
+            self.assertEqual(VoteBuffer(buffer.path).flush(), 2)
+        self.assertEqual(buffer.depth(), 0)
+        self.assertEqual(Vote.objects.count(), 2)
+        self.assertEqual(poll.count_percentage(True),
+                         {u'i-am-fine': 0.5, u'so-so': 0.5, u'bad': 0.0})
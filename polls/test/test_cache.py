@@ -0,0 +1,69 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from polls.cache import get_cache, get_version, results_cache
+from polls.test.test_models import create_poll_single
+
+
+@override_settings(POLLS_RESULTS_MAX_AGE=0,
+                   POLLS_RESULTS_STALE_WHILE_REVALIDATE=30,
+                   POLLS_RESULTS_BACKGROUND_REFRESH=False)
+class ResultsCacheTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        results_cache.reset_counters()
+        self.user1 = User.objects.create_user('user1', 'test1@test.com', 'testtest1')
+        self.user2 = User.objects.create_user('user2', 'test2@test.com', 'testtest2')
+        self.poll, self.cids = create_poll_single()
+
+    def test_hit_and_miss(self):
+        stats = results_cache.get_stats(self.poll)
+        self.assertEqual(stats, self.poll.get_stats())
+        with self.assertNumQueries(0):
+            self.assertEqual(results_cache.get_stats(self.poll), stats)
+        self.assertEqual(results_cache.counters(),
+                         dict(hits=1, stale=0, misses=1))
+
+    def test_version_bump(self):
+        version = get_version(self.poll.pk)
+        self.poll.vote([self.cids[0]], self.user1)
+        self.assertTrue(get_version(self.poll.pk) > version)
+        version = get_version(self.poll.pk)
+        self.poll.change_vote([self.cids[1]], self.user1)
+        self.assertTrue(get_version(self.poll.pk) > version)
+        version = get_version(self.poll.pk)
+        self.poll.save()
+        self.assertTrue(get_version(self.poll.pk) > version)
+
+    def test_stale_while_revalidate(self):
+        stats = results_cache.get_stats(self.poll)
+        self.poll.vote([self.cids[0]], self.user1)
+        # the stale results are served while they are recomputed
+        self.assertEqual(results_cache.get_stats(self.poll), stats)
+        self.assertEqual(results_cache.get_stats(self.poll)['votes'], 1)
+        self.assertEqual(results_cache.counters(),
+                         dict(hits=1, stale=1, misses=1))
+
+    @override_settings(POLLS_RESULTS_STALE_WHILE_REVALIDATE=0)
+    def test_stale_recompute(self):
+        results_cache.get_stats(self.poll)
+        self.poll.vote([self.cids[0]], self.user1)
+        self.assertEqual(results_cache.get_stats(self.poll)['votes'], 1)
+        self.assertEqual(results_cache.counters(),
+                         dict(hits=0, stale=0, misses=2))
+
+    def test_segment_by(self):
+        self.poll.vote([self.cids[0]], self.user1, data={'region': 'north'})
+        stats = results_cache.get_stats(self.poll, segment_by='region')
+        self.assertEqual(stats['segments'][0]['segment'], 'north')
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                results_cache.get_stats(self.poll, segment_by='region'), stats)
+        self.assertNotIn('segments', results_cache.get_stats(self.poll))
+        self.poll.vote([self.cids[1]], self.user2, data={'region': 'south'})
+        # stale, then revalidated
+        self.assertEqual(
+            results_cache.get_stats(self.poll, segment_by='region'), stats)
+        stats = results_cache.get_stats(self.poll, segment_by='region')
+        self.assertEqual(len(stats['segments']), 2)
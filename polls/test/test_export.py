@@ -0,0 +1,56 @@
+from StringIO import StringIO
+import csv
+import json
+
+from django.contrib.auth.models import Permission, User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from polls.export import export_lines
+from polls.test.test_models import create_poll_multiple
+
+
+class PollsExportTest(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user('user1', 'test1@test.com', 'testtest1')
+        self.user2 = User.objects.create_user('user2', 'test2@test.com', 'testtest2')
+        self.poll, self.cids = create_poll_multiple()
+        self.poll.vote([self.cids[0], self.cids[1]], self.user1,
+                       data={'region': 'north'}, comment=u'caf\xe9')
+        self.poll.vote([self.cids[2]], self.user2)
+
+    def test_csv(self):
+        rows = list(csv.reader(export_lines(self.poll, 'csv', chunk_size=2)))
+        self.assertEqual(rows[0], ['id', 'created', 'choice', 'user', 'voter',
+                                   'comment', 'data'])
+        self.assertEqual([row[2] for row in rows[1:]],
+                         ['french', 'english', 'german'])
+        self.assertEqual(rows[1][5], u'caf\xe9'.encode('utf-8'))
+        self.assertEqual(json.loads(rows[1][6]), {'region': 'north'})
+        self.assertEqual(rows[3][3], str(self.user2.pk))
+
+    def test_ndjson(self):
+        lines = [json.loads(line) for line in
+                 export_lines(self.poll, 'ndjson', chunk_size=1)]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0]['data'], {'region': 'north'})
+        self.assertEqual(lines[0]['comment'], u'caf\xe9')
+        self.assertEqual(lines[2]['choice'], 'german')
+
+    def test_command(self):
+        out = StringIO()
+        call_command('polls_export', str(self.poll.pk), format='ndjson',
+                     stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+    def test_view(self):
+        url = reverse('polls:export', args=[self.poll.pk, 'csv'])
+        self.client.login(username='user1', password='testtest1')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.user1.user_permissions.add(
+            Permission.objects.get(codename='change_poll'))
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'text/csv')
+        self.assertEqual(len(b''.join(resp.streaming_content).splitlines()), 4)
@@ -0,0 +1,85 @@
+from importlib import import_module
+from StringIO import StringIO
+import uuid
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase
+
+from polls.fields import normalize_reference, parse_reference
+from polls.models import Poll
+
+
+class ReferenceFieldTest(TestCase):
+    def setUp(self):
+        self.uuid = uuid.UUID('5e0cdc46-d6fe-43fd-9849-b66ec15ecdb6')
+
+    def test_normalize(self):
+        hyphenated = u'5e0cdc46-d6fe-43fd-9849-b66ec15ecdb6'
+        for value in [self.uuid, hyphenated, hyphenated.upper(),
+                      '5e0cdc46d6fe43fd9849b66ec15ecdb6']:
+            self.assertEqual(parse_reference(value), self.uuid)
+            self.assertEqual(normalize_reference(value), hyphenated)
+        for value in ['one', '', 12]:
+            self.assertEqual(parse_reference(value), None)
+            self.assertEqual(normalize_reference(value), value)
+
+    def test_lookups(self):
+        poll = Poll.objects.create(question='question')
+        reference = str(poll.reference)
+        self.assertEqual(Poll.objects.get(pk=poll.pk).reference, reference)
+        compact = reference.replace('-', '')
+        self.assertEqual(Poll.objects.get(reference=compact), poll)
+        self.assertEqual(Poll.objects.get(reference=compact.upper()), poll)
+        self.assertEqual(Poll.objects.exclude(reference=compact).count(), 0)
+        # references are returned as they were stored
+        other = Poll.objects.create(question='question',
+                                    reference=self.uuid.hex.upper())
+        self.assertEqual(Poll.objects.get(reference=str(self.uuid)), other)
+        self.assertEqual(Poll.objects.get(pk=other.pk).reference,
+                         self.uuid.hex.upper())
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, Poll.objects.create,
+                              question='question', reference=str(self.uuid))
+        # names are looked up as they are
+        Poll.objects.create(question='question', reference='one')
+        self.assertEqual(Poll.objects.get(reference='one').reference, 'one')
+        self.assertFalse(Poll.objects.filter(reference='One').exists())
+        self.assertEqual(Poll.objects.filter(reference_uuid=None).count(), 1)
+        # the uuid is a compact column
+        field = Poll._meta.get_field('reference_uuid')
+        if connection.vendor != 'postgresql':
+            value = Poll.objects.values_list('reference_uuid', flat=True).get(
+                pk=other.pk)
+            self.assertEqual(len(bytes(value)), 16)
+            self.assertEqual(field.to_python(value), self.uuid)
+        self.assertRaises(ValidationError, field.to_python, self.uuid.bytes)
+        self.assertRaises(TypeError, field.get_prep_lookup, 'contains', 'one')
+
+    def test_migration(self):
+        poll = Poll.objects.create(question='question')
+        Poll.objects.create(question='question', reference='One')
+        Poll.objects.update(reference_uuid=None)
+        self.assertFalse(Poll.objects.filter(reference=poll.reference).exists())
+        migration = import_module('polls.migrations.0010_auto_20261016_1554')
+        with connection.schema_editor() as editor:
+            migration.fill_reference_uuids(apps, editor)
+        self.assertEqual(Poll.objects.get(reference=poll.reference), poll)
+        self.assertEqual(Poll.objects.get(reference='One').reference, 'One')
+        # references that are the same UUID are reported
+        table = connection.ops.quote_name(Poll._meta.db_table)
+        connection.cursor().execute(
+            'UPDATE %s SET reference = %%s WHERE reference = %%s' % table,
+            [str(poll.reference).upper(), 'One'])
+        Poll.objects.update(reference_uuid=None)
+        with connection.schema_editor() as editor:
+            self.assertRaises(ValueError, migration.fill_reference_uuids,
+                              apps, editor)
+
+    def test_migrations(self):
+        # the column type is that of the migrations of polls
+        out = StringIO()
+        call_command('makemigrations', 'polls', dry_run=True, stdout=out)
+        self.assertIn('No changes detected', out.getvalue())
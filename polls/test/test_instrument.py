@@ -0,0 +1,81 @@
+import json
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import Permission, User
+from django.test.utils import override_settings
+from tastypie.test import ResourceTestCase
+
+from polls import instrument
+from polls.instrument import fingerprint
+from polls.test.test_models import create_poll_single
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@override_settings(
+    POLLS_INSTRUMENTATION=True,
+    MIDDLEWARE_CLASSES=tuple(settings.MIDDLEWARE_CLASSES) +
+    ('polls.instrument.QueryInstrumentationMiddleware',))
+class InstrumentationTest(ResourceTestCase):
+    urls = 'polls.urls'
+
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        instrument.reset_aggregates()
+        self.handler = ListHandler()
+        instrument.logger.addHandler(self.handler)
+        instrument.logger.setLevel(logging.INFO)
+        self.user = User.objects.create_user('admin', 'admin@nomail.com', 'password')
+        self.user.user_permissions.add(Permission.objects.get(codename='add_poll'))
+
+    def tearDown(self):
+        instrument.logger.removeHandler(self.handler)
+        instrument.logger.setLevel(logging.NOTSET)
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint('SELECT "a"."id" FROM "a"  WHERE "a"."b" = 12 AND '
+                        '"a"."c" = \'it\'\'s\' AND "a"."d" IN (1, 2, 3)'),
+            'SELECT "a"."id" FROM "a" WHERE "a"."b" = ? AND "a"."c" = ? '
+            'AND "a"."d" IN (...)')
+        self.assertEqual(fingerprint('SELECT * FROM t2 WHERE x IN (%s, %s)'),
+                         'SELECT * FROM t2 WHERE x IN (...)')
+
+    def test_requests(self):
+        create_poll_single()
+        resp = self.api_client.get('/api/v1/poll/')
+        self.assertHttpOK(resp)
+        resp = self.api_client.post(
+            '/api/v1/poll/', format='json', data={'question': 'question'},
+            authentication=self.create_basic('admin', 'password'))
+        self.assertHttpCreated(resp)
+        self.assertEqual(len(self.handler.records), 2)
+        record = json.loads(self.handler.records[0].getMessage())
+        self.assertEqual(record['resource'], 'poll')
+        self.assertEqual(record['status'], 200)
+        self.assertTrue(record['queries'] >= 2)
+        self.assertTrue(len(record['slowest']) <= 5)
+        self.assertEqual(sorted(record['phases']),
+                         ['authentication', 'dehydrate', 'serialization'])
+        self.assertEqual(self.handler.records[1].polls_request['status'], 201)
+        self.assertIn('obj_create', self.handler.records[1].polls_request['phases'])
+        stats = instrument.aggregates()['poll']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['queries'],
+                         sum(json.loads(r.getMessage())['queries']
+                             for r in self.handler.records))
+        self.assertTrue(stats['statements'])
+
+    @override_settings(POLLS_INSTRUMENTATION=False)
+    def test_disabled(self):
+        self.api_client.get('/api/v1/poll/')
+        self.assertEqual(self.handler.records, [])
+        self.assertEqual(instrument.aggregates(), {})
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import Permission, User
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from polls import metrics
+from polls.cache import get_cache, results_cache
+from polls.exceptions import PollNotMultiple
+from polls.metrics import Counter, Histogram, Registry
+from polls.test.test_models import create_poll_single
+
+
+class MetricsTest(TestCase):
+    urls = 'polls.urls'
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.user1 = User.objects.create_user('user1', 'test1@test.com', 'testtest1')
+        self.user2 = User.objects.create_user('user2', 'test2@test.com', 'testtest2')
+
+    def test_expose(self):
+        registry = Registry()
+        counter = Counter(registry, 'test_total', 'A counter', ['poll'])
+        histogram = Histogram(registry, 'test_seconds', 'A histogram',
+                              buckets=[0.1, 1])
+        counter.inc(poll=1)
+        counter.inc(2, poll=1)
+        counter.inc(poll='a"b')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(registry.expose().splitlines(), [
+            '# HELP test_seconds A histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+            '# HELP test_total A counter',
+            '# TYPE test_total counter',
+            'test_total{poll="1"} 3',
+            'test_total{poll="a\\"b"} 1',
+        ])
+
+    def test_votes(self):
+        poll, cids = create_poll_single()
+        poll.vote([cids[0]], self.user1)
+        self.assertRaises(PollNotMultiple, poll.vote, [cids[0], cids[1]],
+                          self.user2)
+        values = metrics.registry.values()
+        self.assertEqual(values['polls_ballots_total'],
+                         {(('poll', unicode(poll.pk)),): 1})
+        self.assertEqual(values['polls_rejections_total'],
+                         {(('poll', unicode(poll.pk)),
+                           ('reason', u'PollNotMultiple')): 1})
+
+    def test_results_cache(self):
+        get_cache().clear()
+        poll, cids = create_poll_single()
+        results_cache.get_stats(poll)
+        results_cache.get_stats(poll)
+        self.assertEqual(metrics.registry.values()['polls_results_cache_total'],
+                         {(('result', u'miss'),): 1, (('result', u'hit'),): 1})
+
+    def test_processes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(POLLS_METRICS_DIR=directory):
+                metrics.ballots.inc(poll=1)
+                pid = os.fork()
+                if not pid:
+                    try:
+                        # values of the parent are not counted twice
+                        metrics.ballots.inc(2, poll=1)
+                        metrics.ballots.inc(poll=2)
+                        metrics.registry.flush()
+                    finally:
+                        os._exit(0)
+                os.waitpid(pid, 0)
+                self.assertEqual(len(os.listdir(directory)), 2)
+                exposed = metrics.registry.expose()
+            self.assertIn('polls_ballots_total{poll="1"} 3\n', exposed)
+            self.assertIn('polls_ballots_total{poll="2"} 1\n', exposed)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_view(self):
+        self.user1.user_permissions.add(Permission.objects.get(codename='change_poll'))
+        resp = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(resp.status_code, 403)
+        self.client.login(username='user1', password='testtest1')
+        resp = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp['Content-Type'].startswith('text/plain'))
+        self.assertIn('# TYPE polls_ballots_total counter', resp.content)
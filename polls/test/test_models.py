@@ -4,14 +4,26 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+from datetime import datetime, timedelta
+from StringIO import StringIO
 import random
 import logging
 from django.test import TestCase
+from django.contrib import admin
 from django.contrib.auth import get_user
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from polls.models import Poll, Choice, Vote
-from polls.exceptions import PollNotAnonymous, PollNotMultiple
+from django.db.models.deletion import Collector
+from django.test.utils import override_settings
+from django.utils import timezone
+from polls.admin import VoteAdmin
+from polls.cache import PollDataCache, get_cache, get_version
+from polls.models import Poll, Choice, Vote, ChoiceTally, Voter, VoteRollup, \
+    RULES_KEY, choice_maps, get_poll_rules, load_poll_rules, \
+    poll_references, poll_rules
+from polls.exceptions import PollClosed, PollNotAnonymous, PollNotMultiple, \
+    PollInvalidChoice
 
 logger = logging.getLogger(__name__)
 
@@ -78,6 +90,10 @@ class PollsModelTest(TestCase):
         self.user3 = User.objects.create_user('user3', 'test3@test.com', 'testtest3')
         self.user4 = User.objects.create_user('user4', 'test4@test.com', 'testtest4')
         Choice.objects.all().delete()
+        get_cache().clear()
+        choice_maps.local.clear()
+        poll_rules.local.clear()
+        poll_references.local.clear()
 
     def tearDown(self):
         pass
@@ -165,6 +181,313 @@ class PollsModelTest(TestCase):
                          {u'vegetables': 0.0, u'fruits': 0.0, 
                           u'milk': 1.0, u'meat': 0.0, u'chocolate': 0.0})
 
+    def test_tally_vote(self):
+        poll, cids = create_poll_multiple()
+        poll.vote([cids[0], cids[1]], self.user1)
+        poll.vote([cids[1]], self.user2)
+        self.assertDictEqual(poll.get_tally(), {cids[0]: 1, cids[1]: 2})
+        self.assertEqual(poll.count_total_votes(), 3)
+
+    def test_tally_change_vote(self):
+        poll, cids = create_poll_multiple()
+        poll.vote([cids[0], cids[1]], self.user1)
+        poll.change_vote([cids[2]], self.user1)
+        self.assertDictEqual(poll.get_tally(),
+                             {cids[0]: 0, cids[1]: 0, cids[2]: 1})
+        self.assertEqual(poll.count_total_votes(), 1)
+
+    def test_tally_delete_vote(self):
+        poll, cids = create_poll_multiple()
+        poll.vote([cids[0], cids[1]], self.user1)
+        poll.vote([cids[0]], self.user2)
+        version = get_version(poll.pk)
+        Vote.objects.filter(user=self.user1).delete()
+        self.assertDictEqual(poll.get_tally(), {cids[0]: 1, cids[1]: 0})
+        self.assertDictEqual(poll.get_tally_as_of(
+            timezone.now() + timedelta(minutes=1)), {cids[0]: 1, cids[1]: 0})
+        self.assertNotEqual(get_version(poll.pk), version)
+        # in the admin
+        vote = poll.vote_set.get()
+        VoteAdmin(Vote, admin.site).delete_model(None, vote)
+        self.assertEqual(poll.get_stats()['votes'], 0)
+        poll.vote([cids[2]], self.user1)[0].delete()
+        self.assertEqual(poll.count_total_votes(), 0)
+
+    def test_tally_delete_choice(self):
+        poll, cids = create_poll_multiple()
+        poll.vote([cids[0], cids[1]], self.user1)
+        poll.vote([cids[0]], self.user2)
+        # votes are deleted in bulk, not one by one
+        self.assertTrue(Collector(using='default').can_fast_delete(
+            poll.vote_set.all()))
+        Choice.objects.get(pk=cids[0]).delete()
+        self.assertDictEqual(poll.get_tally(), {cids[1]: 1})
+        self.assertEqual(poll.count_total_votes(), 1)
+        self.assertFalse(VoteRollup.objects.filter(choice=cids[0]).exists())
+
+    def test_tally_shards(self):
+        poll, cids = create_poll_anonymous_multiple()
+        poll.tally_shards = 4
+        poll.save()
+        for i in range(40):
+            poll.vote([cids[0], cids[1]])
+        self.assertTrue(ChoiceTally.objects.filter(choice=cids[0]).count() > 1)
+        self.assertTrue(ChoiceTally.objects.filter(choice=cids[0]).count() <= 4)
+        self.assertDictEqual(poll.get_tally(), {cids[0]: 40, cids[1]: 40})
+        self.assertEqual(poll.count_total_votes(), 80)
+        self.assertEqual(poll.get_stats()['values'], [0.5, 0.0, 0.0, 0.5, 0.0])
+        voter = Voter.objects.create(key='shards')
+        poll.vote([cids[0]], voter=voter)
+        poll.change_vote([cids[1]], voter=voter)
+        self.assertDictEqual(poll.get_tally(), {cids[0]: 40, cids[1]: 41})
+
+    def test_tally_invalid_choice(self):
+        poll, cids = create_poll_multiple()
+        self.assertRaises(PollInvalidChoice, poll.vote,
+                          [cids[0], 'xchoice'], self.user1)
+        self.assertEqual(poll.count_total_votes(), 0)
+        self.assertEqual(poll.vote_set.count(), 0)
+
+    def test_stats_single_query(self):
+        poll, cids = create_poll_multiple()
+        poll.vote([cids[0], cids[1]], self.user1)
+        poll.vote([cids[1]], self.user2)
+        with self.assertNumQueries(1):
+            stats = poll.get_stats()
+        self.assertDictEqual(stats, {
+            'labels': [u'Chinese', u'English', u'French', u'German', u'Japanese'],
+            'codes': [u'chinese', u'english', u'french', u'german', u'japanese'],
+            'values': [0.0, 2 / 3.0, 1 / 3.0, 0.0, 0.0],
+            'votes': 3,
+        })
+        with self.assertNumQueries(1):
+            poll.count_percentage(True)
+
+    def test_stats_no_votes(self):
+        poll, cids = create_poll_single()
+        self.assertDictEqual(poll.count_percentage(True),
+                             {u'i-am-fine': 0.0, u'so-so': 0.0, u'bad': 0.0})
+        self.assertDictEqual(poll.get_stats(), {
+            'labels': [u'Bad', u'I am fine', u'So so'],
+            'codes': [u'bad', u'i-am-fine', u'so-so'],
+            'values': [0.0, 0.0, 0.0],
+            'votes': 0,
+        })
+
+    def test_vote_queries(self):
+        poll, cids = create_poll_multiple()
+        poll.vote(cids, self.user1)
+        # insert the first vote and the others, update the tally and the
+        # 1m and 1h rollups (plus savepoints), choices are resolved by the
+        # cached choice map
+        with self.assertNumQueries(5 + 2):
+            votes = poll.vote(cids, self.user2)
+        self.assertEqual(len(votes), 5)
+        self.assertEqual(Vote.objects.get(pk=votes[0].pk).choice_id, cids[0])
+        self.assertEqual(sorted(poll.vote_set.filter(user=self.user2)
+                                .values_list('choice', flat=True)), sorted(cids))
+        # ballots that share their voter and time keep their own pk
+        anonymous, choices = create_poll_anonymous_multiple()
+        first = anonymous.vote(choices[:2])
+        second = anonymous.vote(choices[2:4])
+        self.assertNotEqual(first[0].pk, second[0].pk)
+        self.assertEqual(Vote.objects.get(pk=second[0].pk).choice_id,
+                         choices[2])
+        self.assertEqual(poll.vote_set.count(), 10)
+        self.assertEqual(poll.count_total_votes(), 10)
+
+    def test_rollups(self):
+        poll, cids = create_poll_anonymous_multiple()
+        start = datetime(2016, 4, 24, 9, 58, 30, tzinfo=timezone.utc)
+        poll.start_votes = start
+        poll.save()
+        poll.vote_batch([
+            {'voter': 'a', 'choice': [cids[0], cids[1]], 'created': start},
+            {'voter': 'b', 'choice': [cids[0]],
+             'created': start + timedelta(seconds=20)},
+            {'voter': 'c', 'choice': [cids[1]],
+             'created': start + timedelta(minutes=2)},
+        ])
+        self.assertEqual(VoteRollup.objects.filter(bucket=60).count(), 3)
+        self.assertEqual(VoteRollup.objects.filter(bucket=3600).count(), 3)
+        series = poll.get_timeseries('1m')
+        self.assertEqual(series['codes'],
+                         [u'chocolate', u'fruits', u'meat', u'milk', u'vegetables'])
+        self.assertEqual([(item['start'].strftime('%H:%M'), item['votes'])
+                          for item in series['series']],
+                         [('09:58', [2, 0, 0, 1, 0]),
+                          ('10:00', [0, 0, 0, 1, 0])])
+        self.assertEqual(len(poll.get_timeseries('1h')['series']), 2)
+        self.assertEqual(len(poll.get_timeseries(
+            '1m', since=start + timedelta(minutes=1))['series']), 1)
+        # as of a time the votes of the complete minutes before are counted
+        as_of = start + timedelta(minutes=1, seconds=45)
+        self.assertDictEqual(poll.get_tally_as_of(as_of), {cids[0]: 2, cids[1]: 1})
+        self.assertEqual(poll.get_stats(as_of=as_of)['votes'], 3)
+        self.assertEqual(poll.get_stats(as_of=timezone.now()), poll.get_stats())
+        poll.change_vote([cids[2]], voter=Voter.objects.get(
+            key=Voter.hash_key('a')))
+        # the new vote is counted once its minute is complete
+        as_of = timezone.now() + timedelta(minutes=1)
+        self.assertDictEqual(poll.get_tally_as_of(as_of),
+                             {cids[0]: 1, cids[1]: 1, cids[2]: 1})
+        self.assertEqual(poll.get_stats(as_of=as_of), poll.get_stats())
+
+    def test_segment_stats(self):
+        poll, cids = create_poll_anonymous_multiple()
+        poll.vote([cids[0], cids[1]], data={'region': 'north', 'age': '18-24'})
+        poll.vote([cids[0]], data={'region': 'north', 'age': '25-34'})
+        poll.vote([cids[1]], data={'region': 'south'})
+        poll.vote([cids[1]], data={'age': '18-24'})
+        poll.vote([cids[2]])
+        with self.assertNumQueries(2):
+            stats = poll.get_stats(segment_by='region')
+        self.assertEqual(stats['codes'],
+                         [u'chocolate', u'fruits', u'meat', u'milk', u'vegetables'])
+        self.assertEqual(stats['votes'], 6)
+        self.assertEqual(stats['values'], poll.get_stats()['values'])
+        self.assertEqual(stats['segment_by'], 'region')
+        self.assertEqual([(item['segment'], item['counts'], item['votes'])
+                          for item in stats['segments']],
+                         [(u'north', [2, 0, 0, 1, 0], 3),
+                          (u'south', [0, 0, 0, 1, 0], 1),
+                          (None, [0, 1, 0, 1, 0], 2)])
+        self.assertEqual(stats['segments'][0]['values'],
+                         [2 / 3.0, 0.0, 0.0, 1 / 3.0, 0.0])
+        self.assertEqual(dict(poll.get_segments('age'))[u'18-24'],
+                         [1, 0, 0, 2, 0])
+        self.assertRaises(ValueError, poll.get_stats, as_of=timezone.now(),
+                          segment_by='region')
+
+    def test_choice_map(self):
+        poll, cids = create_poll_multiple()
+        poll.vote(['french'], self.user1)
+        with self.assertNumQueries(0):
+            choices = poll.resolve_choices(['english', str(cids[2]), cids[3]])
+        self.assertEqual([choice.pk for choice in choices], cids[1:4])
+        self.assertEqual(choices[0].code, 'english')
+        # numeric codes
+        choice = Choice.objects.create(poll=poll, choice='2016', code='2016')
+        self.assertEqual(poll.resolve_choices(['2016'])[0].pk, choice.pk)
+        # changes are seen at once by this process and through the shared
+        # cache by others
+        choice.code = 'twenty-sixteen'
+        choice.save()
+        self.assertRaises(PollInvalidChoice, poll.resolve_choices, ['2016'])
+        self.assertEqual(poll.resolve_choices(['twenty-sixteen'])[0].pk, choice.pk)
+        choice.delete()
+        self.assertRaises(PollInvalidChoice, poll.resolve_choices,
+                          ['twenty-sixteen'])
+        # choices missing from a stale map are queried
+        choice_maps.local.clear()
+        get_cache().clear()
+        choice_maps.get(poll.pk)
+        Choice.objects.bulk_create([Choice(poll=poll, choice='Dutch', code='dutch')])
+        self.assertEqual(poll.resolve_choices(['dutch'])[0].code, 'dutch')
+        self.assertIn('dutch', choice_maps.get(poll.pk)[1])
+        # unknown choices cost the fallback query only
+        with self.assertNumQueries(1):
+            self.assertRaises(PollInvalidChoice, poll.resolve_choices, ['xchoice'])
+
+    def test_poll_rules(self):
+        poll, cids = create_poll_single()
+        poll.reference = 'rules'
+        poll.save()
+        rules = get_poll_rules(reference='rules')
+        self.assertEqual(rules, poll.rules)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_poll_rules(reference='rules'), rules)
+            self.assertEqual(get_poll_rules(pk=str(poll.pk)), rules)
+        # votes by a snapshot are votes of the poll
+        votes = rules.as_poll().vote([cids[0]], self.user1)
+        vote = Vote.objects.get()
+        self.assertEqual((vote.pk, vote.poll_id), (votes[0].pk, poll.pk))
+        self.assertEqual(dict((choice.pk, choice.votes) for choice
+                              in poll.count_votes_by_choice())[cids[0]], 1)
+        # saving the poll invalidates the snapshot
+        poll.is_closed = True
+        poll.reference = 'renamed'
+        poll.save()
+        rules = get_poll_rules(pk=poll.pk)
+        self.assertTrue(rules.is_closed)
+        self.assertRaises(PollClosed, rules.check_open)
+        self.assertRaises(PollClosed, rules.as_poll().vote, [cids[0]],
+                          self.user2)
+        # stale references are verified against the snapshot
+        self.assertRaises(Poll.DoesNotExist, get_poll_rules, reference='rules')
+        self.assertEqual(get_poll_rules(reference='renamed').pk, poll.pk)
+        pk = poll.pk
+        poll.delete()
+        self.assertRaises(Poll.DoesNotExist, get_poll_rules, pk=pk)
+        self.assertRaises(Poll.DoesNotExist, get_poll_rules,
+                          reference='renamed')
+
+    def test_poll_data_cache(self):
+        poll, cids = create_poll_single()
+        # the rules as cached by another process
+        other = PollDataCache(RULES_KEY, load_poll_rules)
+        generation = other.generation(poll.pk)
+        rules = other.get(poll.pk)
+        self.assertFalse(rules.is_closed)
+        poll.is_closed = True
+        poll.save()
+        # other processes see the invalidation at once
+        self.assertTrue(other.get(poll.pk).is_closed)
+        # values loaded before the invalidation are not served
+        get_cache().set('%s:%s' % (RULES_KEY % poll.pk, generation), rules)
+        other.local.clear()
+        self.assertTrue(other.get(poll.pk).is_closed)
+        self.assertTrue(get_poll_rules(pk=poll.pk).is_closed)
+
+    def test_vote_by_code(self):
+        poll, cids = create_poll_multiple()
+        poll.vote(['french', str(cids[1])], self.user1)
+        self.assertEqual(poll.count_percentage(True)['french'], 0.5)
+        self.assertEqual(poll.count_percentage(True)['english'], 0.5)
+
+    def test_vote_choice_of_other_poll(self):
+        poll, cids = create_poll_multiple()
+        other_poll, other_cids = create_poll_single()
+        self.assertRaises(PollInvalidChoice, poll.vote,
+                          [cids[0], other_cids[0]], self.user1)
+        self.assertRaises(PollInvalidChoice, poll.vote, [None], self.user1)
+        self.assertEqual(Vote.objects.count(), 0)
+
+    def test_voter_vote(self):
+        poll, cids = create_poll_anonymous_single()
+        voter = Voter.objects.create(key=Voter.hash_key('127.0.0.1'))
+        other = Voter.objects.create(key=Voter.hash_key('127.0.0.2'))
+        self.assertFalse(poll.already_voted(AnonymousUser(), voter=voter))
+        poll.vote([cids[0]], voter=voter)
+        self.assertTrue(poll.already_voted(AnonymousUser(), voter=voter))
+        self.assertFalse(poll.already_voted(AnonymousUser(), voter=other))
+        poll.change_vote([cids[1]], voter=voter)
+        self.assertEqual(poll.votes_by(None, voter).get().choice_id, cids[1])
+
+    @override_settings(DEFAULT_FROM_EMAIL='polls@nomail.com')
+    def test_migrate_ip_users(self):
+        poll, cids = create_poll_anonymous_single()
+        ip_user = User.objects.create_user('127.0.0.1', 'polls@nomail.com')
+        poll.vote([cids[0]], ip_user)
+        poll.vote([cids[1]], self.user1)
+        call_command('polls_migrate_ip_users', delete=True, stdout=StringIO())
+        self.assertFalse(User.objects.filter(pk=ip_user.pk).exists())
+        voter = Voter.objects.get(key=Voter.hash_key('127.0.0.1'))
+        self.assertEqual(poll.votes_by(None, voter).get().choice_id, cids[0])
+        self.assertEqual(poll.votes_by(self.user1).get().choice_id, cids[1])
+        self.assertEqual(poll.count_total_votes(), 2)
+
+    def test_create_choices(self):
+        poll, cids = create_poll_single()
+        with self.assertNumQueries(2):
+            choices = Choice.objects.create_for_poll(
+                poll, ['Bad', 'x' * 40, 'x' * 40, '?'])
+        self.assertEqual([choice.code for choice in choices],
+                         ['bad-2', 'x' * 36, 'x' * 34 + '-2', 'choice'])
+        self.assertEqual(poll.count_choices(), 7)
+        self.assertRaises(PollInvalidChoice, Choice.objects.create_for_poll,
+                          poll, [{'choice': 'Bad', 'code': 'bad'}])
+
 # for authenticated users, only one vote allowed
 def create_poll_single():
     poll = Poll(question='How are you?', description='description')
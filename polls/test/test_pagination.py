@@ -0,0 +1,114 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.http import QueryDict
+from django.test import TestCase
+from django.utils import timezone
+from tastypie.exceptions import BadRequest
+
+from polls.models import Poll
+from polls.pagination import (POLL_KEYS, InvalidCursor, PollPaginator,
+                              keyset_page)
+from polls.test.test_models import create_poll_single
+from polls.views import PollListView
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        # pairs of polls with the same start_votes
+        for i in range(7):
+            Poll.objects.create(question='poll %d' % i,
+                                start_votes=now - timedelta(days=i // 2))
+        self.polls = list(Poll.objects.order_by(*POLL_KEYS))
+
+    def pages(self, queryset, keys, limit):
+        pages = []
+        cursor = None
+        while True:
+            page = keyset_page(queryset, keys, cursor, limit)
+            pages.append(list(page))
+            if not page.has_next:
+                return pages
+            cursor = page.next_cursor
+
+    def test_polls(self):
+        pages = self.pages(Poll.objects.all(), POLL_KEYS, 3)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), self.polls)
+        # pages do not depend on an offset
+        self.assertEqual(sum(self.pages(Poll.objects.all(), POLL_KEYS, 2), []),
+                         self.polls)
+        self.assertEqual(list(keyset_page(Poll.objects.all(), POLL_KEYS,
+                                          limit=None)), self.polls)
+        self.assertEqual(self.pages(Poll.objects.all(), POLL_KEYS, 7),
+                         [self.polls])
+
+    def test_votes(self):
+        user = User.objects.create_user('user1', 'test1@test.com', 'testtest1')
+        poll, cids = create_poll_single()
+        poll.is_multiple = True
+        poll.save()
+        # votes of a ballot are created at the same time
+        poll.vote(cids, user, buffered=False)
+        poll.vote(cids[:2], user, buffered=False)
+        # a first key that is not unique, newest first
+        keys = ('-created', '-id')
+        votes = list(poll.vote_set.order_by(*keys))
+        self.assertEqual(len(votes), 5)
+        pages = self.pages(poll.vote_set.all(), keys, 2)
+        self.assertEqual(sum(pages, []), votes)
+        self.assertEqual(pages[0], sorted(votes, key=lambda vote: (
+            vote.created, vote.pk), reverse=True)[:2])
+
+    def test_invalid_cursor(self):
+        for cursor in ['xyz', 'W10', 'WyJ4IiwgMV0', u'\xe4']:
+            self.assertRaises(InvalidCursor, keyset_page, Poll.objects.all(),
+                              POLL_KEYS, cursor)
+
+    def test_paginator(self):
+        request_data = QueryDict('limit=3&offset=6&reference=x')
+        paginator = PollPaginator(request_data, Poll.objects.all(),
+                                  resource_uri='/api/v1/poll/')
+        with self.assertNumQueries(2):
+            page = paginator.page()
+        self.assertEqual(page['objects'], self.polls[:3])
+        self.assertEqual(page['meta']['total_count'], 7)
+        self.assertEqual(page['meta']['previous'], None)
+        cursor = keyset_page(Poll.objects.all(), POLL_KEYS, limit=3).next_cursor
+        self.assertEqual(page['meta']['next'],
+                         '/api/v1/poll/?reference=x&limit=3&cursor=%s' % cursor)
+        # without counting
+        request_data = QueryDict('limit=3&count=false&cursor=%s' % cursor)
+        paginator = PollPaginator(request_data, Poll.objects.all(),
+                                  resource_uri='/api/v1/poll/')
+        with self.assertNumQueries(1):
+            page = paginator.page()
+        self.assertEqual(page['objects'], self.polls[3:6])
+        self.assertEqual(page['meta']['total_count'], None)
+        paginator = PollPaginator(QueryDict('cursor=xyz'), Poll.objects.all())
+        self.assertRaises(BadRequest, paginator.page)
+
+    def test_list_view(self):
+        url = reverse('polls:list')
+        resp = self.client.get(url)
+        self.assertEqual(list(resp.context['poll_list']), self.polls)
+        self.assertFalse(resp.context['is_paginated'])
+        polls = []
+        PollListView.paginate_by = 3
+        try:
+            cursor = None
+            while True:
+                resp = self.client.get(url, {'cursor': cursor} if cursor else {})
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.context['is_paginated'])
+                polls.extend(resp.context['poll_list'])
+                cursor = resp.context['page_obj'].next_cursor
+                if cursor is None:
+                    break
+                self.assertContains(resp, '?cursor=%s' % cursor)
+        finally:
+            PollListView.paginate_by = 20
+        self.assertEqual(polls, self.polls)
+        self.assertEqual(self.client.get(url, {'cursor': 'xyz'}).status_code, 404)
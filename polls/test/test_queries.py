@@ -0,0 +1,83 @@
+from datetime import timedelta
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from polls.models import Poll, Vote, Voter
+from polls.pagination import POLL_KEYS, after_cursor, encode_cursor
+from polls.test.test_models import create_poll_single
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are checked on SQLite')
+class QueryPlanTest(TestCase):
+    """
+    make sure the hot queries on votes use an index, see Vote.Meta
+    """
+    def setUp(self):
+        self.user1 = User.objects.create_user('user1', 'test1@test.com', 'testtest1')
+        self.poll, self.cids = create_poll_single()
+
+    def query_plan(self, queryset):
+        # exists() and count() clear the ordering of the queryset, pass
+        # querysets with order_by() to check the plans of those
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    def assertIndexSearch(self, queryset, condition):
+        plan = self.query_plan(queryset)
+        self.assertIn('INDEX', plan)
+        self.assertIn('(%s)' % condition, plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_votes_by_user(self):
+        self.assertIndexSearch(
+            self.poll.votes_by(self.user1).order_by().values('pk')[:1],
+            'poll_id=? AND user_id=?')
+
+    def test_votes_by_voter(self):
+        voter = Voter.objects.create(key=Voter.hash_key('127.0.0.1'))
+        self.assertIndexSearch(
+            self.poll.votes_by(None, voter).order_by().values('pk')[:1],
+            'poll_id=? AND voter_id=?')
+
+    def test_votes_by_time(self):
+        now = timezone.now()
+        votes = Vote.objects.filter(poll=self.poll,
+                                    created__gte=now - timedelta(hours=1),
+                                    created__lt=now).order_by('created')
+        self.assertIndexSearch(votes, 'poll_id=? AND created>? AND created<?')
+        votes = Vote.objects.filter(choice=self.cids[0],
+                                    created__gte=now - timedelta(hours=1))
+        self.assertIndexSearch(votes.order_by(), 'choice_id=? AND created>?')
+
+    def test_poll_by_reference(self):
+        reference = str(self.poll.reference).replace('-', '')
+        self.assertIndexSearch(Poll.objects.filter(reference=reference)
+                               .order_by().values('pk'), 'reference_uuid=?')
+        self.assertIndexSearch(Poll.objects.filter(reference='one')
+                               .order_by().values('pk'), 'reference=?')
+
+    def test_count_votes(self):
+        choice = self.poll.choice_set.get(pk=self.cids[0])
+        plan = self.query_plan(choice.vote_set.order_by().values('pk'))
+        self.assertIn('COVERING INDEX', plan)
+        self.assertIn('(choice_id=?)', plan)
+
+    def test_poll_ordering(self):
+        plan = self.query_plan(Poll.objects.all())
+        self.assertIn('INDEX', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        self.assertIndexSearch(Poll.objects.filter(start_votes__lte=timezone.now()),
+                               'start_votes<?')
+
+    def test_keyset_pages(self):
+        # the next page of a cursor is an index range scan, not a sort
+        cursor = encode_cursor([timezone.now(), 10])
+        plan = self.query_plan(after_cursor(Poll.objects.all(), POLL_KEYS, cursor))
+        self.assertIn('INDEX', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
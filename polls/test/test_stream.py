@@ -0,0 +1,91 @@
+import json
+import threading
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from polls import stream
+from polls.cache import get_cache, get_version, results_cache
+from polls.stream import ResultsChannel, event_stream
+from polls.test.test_models import create_poll_single
+
+
+class ResultsStreamTest(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        results_cache.reset_counters()
+        self.user1 = User.objects.create_user('user1', 'test1@test.com', 'testtest1')
+        self.poll, self.cids = create_poll_single()
+
+    def test_next(self):
+        channel = ResultsChannel(self.poll, interval=0)
+        version, stats = channel.next(None, timeout=1)
+        self.assertEqual(version, get_version(self.poll.pk))
+        self.assertEqual(stats, self.poll.get_stats())
+        # other subscribers get the same update without a query
+        with self.assertNumQueries(0):
+            self.assertEqual(channel.next(None, timeout=1), (version, stats))
+            self.assertEqual(channel.next(version, timeout=0.05), None)
+        self.poll.vote([self.cids[0]], self.user1)
+        version, stats = channel.next(version, timeout=1)
+        self.assertEqual(stats['votes'], 1)
+
+    def test_coalesce(self):
+        channel = ResultsChannel(self.poll, interval=0.1)
+        version, stats = channel.next(None, timeout=1)
+        self.poll.vote([self.cids[0]], self.user1)
+        # compute the new statistics here, subscriber threads cannot query
+        # the test database
+        results_cache.get_stats_at(self.poll, get_version(self.poll.pk))
+        results_cache.reset_counters()
+        updates = []
+
+        def subscriber():
+            updates.append(channel.next(version, timeout=5))
+        threads = [threading.Thread(target=subscriber) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(version for version, stats in updates)), 1)
+        self.assertEqual(updates[0][1]['votes'], 1)
+        # one refresh for all subscribers
+        self.assertEqual(results_cache.counters(),
+                         dict(hits=1, stale=0, misses=0))
+
+    @override_settings(POLLS_STREAM_INTERVAL=0.01, POLLS_STREAM_HEARTBEAT=0.05,
+                       POLLS_STREAM_TIMEOUT=0.2)
+    def test_event_stream(self):
+        events = list(event_stream(self.poll))
+        self.assertEqual(events[0], 'retry: 10\n\n')
+        lines = events[1].splitlines()
+        self.assertEqual(lines[0], 'id: %s' % get_version(self.poll.pk))
+        self.assertEqual(lines[1], 'event: stats')
+        self.assertEqual(json.loads(lines[2][len('data: '):]),
+                         self.poll.get_stats())
+        self.assertTrue(len(events) > 2)
+        self.assertEqual(set(events[2:]), set([': keep-alive\n\n']))
+        self.assertEqual(stream._channels, {})
+        # a client that has seen the current version gets no update
+        events = list(event_stream(self.poll, get_version(self.poll.pk)))
+        self.assertEqual(set(events[1:]), set([': keep-alive\n\n']))
+
+    @override_settings(POLLS_STREAM_MAX_SUBSCRIBERS=1,
+                       POLLS_STREAM_HEARTBEAT=0.05, POLLS_STREAM_TIMEOUT=0.2)
+    def test_max_subscribers(self):
+        channel = stream.subscribe(self.poll)
+        try:
+            self.assertEqual(stream.subscribe(self.poll), None)
+            # the client polls instead
+            events = list(event_stream(self.poll))
+            self.assertEqual(events[0], 'retry: 50\n\n')
+            self.assertEqual(len(events), 2)
+            self.assertTrue(events[1].startswith(
+                'id: %s\nevent: stats\n' % get_version(self.poll.pk)))
+            events = list(event_stream(self.poll, get_version(self.poll.pk)))
+            self.assertEqual(events, ['retry: 50\n\n'])
+        finally:
+            stream.unsubscribe(channel)
+        self.assertEqual(stream._channels, {})
+        self.assertEqual(stream._subscribers, 0)
@@ -0,0 +1,67 @@
+import time
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from polls.util import LRUCache, client_cache, get_user, get_voter
+
+
+class LRUCacheTest(TestCase):
+    def test_lru(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # b is the least recently used
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), dict(hits=3, misses=1, hit_rate=0.75,
+                                             size=2))
+
+    def test_ttl(self):
+        cache = LRUCache(maxsize=2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+
+
+class ClientUserTest(TestCase):
+    def setUp(self):
+        client_cache.clear()
+        self.request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.1')
+        self.request.user = AnonymousUser()
+
+    def test_get_user(self):
+        user = get_user(self.request)
+        self.assertEqual(user.username, '10.0.0.1')
+        self.assertFalse(user.has_usable_password())
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user(self.request).pk, user.pk)
+        self.assertEqual(client_cache.stats()['hits'], 1)
+        self.assertEqual(get_user(self.request, clientid='abc').username, 'abc')
+        self.assertEqual(User.objects.count(), 2)
+
+    def test_deleted_user(self):
+        user = get_user(self.request)
+        self.assertEqual(get_user(self.request).pk, user.pk)
+        # e.g. by polls_migrate_ip_users in another process
+        User.objects.filter(pk=user.pk).delete()
+        other = get_user(self.request)
+        self.assertNotEqual(other.pk, user.pk)
+        self.assertEqual(User.objects.get().pk, other.pk)
+
+    def test_get_existing_user(self):
+        User.objects.create_user('10.0.0.1')
+        client_cache.clear()
+        self.assertEqual(get_user(self.request).pk,
+                         User.objects.get(username='10.0.0.1').pk)
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_get_voter(self):
+        voter = get_voter(self.request)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_voter(self.request).pk, voter.pk)
+        self.assertEqual(get_voter(self.request).key, voter.key)
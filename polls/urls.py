@@ -1,7 +1,8 @@
 from django.conf.urls import patterns, url, include
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, permission_required
 
-from views import PollDetailView, PollListView, PollVoteView
+from views import PollDetailView, PollListView, PollVoteView, PollExportView, \
+    MetricsView
 from tastypie.api import Api, NamespacedApi
 from polls.api import UserResource, PollResource, ChoiceResource, VoteResource, ResultResource
 
@@ -17,4 +18,7 @@ urlpatterns = patterns('',
     url(r'^api/', include(v1_api.urls)),
     url(r'^(?P<pk>\d+)/$', PollDetailView.as_view(), name='detail'),
     url(r'^(?P<pk>\d+)/vote/$', login_required(PollVoteView.as_view()), name='vote'),
+    url(r'^(?P<pk>\d+)/export\.(?P<format>csv|ndjson)$',
+        permission_required('polls.change_poll')(PollExportView.as_view()), name='export'),
+    url(r'^metrics$', MetricsView.as_view(), name='metrics'),
 )
@@ -1,11 +1,19 @@
+from collections import OrderedDict
 import base64
+import threading
+import time
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.hashers import make_password
+from django.db import transaction, IntegrityError
 from tastypie.authentication import MultiAuthentication
 from tastypie.authorization import DjangoAuthorization
 
+from polls.cache import bump_counter, get_counter
+
+
+CLIENTS_KEY = 'polls:clients:generation'
+
 
 def get_client_ip(request):
     """
@@ -19,6 +27,89 @@ def get_client_ip(request):
     return ip
 
 
+class LRUCache(object):
+
+    """
+    a thread-safe, in-process least recently used cache with a time to live
+
+    Usage:
+        cache = LRUCache(maxsize=1000, ttl=300)
+        cache.set('key', value)
+        cache.get('key')
+        => value
+        cache.stats()
+        => { 'hits' : 1, 'misses' : 0, 'hit_rate' : 1.0, 'size' : 1 }
+    """
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.time():
+                self.misses += 1
+                return default
+            # move to the end, i.e. most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses,
+                        hit_rate=float(self.hits) / lookups if lookups else 0.0,
+                        size=len(self._data))
+
+
+#: (kind, generation, client key) => pk of user or voter, see get_user
+#: and get_voter
+client_cache = LRUCache(
+    maxsize=getattr(settings, 'POLLS_CLIENT_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'POLLS_CLIENT_CACHE_TTL', 300))
+
+
+def client_generation():
+    """
+    return the generation of the client_cache entries, shared by all
+    processes, see reset_client_cache
+    """
+    return get_counter(CLIENTS_KEY)
+
+
+def reset_client_cache():
+    """
+    forget the users and voters in the client_cache of all processes,
+    e.g. once some were deleted
+    """
+    bump_counter(CLIENTS_KEY)
+
+
 def get_user(request, clientid=None):
     """
     get a valid user, get or create a user by IP address 
@@ -31,21 +122,62 @@ def get_user(request, clientid=None):
 
     if the user is authenticated:
         returns it unchanged
+
+    the pks of users are kept in client_cache so that repeated requests
+    by the same client do not query the database. a user from the cache
+    only has its pk and username set.
     """
     user = request.user
     if request.user.is_anonymous():
-        User = get_user_model()
         username = clientid or get_client_ip(request)
-        try:
-            user = User.objects.get(username=username)
-        except:
-            unusable_password = make_password(None)
-            user = User.objects.create_user(username,
-                                            email=settings.DEFAULT_FROM_EMAIL,
-                                            password=unusable_password)
+        key = ('user', client_generation(), username)
+        pk = client_cache.get(key)
+        if pk is None:
+            user = get_or_create_client_user(username)
+            client_cache.set(key, user.pk)
+        else:
+            User = get_user_model()
+            user = User(pk=pk, **{User.USERNAME_FIELD: username})
     return user
 
 
+def get_or_create_client_user(username):
+    """
+    get or create a user without credentials. safe to be called
+    concurrently for the same username.
+    """
+    User = get_user_model()
+    try:
+        return User.objects.get(username=username)
+    except User.DoesNotExist:
+        pass
+    try:
+        with transaction.atomic():
+            return User.objects.create_user(username,
+                                            email=settings.DEFAULT_FROM_EMAIL,
+                                            password=None)
+    except IntegrityError:
+        # a concurrent request created the user
+        return User.objects.get(username=username)
+
+
+def get_voter(request, clientid=None):
+    """
+    get or create the Voter of an anonymous request by the given clientid,
+    which defaults to the ip address
+    """
+    from polls.models import Voter
+    client_key = clientid or get_client_ip(request)
+    key = ('voter', client_generation(), client_key)
+    pk = client_cache.get(key)
+    if pk is None:
+        voter, created = Voter.objects.get_or_create(
+            key=Voter.hash_key(client_key))
+        client_cache.set(key, voter.pk)
+        return voter
+    return Voter(pk=pk, key=Voter.hash_key(client_key))
+
+
 class ReasonableDjangoAuthorization(DjangoAuthorization):
 
     """
@@ -93,6 +225,10 @@ class IPAuthentication(MultiAuthentication):
     proxies. note that the cookie value is base64 encoded assuming we get
     a UUID of some sorts to ensure we get valid usernames. 
 
+    if settings.POLLS_ANONYMOUS_VOTERS is True, no user is created. instead
+    request.voter is set to a Voter and request.user remains anonymous.
+    use the polls_migrate_ip_users command to move existing users.
+
     Usage:
         # use the same as MultiAuthentication()
         IPAuthentication(BasicAuthentication(), SessionAuthentication())
@@ -106,5 +242,8 @@ class IPAuthentication(MultiAuthentication):
             clientid = request.COOKIES.get('quickpollscid', None)
             if clientid:
                 clientid = base64.b64encode(clientid)
-            request.user = get_user(request, clientid=clientid)
+            if getattr(settings, 'POLLS_ANONYMOUS_VOTERS', False):
+                request.voter = get_voter(request, clientid=clientid)
+            else:
+                request.user = get_user(request, clientid=clientid)
         return authed
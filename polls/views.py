@@ -1,13 +1,34 @@
-from django.views.generic import DetailView, ListView, RedirectView
+from django.shortcuts import get_object_or_404
+from django.views.generic import DetailView, ListView, RedirectView, View
 from django.core.urlresolvers import reverse_lazy
 from django.contrib import messages
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import PermissionDenied
-from models import Choice, Poll, Vote
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from exceptions import PollClosed, PollNotOpen, PollNotAnonymous, PollNotMultiple, \
+    PollInvalidChoice
+from export import CONTENT_TYPES, export_lines
+from metrics import registry
+from models import Poll, Vote
+from pagination import POLL_KEYS, InvalidCursor, keyset_page
 
 
 class PollListView(ListView):
+    """
+    the polls by start_votes, newest first. pages are selected by
+    ?cursor= rather than by page number, see polls.pagination
+    """
     model = Poll
+    paginate_by = 20
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get('cursor')
+        try:
+            page = keyset_page(queryset, POLL_KEYS, cursor, page_size)
+        except InvalidCursor:
+            raise Http404
+        return None, page, page.object_list, bool(cursor) or page.has_next
 
 
 class PollDetailView(DetailView):
@@ -26,13 +47,43 @@ class PollVoteView(RedirectView):
     def post(self, request, *args, **kwargs):
         poll = Poll.objects.get(id=kwargs['pk'])
         user = request.user
-        choice = Choice.objects.get(id=request.POST['choice_pk'])
         # if already voted, prevent IntegrityError
         if Vote.objects.filter(poll=poll, user=user).exists():
             raise PermissionDenied
-        Vote.objects.create(poll=poll, user=user, choice=choice)
+        # vote through the poll so the tally is kept up to date
+        try:
+            poll.vote([request.POST['choice_pk']], user=user)
+        except PollInvalidChoice:
+            raise Http404
+        except (PollClosed, PollNotOpen, PollNotAnonymous, PollNotMultiple):
+            raise PermissionDenied
         messages.success(request, _("Thanks for your vote."))
         return super(PollVoteView, self).post(request, *args, **kwargs)
 
     def get_redirect_url(self, **kwargs):
         return reverse_lazy('polls:detail', args=[kwargs['pk']])
+
+
+class PollExportView(View):
+    def get(self, request, *args, **kwargs):
+        poll = get_object_or_404(Poll, pk=kwargs['pk'])
+        format = kwargs['format']
+        response = StreamingHttpResponse(export_lines(poll, format),
+                                         content_type=CONTENT_TYPES[format])
+        response['Content-Disposition'] = (
+            'attachment; filename="poll-%s-votes.%s"' % (poll.pk, format))
+        return response
+
+
+class MetricsView(View):
+    """
+    the metrics of all processes in the Prometheus text format, see
+    polls.metrics. allowed for INTERNAL_IPS and users with the
+    change_poll permission.
+    """
+    def get(self, request, *args, **kwargs):
+        if (request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS and
+                not request.user.has_perm('polls.change_poll')):
+            raise PermissionDenied
+        return HttpResponse(registry.expose(),
+                            content_type='text/plain; version=0.0.4')